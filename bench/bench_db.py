@@ -0,0 +1,175 @@
+"""
+Đo độ trễ (p50 / p95 / p99) và số truy vấn mỗi giây của từng hàm truy cập dữ liệu trong main.py,
+chạy đồng thời nhiều luồng trên database hiện tại (DATABASE_URL hoặc DB_PATH).
+Nên nạp dữ liệu trước bằng bench/gen_data.py.
+
+    DATABASE_URL=postgresql://... python bench/bench_db.py --concurrency 8 --duration 10
+    python bench/bench_db.py --cases get_files_of_owner,is_user_allowed
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_samples(store):
+    """
+    Lấy mẫu tham số từ dữ liệu thật: vài user / thư mục nặng nhất + một nhóm ngẫu nhiên.
+    """
+    with store._cursor() as cur:
+        cur.execute(
+            """
+            SELECT owner_telegram_id AS uid, folder_id AS fid, COUNT(*) AS n
+            FROM files
+            GROUP BY owner_telegram_id, folder_id
+            ORDER BY n DESC
+            LIMIT 20
+            """
+        )
+        heavy = [(r["uid"], r["fid"]) for r in cur.fetchall()]
+        cur.execute("SELECT id AS fid, owner_telegram_id AS uid FROM folders ORDER BY random() LIMIT 2000")
+        light = [(r["uid"], r["fid"]) for r in cur.fetchall()]
+        cur.execute("SELECT token FROM share_tokens ORDER BY random() LIMIT 2000")
+        tokens = [r["token"] for r in cur.fetchall()]
+    if not light:
+        raise SystemExit("❌ Database chưa có dữ liệu – chạy bench/gen_data.py trước.")
+    return heavy or light, light, tokens or ["khong-co"]
+
+
+def build_cases(main, heavy, light, tokens, heavy_share):
+    def pick(rng):
+        return rng.choice(heavy) if rng.random() < heavy_share else rng.choice(light)
+
+    def files_in_folder(rng):
+        uid, fid = pick(rng)
+        main.get_files_of_owner(uid, folder_id=fid, limit=30)
+
+    def files_of_owner(rng):
+        main.get_files_of_owner(pick(rng)[0], limit=30)
+
+    def subtree_files(rng):
+        uid, fid = pick(rng)
+        main.get_subtree_files(uid, fid, limit=30)
+
+    def folders_page(rng):
+        main.list_folders_page(pick(rng)[0], main.FOLDERS_PAGE_SIZE, 0)
+
+    def share_token(rng):
+        uid, fid = pick(rng)
+        main.get_share_token(uid, fid)
+
+    return {
+        "get_files_of_owner": files_in_folder,
+        "get_files_of_owner_all": files_of_owner,
+        "get_subtree_files": subtree_files,
+        "list_folders": lambda rng: main.list_folders(pick(rng)[0]),
+        "list_folders_page": folders_page,
+        "get_current_folder": lambda rng: main.get_current_folder(pick(rng)[0]),
+        "search_files": lambda rng: main.search_files(pick(rng)[0], rng.choice(("anh", "hop", "du")), 20),
+        "get_share_token": share_token,
+        "get_owner_and_folder_by_token": lambda rng: main.get_owner_and_folder_by_token(rng.choice(tokens)),
+        # 2 hàm dưới có cache trong RAM ở main.py: đo thẳng truy vấn DB
+        "is_user_allowed": lambda rng: main.db().is_user_allowed(pick(rng)[0]),
+        "get_latest_ad": lambda rng: main.db().get_latest_ad(),
+    }
+
+
+def run_case(fn, concurrency, duration, seed):
+    """
+    concurrency luồng gọi fn liên tục trong duration giây. Trả về (danh sách độ trễ, số lỗi).
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(i):
+        rng = random.Random(seed + i)
+        mine = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            try:
+                fn(rng)
+            except Exception:
+                failed += 1
+                continue
+            mine.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def connections_opened(store):
+    """
+    Tổng số kết nối pool Postgres của store đã mở (primary + replica); None với SQLite (không có pool).
+    """
+    pools = [p for p in (getattr(store, "pool", None), getattr(store, "replica_pool", None)) if p]
+    return sum(p.opened for p in pools) if pools else None
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="số giây đo mỗi hàm")
+    parser.add_argument("--warmup", type=float, default=1.0, help="số giây chạy nóng trước khi đo")
+    parser.add_argument("--heavy-share", type=float, default=0.2, help="tỉ lệ lượt gọi rơi vào user nặng")
+    parser.add_argument("--cases", default="", help="chỉ đo các hàm này (ngăn bởi dấu phẩy)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # pool kết nối cố định, đủ cho số luồng (không luồng nào phải chờ kết nối), đặt trước khi import main
+    os.environ["DB_POOL_SIZE"] = str(max(args.concurrency, int(os.getenv("DB_POOL_SIZE", "5"))))
+    import main
+
+    store = main.init_db()
+    heavy, light, tokens = load_samples(store)
+    cases = build_cases(main, heavy, light, tokens, args.heavy_share)
+    if args.cases:
+        wanted = [c.strip() for c in args.cases.split(",") if c.strip()]
+        unknown = [c for c in wanted if c not in cases]
+        if unknown:
+            raise SystemExit(f"❌ Không có hàm: {', '.join(unknown)}. Có: {', '.join(cases)}")
+        cases = {c: cases[c] for c in wanted}
+
+    print(f"{store.name}, {args.concurrency} luồng, {args.duration:g}s mỗi hàm, "
+          f"{args.heavy_share:.0%} lượt gọi vào user nặng\n")
+    # "kết nối mới": số kết nối DB mở ra trong lúc đo hàm đó; pool cố định nên khác 0 là có kết nối hỏng phải mở lại
+    print(f"{'hàm':32} {'qps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'lỗi':>6} "
+          f"{'kết nối mới':>12}")
+    for name, fn in cases.items():
+        if args.warmup:
+            run_case(fn, args.concurrency, args.warmup, args.seed)
+        opened = connections_opened(store)
+        lat, errors = run_case(fn, args.concurrency, args.duration, args.seed)
+        opened = "-" if opened is None else connections_opened(store) - opened
+        lat.sort()
+        ms = [percentile(lat, q) * 1000 for q in (0.5, 0.95, 0.99)] + [(lat[-1] if lat else 0) * 1000]
+        print(f"{name:32} {len(lat) / args.duration:9.0f} " + " ".join(f"{v:9.2f}" for v in ms)
+              + f" {errors:6d} {opened:>12}")
+
+    store.close()
+    main.close_shared_pg_pools()
+
+
+if __name__ == "__main__":
+    main_cli()
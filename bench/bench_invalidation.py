@@ -0,0 +1,100 @@
+"""
+Đo độ trễ đồng bộ cache giữa 2 tiến trình dùng chung 1 PostgreSQL (NOTIFY / LISTEN).
+Tiến trình này ghi (thêm user vào whitelist), tiến trình con giữ whitelist trong RAM như bot đang chạy
+và báo lại lúc cache của nó thấy user mới.
+
+    DATABASE_URL=postgresql://... python bench/bench_invalidation.py --rounds 200
+
+Các user thử (id từ 900000000) được xoá khỏi whitelist khi chạy xong.
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIRST_UID = 900_000_000
+
+
+async def child(main):
+    """
+    Tiến trình con: LISTEN + whitelist trong RAM, in 1 dòng mỗi khi áp 1 sự kiện.
+    """
+    store = main.init_db()
+    listener = main.CacheListener(main.DATABASE_URL)
+    task = asyncio.create_task(listener.run())
+    while listener.conn is None:
+        await asyncio.sleep(0.01)
+    main.warm_caches(store)
+    print("ready", flush=True)
+
+    seen = 0
+    try:
+        while True:
+            if listener.received != seen:
+                seen = listener.received
+                allowed = main.WHITELIST_CACHE.get(store.tenant, allow_stale=True) or {0}
+                print(f"{seen} {listener.last_delay * 1000:.3f} {max(allowed)}", flush=True)
+            await asyncio.sleep(0.0005)
+    finally:
+        task.cancel()
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    import main
+
+    if not main.DATABASE_URL:
+        raise SystemExit("❌ Cần DATABASE_URL trỏ tới PostgreSQL (SQLite chỉ chạy 1 tiến trình).")
+    if args.child:
+        asyncio.run(child(main))
+        return
+
+    store = main.init_db()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        stdout=subprocess.PIPE, text=True, env=dict(os.environ, LOOP_STALL_THRESHOLD="0"),
+    )
+    try:
+        if proc.stdout.readline().strip() != "ready":
+            raise SystemExit("❌ Tiến trình con không khởi động được.")
+        notify_ms, total_ms = [], []
+        for i in range(args.rounds):
+            uid = FIRST_UID + i
+            started = time.perf_counter()
+            main.add_allowed_user(uid, 0)  # INSERT + NOTIFY
+            _, delay, newest = proc.stdout.readline().split()
+            total_ms.append((time.perf_counter() - started) * 1000)
+            notify_ms.append(float(delay))
+            if int(newest) != uid:
+                raise SystemExit(f"❌ Cache tiến trình con chưa có user {uid} (mới nhất: {newest}).")
+    finally:
+        proc.terminate()
+        proc.wait()
+        with store._cursor() as cur:
+            cur.execute("DELETE FROM allowed_users WHERE telegram_id >= %s", (FIRST_UID,))
+        store.close()
+        main.close_shared_pg_pools()
+
+    print(f"{args.rounds} lần thêm whitelist, cache tiến trình kia đều thấy user mới\n")
+    print(f"{'':34} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, values in (("NOTIFY → áp vào cache bên kia", notify_ms), ("ghi DB → cache bên kia đúng", total_ms)):
+        values.sort()
+        print(f"{name:34} {percentile(values, 0.5):9.2f} {percentile(values, 0.95):9.2f} {values[-1]:9.2f}")
+
+
+if __name__ == "__main__":
+    main_cli()
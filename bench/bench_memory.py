@@ -0,0 +1,154 @@
+"""
+Đo bộ nhớ của các cache trong RAM ở main.py (tracemalloc) trên database hiện tại (DATABASE_URL hoặc DB_PATH):
+- số byte mỗi phần tử cache: dòng dict đủ cột (cách cũ) so với record chỉ gồm cột cần dùng,
+  và 1 SharePlan dựng từ dữ liệu thật;
+- số khối bộ nhớ cấp phát mỗi update ở các đường nóng (bàn phím chính, inline query trúng cache).
+Nên nạp dữ liệu trước bằng bench/gen_data.py.
+
+    DATABASE_URL=postgresql://... python bench/bench_memory.py --rows 5000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def retained(fn):
+    """
+    Gọi fn() và giữ lại kết quả. Trả về (kết quả, số byte, số khối bộ nhớ còn sống do fn tạo ra).
+    """
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    result = fn()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    stats = after.compare_to(before, "filename")
+    return result, sum(s.size_diff for s in stats), sum(s.count_diff for s in stats)
+
+
+def fetch(store, sql, params=()):
+    with store._cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+
+def old_main_keyboard(main):
+    # get_main_keyboard() trước đây: dựng bàn phím mới ở mỗi lần trả lời
+    keyboard = [
+        [main.KeyboardButton("📁 Tạo thư mục mới"), main.KeyboardButton("/upload")],
+        [main.KeyboardButton("/getlink"), main.KeyboardButton("/myfiles")],
+        [main.KeyboardButton("/folders")],
+    ]
+    return main.ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+def bench_entries(main, store, rows):
+    """
+    (tên, byte / phần tử cách cũ, byte / phần tử hiện tại)
+    """
+    from storage import AdRef, ShareFile
+
+    file_cols = "id, file_id, file_name, file_type, file_size"
+    share_cols = "file_id, file_name, file_type, file_size, thumb_file_id, storage_chat_id, storage_message_id"
+    cases = [
+        ("FileRef (INLINE_CACHE)", f"SELECT {file_cols} FROM files ORDER BY id LIMIT %s",
+         f"SELECT {file_cols} FROM files ORDER BY id LIMIT %s", main.FileRef),
+        ("ShareFile (dựng link chia sẻ)", "SELECT * FROM files ORDER BY id LIMIT %s",
+         f"SELECT {share_cols} FROM files ORDER BY id LIMIT %s", ShareFile),
+        ("AdRef (LATEST_AD_CACHE)", "SELECT * FROM ads ORDER BY id LIMIT %s",
+         "SELECT code, content FROM ads ORDER BY id LIMIT %s", AdRef),
+    ]
+    out = []
+    for name, old_sql, new_sql, record in cases:
+        old, old_bytes, _ = retained(lambda: fetch(store, old_sql, (rows,)))
+        new, new_bytes, _ = retained(lambda: [record.from_row(r) for r in fetch(store, new_sql, (rows,))])
+        if old:
+            out.append((name, len(old), old_bytes / len(old), new_bytes / len(new)))
+        del old, new
+    return out
+
+
+def bench_share_plans(main, store, n):
+    """
+    Byte trung bình của 1 SharePlan (album / bước copy / ảnh xem trước của tối đa 30 file).
+    """
+    folders = fetch(
+        store,
+        """
+        SELECT folder_id AS fid, owner_telegram_id AS uid FROM files
+        WHERE deleted_at IS NULL GROUP BY folder_id, owner_telegram_id
+        ORDER BY COUNT(*) DESC LIMIT %s
+        """,
+        (n,),
+    )
+    plans, size, _ = retained(lambda: [main.build_share_plan(r["uid"], r["fid"]) for r in folders])
+    plans = [p for p in plans if p]
+    return len(plans), size / max(1, len(plans))
+
+
+def bench_updates(main, store, n):
+    """
+    (tên, số khối / update, byte / update) cho n update liên tiếp, giữ lại đồ gửi đi của từng update.
+    """
+    uid = fetch(store, "SELECT owner_telegram_id AS uid FROM files GROUP BY owner_telegram_id "
+                       "ORDER BY COUNT(*) DESC LIMIT 1")[0]["uid"]
+    main.INLINE_CACHE.clear()
+    main._inline_lookup(uid, "", 0)  # nạp cache trước: đo đường trúng cache
+
+    def inline_update():
+        rows, block_start = main._inline_lookup(uid, "", 0)
+        return [main._inline_result(f) for f in rows[:main.INLINE_PAGE_SIZE]]
+
+    cases = [
+        ("bàn phím chính (cũ: dựng mới)", lambda: old_main_keyboard(main)),
+        ("bàn phím chính (dùng chung)", main.get_main_keyboard),
+        ("inline query trúng cache", inline_update),
+    ]
+    out = []
+    for name, fn in cases:
+        fn()
+        _, size, blocks = retained(lambda: [fn() for _ in range(n)])
+        out.append((name, blocks / n, size / n))
+    return out
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="số dòng đo cho mỗi kiểu phần tử cache")
+    parser.add_argument("--plans", type=int, default=200, help="số thư mục dựng SharePlan")
+    parser.add_argument("--updates", type=int, default=1000, help="số update giả lập mỗi đường nóng")
+    args = parser.parse_args()
+
+    import main
+
+    store = main.init_db()
+    if not fetch(store, "SELECT id FROM files LIMIT 1"):
+        raise SystemExit("❌ Database chưa có dữ liệu – chạy bench/gen_data.py trước.")
+
+    tracemalloc.start()
+    entries = bench_entries(main, store, args.rows)
+    n_plans, plan_bytes = bench_share_plans(main, store, args.plans)
+    updates = bench_updates(main, store, args.updates)
+    tracemalloc.stop()
+
+    print(f"{store.name}\n")
+    print(f"{'phần tử cache':32} {'số dòng':>8} {'dict B':>9} {'record B':>9} {'giảm':>6}")
+    for name, n, old, new in entries:
+        print(f"{name:32} {n:8d} {old:9.0f} {new:9.0f} {1 - new / old:6.0%}")
+    print(f"{'SharePlan (SHARE_PLANS)':32} {n_plans:8d} {plan_bytes:9.0f}")
+
+    print(f"\n{'mỗi update':32} {'khối':>8} {'byte':>9}")
+    for name, blocks, size in updates:
+        print(f"{name:32} {blocks:8.1f} {size:9.0f}")
+
+    store.close()
+    main.close_shared_pg_pools()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,185 @@
+"""
+Sinh dữ liệu giả (lệch như thật: vài user rất nặng, rất nhiều user nhẹ) và nạp hàng loạt vào
+PostgreSQL bằng COPY, để đo truy vấn với bench/bench_db.py.
+
+    DATABASE_URL=postgresql://... python bench/gen_data.py --users 100000 --files 10000000
+
+CHỈ chạy trên database thử nghiệm: các bảng của bot bị xoá sạch trước khi nạp.
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+FILE_TYPES = (
+    ("photo", "image/jpeg", ".jpg"),
+    ("video", "video/mp4", ".mp4"),
+    ("document", "application/pdf", ".pdf"),
+    ("audio", "audio/mpeg", ".mp3"),
+)
+WORDS = (
+    "anh", "video", "hop", "dong", "bao", "cao", "du", "lich", "gia", "dinh",
+    "tai", "lieu", "hoc", "tap", "cong", "viec", "nhac", "phim", "scan", "hoa", "don",
+)
+TABLES = (
+    "files", "folder_tree", "user_current_folder", "share_tokens",
+    "share_stats", "file_mirrors", "folders", "allowed_users", "users", "ads", "jobs",
+)
+COPY_BATCH = 100_000
+
+
+def zipf_counts(total, n, s, rng):
+    """
+    Chia total phần cho n user theo luật Zipf (hạng r nhận tỉ lệ 1/r^s), thứ hạng xáo ngẫu nhiên.
+    """
+    weights = [1.0 / (r ** s) for r in range(1, n + 1)]
+    norm = sum(weights)
+    counts = [int(total * w / norm) for w in weights]
+    for i in range(total - sum(counts)):
+        counts[i % n] += 1
+    rng.shuffle(counts)
+    return counts
+
+
+def ts(epoch):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+def copy_rows(cur, table, columns, rows):
+    """
+    COPY theo từng lô COPY_BATCH dòng: không dựng cả bảng trong RAM.
+    """
+    buf = io.StringIO()
+    n = 0
+
+    def flush():
+        buf.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+        buf.seek(0)
+        buf.truncate()
+
+    for row in rows:
+        buf.write("\t".join("\\N" if v is None else str(v) for v in row))
+        buf.write("\n")
+        n += 1
+        if n % COPY_BATCH == 0:
+            flush()
+    if buf.tell():
+        flush()
+    return n
+
+
+def generate(cur, args):
+    rng = random.Random(args.seed)
+    now = time.time()
+    year = 365 * 86400
+
+    files_per_user = zipf_counts(args.files, args.users, args.skew, rng)
+    user_ids = [10_000_000 + i for i in range(args.users)]
+
+    # users
+    copy_rows(cur, "users", ("id", "telegram_id", "full_name", "username", "created_at"), (
+        (i + 1, uid, f"User {uid}", f"u{uid}", ts(now - rng.random() * year))
+        for i, uid in enumerate(user_ids)
+    ))
+
+    # folders: user nhiều file thì nhiều thư mục hơn
+    folders = []  # (folder_id, owner)
+    folder_id = 0
+    for uid, n_files in zip(user_ids, files_per_user):
+        n_folders = 1 + min(n_files // 500, args.max_folders - 1)
+        for _ in range(n_folders):
+            folder_id += 1
+            folders.append((folder_id, uid))
+    copy_rows(cur, "folders", ("id", "owner_telegram_id", "name", "created_at"), (
+        (fid, uid, f"Thư mục {fid}", ts(now - rng.random() * year))
+        for fid, uid in folders
+    ))
+    copy_rows(cur, "folder_tree", ("ancestor_id", "descendant_id", "depth"), (
+        (fid, fid, 0) for fid, _ in folders
+    ))
+
+    # thư mục của từng user (để chọn ngẫu nhiên, thư mục đầu tiên nặng nhất)
+    user_folders = {}
+    for fid, uid in folders:
+        user_folders.setdefault(uid, []).append(fid)
+
+    copy_rows(cur, "user_current_folder", ("owner_telegram_id", "folder_id"), (
+        (uid, fids[0]) for uid, fids in user_folders.items()
+    ))
+
+    def file_rows():
+        file_id = 0
+        for uid, n_files in zip(user_ids, files_per_user):
+            fids = user_folders[uid]
+            for _ in range(n_files):
+                file_id += 1
+                ftype, mime, ext = rng.choice(FILE_TYPES)
+                # ~nửa số file rơi vào thư mục đầu tiên
+                fid = fids[0] if rng.random() < 0.5 else rng.choice(fids)
+                name = "_".join(rng.sample(WORDS, 3)) + f"_{file_id}{ext}"
+                yield (
+                    file_id, f"uq{file_id}", f"fid{file_id}", uid, fid, name, main.fold_name(name), ftype,
+                    rng.randint(10_000, 20_000_000), mime, ts(now - rng.random() * year),
+                )
+
+    n = copy_rows(cur, "files", (
+        "id", "file_unique_id", "file_id", "owner_telegram_id", "folder_id",
+        "file_name", "name_fold", "file_type", "file_size", "mime_type", "created_at",
+    ), file_rows())
+
+    # link chia sẻ cho ~20% thư mục, whitelist ~30% user
+    shared = [f for f in folders if rng.random() < 0.2]
+    copy_rows(cur, "share_tokens", ("owner_telegram_id", "folder_id", "token"), (
+        (uid, fid, f"tok{fid}") for fid, uid in shared
+    ))
+    copy_rows(cur, "allowed_users", ("telegram_id", "added_by"), (
+        (uid, 1) for uid in user_ids if rng.random() < 0.3
+    ))
+    copy_rows(cur, "ads", ("id", "code", "chat_id", "message_id", "content"), (
+        (i, f"qc{i}", 1, i, f"Quảng cáo {i}") for i in range(1, 6)
+    ))
+
+    for table in ("users", "folders", "files", "share_tokens", "allowed_users", "ads", "user_current_folder"):
+        cur.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 1))"
+        )
+    return len(folders), n, len(shared)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--files", type=int, default=10_000_000)
+    parser.add_argument("--skew", type=float, default=1.1, help="số mũ Zipf, càng lớn càng lệch")
+    parser.add_argument("--max-folders", type=int, default=200, help="số thư mục tối đa mỗi user")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if not main.DATABASE_URL:
+        raise SystemExit("❌ Cần DATABASE_URL trỏ tới PostgreSQL thử nghiệm.")
+
+    store = main.init_db()
+    started = time.perf_counter()
+    with store._cursor(statement_timeout=0) as cur:
+        cur.execute("TRUNCATE " + ", ".join(TABLES))
+        n_folders, n_files, n_shared = generate(cur, args)
+    with store._cursor(statement_timeout=0) as cur:
+        cur.execute("ANALYZE")
+
+    print(
+        f"Đã nạp {args.users} user, {n_folders} thư mục, {n_files} file, "
+        f"{n_shared} link chia sẻ trong {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main_cli()
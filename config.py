@@ -0,0 +1,152 @@
+"""
+Cấu hình của bot: biến môi trường và hằng số dùng chung cho main.py và các module khác.
+"""
+
+import logging
+import os
+
+BOT_TOKEN = os.getenv("BOT_TOKEN") or os.getenv("Token")
+# Chạy nhiều bot (nhiều thương hiệu) trong 1 tiến trình: BOT_TOKENS="token1,token2,..."
+BOT_TOKENS = [t.strip() for t in os.getenv("BOT_TOKENS", "").split(",") if t.strip()]
+
+# Railway: DATABASE_URL = ${Postgres.DATABASE_URL}
+DATABASE_URL = os.getenv("DATABASE_URL")
+# (tuỳ chọn) replica chỉ-đọc: truy vấn liệt kê / tra cứu sẽ đọc từ đây
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# user vừa ghi (lưu file, đổi thư mục...) thì đọc từ primary trong N giây
+REPLICA_RYW_SECONDS = float(os.getenv("REPLICA_RYW_SECONDS", "10"))
+# Không có DATABASE_URL → dùng SQLite nhúng (file này)
+DB_PATH = os.getenv("DB_PATH", "bot_data.db")
+# số kết nối Postgres tối đa, dùng chung cho mọi bot trong tiến trình
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+# DB chậm / mất kết nối: giới hạn thời gian chờ thay vì treo cả bot
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))  # giây
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # chờ kết nối rảnh trong pool (giây)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))  # mỗi câu lệnh, 0 = không giới hạn
+DB_MAINTENANCE_TIMEOUT_MS = int(os.getenv("DB_MAINTENANCE_TIMEOUT_MS", "300000"))  # job dọn dẹp / ANALYZE
+# lỗi DB liên tiếp N lần → ngắt (trả lỗi ngay) trong M giây rồi mới thử lại
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS", "30"))
+# Nhiều tiến trình dùng chung 1 Postgres: báo nhau bỏ cache trong RAM qua NOTIFY / LISTEN
+CACHE_NOTIFY = os.getenv("CACHE_NOTIFY", "1").lower() in ("1", "true", "yes")
+CACHE_CHANNEL = "bot_cache"
+CACHE_NOTIFY_IDS = 500  # số id tối đa mỗi NOTIFY (payload Postgres giới hạn 8000 byte)
+CACHE_LISTEN_RECONNECT_SECONDS = 5
+
+OWNER_ID = int(os.getenv("OWNER_ID", "0"))
+
+APP_VERSION = "v7-mediagroup-folder-pass-whitelist-pg"
+MEDIA_GROUP_SIZE = 3  # muốn 10 file 1 lần thì đổi thành 10
+
+# Giới hạn gửi tin của Telegram: ~30 tin/giây toàn bot, ~1 tin/giây mỗi chat,
+# ~20 tin/phút mỗi group/kênh.
+GLOBAL_MSG_PER_SEC = float(os.getenv("GLOBAL_MSG_PER_SEC", "25"))
+PRIVATE_CHAT_INTERVAL = float(os.getenv("PRIVATE_CHAT_INTERVAL", "1.0"))
+GROUP_CHAT_INTERVAL = float(os.getenv("GROUP_CHAT_INTERVAL", "3.0"))
+RETRY_AFTER_MAX_RETRIES = int(os.getenv("RETRY_AFTER_MAX_RETRIES", "3"))
+
+# Độ ưu tiên khi gửi (số nhỏ = ưu tiên cao).
+# Trả lời người dùng dùng mặc định; gửi hàng loạt truyền rate_limit_args=PRIORITY_BULK.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+FOLDERS_PAGE_SIZE = 10  # số thư mục mỗi trang /folders
+TREE_MAX_LINES = 100  # số dòng tối đa của /tree
+
+# Whitelist: /allow, /revoke nhận nhiều id 1 lần (tham số lệnh hoặc file CSV), ghi bằng 1 câu SQL nhiều dòng
+WHITELIST_PAGE_SIZE = 20  # số user mỗi trang /whitelist
+WHITELIST_BULK_MAX = int(os.getenv("WHITELIST_BULK_MAX", "5000"))  # số id tối đa mỗi lần
+WHITELIST_CSV_MAX_BYTES = 1024 * 1024
+WHITELIST_SQL_CHUNK = 400  # số id mỗi câu INSERT / DELETE (SQLite < 3.32 chỉ nhận tối đa 999 tham số)
+
+# Inline mode (@bot từ_khoá): số kết quả mỗi trang, số dòng lấy từ DB mỗi lần,
+# thời gian giữ kết quả trong cache (giây).
+INLINE_PAGE_SIZE = 20
+INLINE_FETCH_LIMIT = 200
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "30"))
+
+# Link chia sẻ: album dựng sẵn giữ trong RAM theo phiên bản thư mục,
+# TTL chỉ là lưới an toàn khi nhiều tiến trình cùng ghi một database.
+SHARE_PLAN_TTL = float(os.getenv("SHARE_PLAN_TTL", "300"))
+SHARE_PLAN_CACHE_SIZE = int(os.getenv("SHARE_PLAN_CACHE_SIZE", "2000"))
+
+# Kênh lưu trữ riêng (bot là admin): file tải lên được copy vào đây, link chia sẻ gửi bằng
+# copy_messages – tối đa COPY_MESSAGES_LIMIT tin mỗi lần gọi thay vì từng album nhỏ.
+STORAGE_CHANNEL_ID = int(os.getenv("STORAGE_CHANNEL_ID", "0"))
+COPY_MESSAGES_LIMIT = 100
+
+# Ảnh xem trước khi mở link chia sẻ: ghép thumbnail các ảnh/video đầu tiên thành 1 ảnh + nút nhận từng trang
+# (cần cài Pillow). Chỉ dùng khi thư mục có từ PREVIEW_MIN_FILES ảnh/video.
+SHARE_PREVIEW = os.getenv("SHARE_PREVIEW", "").lower() in ("1", "true", "yes")
+PREVIEW_TILES = int(os.getenv("PREVIEW_TILES", "30"))
+PREVIEW_MIN_FILES = int(os.getenv("PREVIEW_MIN_FILES", "6"))
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", "2"))
+PREVIEW_COLUMNS = 6
+PREVIEW_TILE_SIZE = 160
+PREVIEW_PAGE_SIZE = 10  # số file mỗi nút = 1 album tối đa
+
+# Thống kê link chia sẻ: cộng dồn trong RAM, ghi xuống DB mỗi N giây
+SHARE_STATS_FLUSH_SECONDS = float(os.getenv("SHARE_STATS_FLUSH_SECONDS", "60"))
+
+# Thùng rác: file / thư mục xoá mềm được giữ N ngày rồi mới xoá hẳn (theo lô)
+TRASH_RETENTION_DAYS = float(os.getenv("TRASH_RETENTION_DAYS", "7"))
+PURGE_INTERVAL_SECONDS = float(os.getenv("PURGE_INTERVAL_SECONDS", "3600"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+TRASH_PAGE_SIZE = 20
+
+# Sao lưu file ra ngoài Telegram: MIRROR_DIR (thư mục local) hoặc MIRROR_S3_* (S3 / MinIO…)
+MIRROR_DIR = os.getenv("MIRROR_DIR")
+MIRROR_S3_ENDPOINT = os.getenv("MIRROR_S3_ENDPOINT")  # vd: http://127.0.0.1:9000
+MIRROR_S3_BUCKET = os.getenv("MIRROR_S3_BUCKET")
+MIRROR_S3_ACCESS_KEY = os.getenv("MIRROR_S3_ACCESS_KEY", "")
+MIRROR_S3_SECRET_KEY = os.getenv("MIRROR_S3_SECRET_KEY", "")
+MIRROR_S3_REGION = os.getenv("MIRROR_S3_REGION", "us-east-1")
+MIRROR_CONCURRENCY = int(os.getenv("MIRROR_CONCURRENCY", "3"))
+MIRROR_BATCH_SIZE = int(os.getenv("MIRROR_BATCH_SIZE", "20"))
+MIRROR_INTERVAL_SECONDS = float(os.getenv("MIRROR_INTERVAL_SECONDS", "300"))
+MIRROR_MAX_ATTEMPTS = int(os.getenv("MIRROR_MAX_ATTEMPTS", "5"))
+MIRROR_CHUNK_SIZE = 64 * 1024
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # Bot API không cho get_file file lớn hơn
+
+# /export: nén thư mục thành các file zip, mỗi phần tối đa EXPORT_PART_SIZE byte (bot gửi file tối đa 50MB).
+# File được tải theo chunk thẳng vào zip; phần zip nhỏ nằm trong RAM, lớn hơn EXPORT_SPOOL_SIZE thì ra file tạm.
+EXPORT_PART_SIZE = int(os.getenv("EXPORT_PART_SIZE", str(45 * 1024 * 1024)))
+EXPORT_SPOOL_SIZE = 1024 * 1024
+EXPORT_BATCH_SIZE = 200
+EXPORT_PROGRESS_SECONDS = 5
+EXPORT_UPLOAD_TIMEOUT = 300
+
+# Event loop bị chặn lâu hơn N giây thì log kèm stack đoạn code đang chặn (0 = tắt)
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))
+PROFILE_MAX_SECONDS = 120
+
+# Bảo trì định kỳ (JobQueue), mỗi việc 1 chu kỳ riêng (giây)
+TOKEN_CLEANUP_INTERVAL_SECONDS = float(os.getenv("TOKEN_CLEANUP_INTERVAL_SECONDS", "3600"))
+TOKEN_CLEANUP_BATCH_SIZE = int(os.getenv("TOKEN_CLEANUP_BATCH_SIZE", "500"))
+ANALYZE_INTERVAL_SECONDS = float(os.getenv("ANALYZE_INTERVAL_SECONDS", "1800"))
+ANALYZE_MIN_CHANGES = int(os.getenv("ANALYZE_MIN_CHANGES", "10000"))  # số dòng đổi kể từ lần ANALYZE trước
+STATE_EVICT_INTERVAL_SECONDS = float(os.getenv("STATE_EVICT_INTERVAL_SECONDS", "600"))
+STATE_IDLE_SECONDS = float(os.getenv("STATE_IDLE_SECONDS", "3600"))  # trạng thái hội thoại bỏ dở quá lâu
+CACHE_REFRESH_SECONDS = float(os.getenv("CACHE_REFRESH_SECONDS", "300"))  # whitelist + QC mới nhất
+
+# Hàng đợi job bền (bảng jobs): việc nặng (phát QC, gửi link chia sẻ lớn) chạy nền, không mất khi restart.
+# Mỗi bot chạy JOB_WORKERS worker; nhiều tiến trình cùng 1 Postgres thì chia nhau job (SKIP LOCKED).
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "10"))  # lần thử thứ n chờ base * 2^(n-1)
+# job "running" không báo tiến độ quá N giây (worker chết / tiến trình bị kill) → đưa lại vào hàng đợi
+JOB_LOCK_TIMEOUT_SECONDS = float(os.getenv("JOB_LOCK_TIMEOUT_SECONDS", "300"))
+JOB_KEEP_DAYS = float(os.getenv("JOB_KEEP_DAYS", "7"))  # job xong / lỗi hẳn giữ lại để xem /jobs
+JOB_INLINE_STEPS = int(os.getenv("JOB_INLINE_STEPS", "3"))  # link chia sẻ gửi quá N lượt thì chuyển sang job
+JOB_BATCH_SIZE = 100  # số user đọc từ DB mỗi lô khi phát QC
+# phát QC lưu checkpoint sau mỗi N user hoặc mỗi N giây (cái nào tới trước): chạy lại gửi trùng tối đa N user
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "25"))
+BROADCAST_CHECKPOINT_SECONDS = float(os.getenv("BROADCAST_CHECKPOINT_SECONDS", "5"))
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+# httpx ghi mỗi request ở mức INFO kèm nguyên URL – URL của Bot API (cả link tải file) chứa token bot
+logging.getLogger("httpx").setLevel(logging.WARNING)
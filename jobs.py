@@ -0,0 +1,102 @@
+"""
+Hàng đợi job bền (bảng jobs): việc nặng chạy nền, không mất khi restart.
+Các loại job đăng ký bằng @job_handler (xem main.py).
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from config import (
+    JOB_POLL_SECONDS,
+    JOB_RETRY_BASE_SECONDS,
+    JOB_WORKERS,
+)
+from mirror import safe_error
+from storage import CURRENT_STORE, DB_DOWN_ERRORS, Storage, utc_timestamp
+
+logger = logging.getLogger(__name__)
+
+# kind -> async handler(bot, store, job); job là 1 dòng bảng jobs, payload đã giải mã JSON.
+# Handler phải chạy lại được từ giữa chừng (retry / restart): đọc job["progress"] / job["checkpoint"].
+JOB_HANDLERS = {}
+# tenant -> asyncio.Event đánh thức worker khi vừa thêm job trong tiến trình này
+JOB_WAKEUP = {}
+
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+async def run_job(bot, store: Storage, job):
+    handler = JOB_HANDLERS.get(job["kind"])
+    try:
+        if handler is None:
+            raise ValueError(f"không có handler cho job {job['kind']}")
+        await handler(bot, store, job)
+    except asyncio.CancelledError:
+        try:
+            store.release_job(job["id"])
+        except Exception as e:
+            logger.warning("Không trả được job #%s về hàng đợi: %s", job["id"], e)
+        raise
+    except Exception as e:
+        error = safe_error(e)[:500]
+        if job["attempts"] >= job["max_attempts"]:
+            logger.exception("Job #%s (%s) lỗi hẳn sau %s lần thử.", job["id"], job["kind"], job["attempts"])
+            store.finish_job(job["id"], "failed", error)
+        else:
+            delay = JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+            logger.warning("Job #%s (%s) lỗi, thử lại sau %.0fs: %s", job["id"], job["kind"], delay, error)
+            store.finish_job(job["id"], "queued", error, utc_timestamp(time.time() + delay))
+        return
+    store.finish_job(job["id"], "done")
+
+
+async def job_worker(app, name: str):
+    """
+    Vòng lặp 1 worker: lấy job đến hạn, chạy, rồi lấy tiếp; hết job thì chờ JOB_POLL_SECONDS
+    (hoặc tới khi enqueue_job đánh thức).
+    """
+    store = app.bot_data["store"]
+    CURRENT_STORE.set(store)
+    wakeup = JOB_WAKEUP.setdefault(store.tenant, asyncio.Event())
+    while True:
+        job = None
+        try:
+            job = store.claim_job(name)
+            if job:
+                await run_job(app.bot, store, job)
+        except DB_DOWN_ERRORS as e:
+            logger.warning("Worker %s: DB lỗi (%s), thử lại sau.", name, e)
+        except Exception as e:
+            logger.exception("Worker %s lỗi: %s", name, e)
+        if job:
+            continue
+        try:
+            await asyncio.wait_for(wakeup.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+
+def start_job_workers(app):
+    tenant = app.bot_data["store"].tenant
+    app.bot_data["job_workers"] = [
+        asyncio.create_task(job_worker(app, f"{tenant}:{os.getpid()}:{i}"))
+        for i in range(JOB_WORKERS)
+    ]
+
+
+async def stop_job_workers(app):
+    """
+    Dừng worker; job đang chạy dở được trả về hàng đợi và chạy tiếp từ checkpoint ở lần sau.
+    """
+    tasks = app.bot_data.pop("job_workers", [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
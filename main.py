@@ -1,9 +1,24 @@
+import asyncio
+import csv
+import heapq
+import io
+import itertools
+import json
 import logging
 import os
-import secrets
-
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
 import psycopg2
-import psycopg2.extras
+from psycopg2 import sql
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -11,252 +26,604 @@ from telegram import (
     InputMediaVideo,
     InputMediaPhoto,
     InputMediaDocument,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultCachedAudio,
+    InlineQueryResultCachedDocument,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+    InlineQueryResultsButton,
 )
+from telegram.error import BadRequest, RetryAfter
+
+try:
+    from PIL import Image, ImageDraw, ImageOps
+except ImportError:  # Pillow là tuỳ chọn, chỉ cần cho ảnh xem trước link chia sẻ
+    Image = None
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
-# ========================= CONFIG =========================
-
-BOT_TOKEN = os.getenv("BOT_TOKEN") or os.getenv("Token")
-
-# Railway: DATABASE_URL = ${Postgres.DATABASE_URL}
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-OWNER_ID = int(os.getenv("OWNER_ID", "0"))
+from config import (
+    ANALYZE_INTERVAL_SECONDS,
+    ANALYZE_MIN_CHANGES,
+    APP_VERSION,
+    BOT_TOKEN,
+    BOT_TOKENS,
+    BROADCAST_CHECKPOINT_EVERY,
+    BROADCAST_CHECKPOINT_SECONDS,
+    CACHE_CHANNEL,
+    CACHE_LISTEN_RECONNECT_SECONDS,
+    CACHE_NOTIFY,
+    CACHE_REFRESH_SECONDS,
+    COPY_MESSAGES_LIMIT,
+    DATABASE_URL,
+    DB_CONNECT_TIMEOUT,
+    EXPORT_BATCH_SIZE,
+    EXPORT_PART_SIZE,
+    EXPORT_PROGRESS_SECONDS,
+    EXPORT_SPOOL_SIZE,
+    EXPORT_UPLOAD_TIMEOUT,
+    FOLDERS_PAGE_SIZE,
+    GLOBAL_MSG_PER_SEC,
+    GROUP_CHAT_INTERVAL,
+    INLINE_CACHE_TTL,
+    INLINE_FETCH_LIMIT,
+    INLINE_PAGE_SIZE,
+    JOB_BATCH_SIZE,
+    JOB_INLINE_STEPS,
+    JOB_KEEP_DAYS,
+    JOB_LOCK_TIMEOUT_SECONDS,
+    JOB_WORKERS,
+    LOOP_STALL_THRESHOLD,
+    MEDIA_GROUP_SIZE,
+    MIRROR_INTERVAL_SECONDS,
+    OWNER_ID,
+    PREVIEW_COLUMNS,
+    PREVIEW_MIN_FILES,
+    PREVIEW_PAGE_SIZE,
+    PREVIEW_TILES,
+    PREVIEW_TILE_SIZE,
+    PREVIEW_WORKERS,
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    PRIVATE_CHAT_INTERVAL,
+    PROFILE_MAX_SECONDS,
+    PURGE_BATCH_SIZE,
+    PURGE_INTERVAL_SECONDS,
+    RETRY_AFTER_MAX_RETRIES,
+    SHARE_PLAN_CACHE_SIZE,
+    SHARE_PLAN_TTL,
+    SHARE_PREVIEW,
+    SHARE_STATS_FLUSH_SECONDS,
+    STATE_EVICT_INTERVAL_SECONDS,
+    STATE_IDLE_SECONDS,
+    STORAGE_CHANNEL_ID,
+    TELEGRAM_DOWNLOAD_LIMIT,
+    TOKEN_CLEANUP_BATCH_SIZE,
+    TOKEN_CLEANUP_INTERVAL_SECONDS,
+    TRASH_PAGE_SIZE,
+    TRASH_RETENTION_DAYS,
+    TREE_MAX_LINES,
+    WHITELIST_BULK_MAX,
+    WHITELIST_CSV_MAX_BYTES,
+    WHITELIST_PAGE_SIZE,
+)
+from jobs import JOB_WAKEUP, job_handler, start_job_workers, stop_job_workers
+from mirror import mirror_pending, open_mirror, safe_error, stream_telegram_file
+from storage import (
+    CURRENT_STORE,
+    DB_BREAKER,
+    DB_DOWN_ERRORS,
+    FileRef,
+    PROCESS_ID,
+    STORES,
+    Storage,
+    close_shared_pg_pools,
+    db,
+    fold_name,
+    init_db,
+    normalize_folder_path,
+    utc_timestamp,
+)
 
-APP_VERSION = "v7-mediagroup-folder-pass-whitelist-pg"
-MEDIA_GROUP_SIZE = 3  # muốn 10 file 1 lần thì đổi thành 10
+# ========================= CONFIG =========================
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+# hằng số cấu hình / biến môi trường: xem config.py
 logger = logging.getLogger(__name__)
 
+# Trạng thái hội thoại, key = state_key(user_id) = (tenant, user_id)
 UPLOAD_MODE_USERS = set()
 FOLDER_NAME_WAIT_USERS = set()
-# user_id -> (owner_id, folder_id) đang chờ nhập mật khẩu khi mở link share_
+# state_key(user_id) -> (owner_id, folder_id, token) đang chờ nhập mật khẩu khi mở link share_
 PASS_WAIT_USERS = {}
+# state_key(user_id) -> set(file_id) đang được chọn trong /rm
+RM_SELECTED = {}
+# state_key -> các token link có mật khẩu user đã mở khoá (để bấm nút trang của ảnh xem trước)
+SHARE_UNLOCKED = {}
+# state_key -> lần cuối user gửi update (monotonic), để dọn các trạng thái bỏ dở
+STATE_TOUCHED = {}
 
 
 # ========================= KEYBOARD =========================
 
-def get_main_keyboard():
-    keyboard = [
+# Dựng 1 lần dùng chung cho mọi tin trả lời (object của PTB là bất biến, không ai sửa được)
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
         [KeyboardButton("📁 Tạo thư mục mới"), KeyboardButton("/upload")],
         [KeyboardButton("/getlink"), KeyboardButton("/myfiles")],
         [KeyboardButton("/folders")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    ],
+    resize_keyboard=True,
+)
 
 
-# ========================= DATABASE (POSTGRES) =========================
+def get_main_keyboard():
+    return MAIN_KEYBOARD
 
-def get_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("❌ Chưa thiết lập DATABASE_URL")
-    conn = psycopg2.connect(
-        DATABASE_URL,
-        cursor_factory=psycopg2.extras.RealDictCursor,
-    )
-    return conn
-
-
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-
-    # USERS
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id              SERIAL PRIMARY KEY,
-            telegram_id     BIGINT UNIQUE,
-            full_name       TEXT,
-            username        TEXT,
-            created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # FOLDERS
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS folders (
-            id               SERIAL PRIMARY KEY,
-            owner_telegram_id BIGINT,
-            name             TEXT,
-            created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # thêm cột password nếu chưa có
-    cur.execute("""
-        ALTER TABLE folders
-        ADD COLUMN IF NOT EXISTS password TEXT;
-    """)
-
-    # CURRENT FOLDER
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_current_folder (
-            id               SERIAL PRIMARY KEY,
-            owner_telegram_id BIGINT UNIQUE,
-            folder_id        INTEGER,
-            updated_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # FILES
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS files (
-            id               SERIAL PRIMARY KEY,
-            file_unique_id   TEXT UNIQUE,
-            file_id          TEXT,
-            owner_telegram_id BIGINT,
-            folder_id        INTEGER,
-            file_name        TEXT,
-            file_type        TEXT,
-            file_size        BIGINT,
-            mime_type        TEXT,
-            created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # SHARE TOKENS
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS share_tokens (
-            id               SERIAL PRIMARY KEY,
-            owner_telegram_id BIGINT,
-            folder_id        INTEGER,
-            token            TEXT UNIQUE,
-            created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # WHITELIST
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS allowed_users (
-            id          SERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE,
-            added_by    BIGINT,
-            created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    # ADS (quảng cáo ghim)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS ads (
-            id          SERIAL PRIMARY KEY,
-            code        TEXT UNIQUE,        -- ví dụ: qc1, qc2
-            chat_id     BIGINT,
-            message_id  BIGINT,
-            content     TEXT,
-            created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-
-    conn.commit()
-    conn.close()
-    logger.info("Database OK (PostgreSQL, password + whitelist + ads).")
 
+# ========================= OUTBOUND (HÀNG ĐỢI GỬI TIN) =========================
 
-def get_or_create_user(tg_user):
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("SELECT * FROM users WHERE telegram_id = %s", (tg_user.id,))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row
-
-    cur.execute(
-        "INSERT INTO users (telegram_id, full_name, username) VALUES (%s, %s, %s)",
-        (tg_user.id, tg_user.full_name, tg_user.username),
-    )
-    conn.commit()
+class OutboundLimiter(BaseRateLimiter[int]):
+    """
+    Hàng đợi gửi tin dùng chung cho mọi request có chat_id:
+    - tôn trọng giới hạn mỗi chat và giới hạn toàn bot,
+    - trả lời tương tác (PRIORITY_INTERACTIVE) được gửi trước hàng loạt (PRIORITY_BULK),
+    - gặp RetryAfter thì tự chờ rồi gửi lại.
+    """
+
+    def __init__(self, overall_per_second=GLOBAL_MSG_PER_SEC,
+                 private_interval=PRIVATE_CHAT_INTERVAL,
+                 group_interval=GROUP_CHAT_INTERVAL,
+                 max_retries=RETRY_AFTER_MAX_RETRIES):
+        self._global_interval = 1.0 / overall_per_second
+        self._private_interval = private_interval
+        self._group_interval = group_interval
+        self._max_retries = max_retries
+
+        # (priority, seq, chat_id, future, enqueued_at)
+        self._heap = []
+        self._seq = itertools.count()
+        self._chat_next = {}  # chat_id -> thời điểm (monotonic) được gửi tiếp
+        self._chat_last_wait = {}  # chat_id -> số giây đã chờ ở lần gửi gần nhất
+        self._global_next = 0.0
+        self._retry_after_count = 0
+        self._wakeup = None
+        self._task = None
+
+    async def initialize(self) -> None:
+        # Application và Updater đều gọi bot.initialize() → có thể bị gọi 2 lần
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for item in self._heap:
+            if not item[3].done():
+                item[3].cancel()
+        self._heap.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._retry_after_count += 1
+                if attempt >= self._max_retries:
+                    raise
+                attempt += 1
+                delay = float(e.retry_after) + 0.1
+                logger.warning(
+                    "RetryAfter %ss (endpoint=%s, chat=%s), chờ rồi gửi lại lần %s",
+                    e.retry_after, endpoint, chat_id, attempt,
+                )
+                if chat_id is None:
+                    await asyncio.sleep(delay)
+                else:
+                    # chặn chat này cho tới khi hết thời gian chờ
+                    until = time.monotonic() + delay
+                    self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0.0), until)
+
+    def _chat_interval(self, chat_id):
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self._private_interval
+        return self._group_interval
+
+    async def _acquire(self, chat_id, priority):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._heap,
+            (priority, next(self._seq), chat_id, fut, time.monotonic()),
+        )
+        self._wakeup.set()
+        await fut
 
-    cur.execute("SELECT * FROM users WHERE telegram_id = %s", (tg_user.id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    def _pop_ready(self, now):
+        """
+        Lấy request ưu tiên cao nhất mà chat của nó đã được phép gửi.
+        Trả về (item, thời điểm sớm nhất có chat sẵn sàng).
+        """
+        deferred = []
+        found = None
+        earliest = None
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            if item[3].done():
+                continue
+            ready_at = self._chat_next.get(item[2], 0.0)
+            if ready_at <= now:
+                found = item
+                break
+            deferred.append(item)
+            if earliest is None or ready_at < earliest:
+                earliest = ready_at
+        for item in deferred:
+            heapq.heappush(self._heap, item)
+        return found, earliest
+
+    def _grant(self, item, now):
+        _, _, chat_id, fut, enqueued_at = item
+        self._chat_next[chat_id] = now + self._chat_interval(chat_id)
+        self._chat_last_wait[chat_id] = now - enqueued_at
+        self._global_next = now + self._global_interval
+        fut.set_result(None)
+
+        # dọn các chat đã hết hạn chờ để dict không phình mãi
+        if len(self._chat_next) > 10000:
+            for cid in [c for c, t in self._chat_next.items() if t <= now]:
+                self._chat_next.pop(cid, None)
+                self._chat_last_wait.pop(cid, None)
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            timeout = None
+            if self._heap:
+                if now < self._global_next:
+                    timeout = self._global_next - now
+                else:
+                    item, earliest = self._pop_ready(now)
+                    if item:
+                        self._grant(item, now)
+                        continue
+                    if earliest is not None:
+                        timeout = earliest - now
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
+    def chat_wait(self, chat_id) -> float:
+        """
+        Ước lượng số giây một tin mới tới chat_id phải chờ trong hàng đợi.
+        """
+        now = time.monotonic()
+        pending = sum(1 for item in self._heap if item[2] == chat_id and not item[3].done())
+        base = max(0.0, self._chat_next.get(chat_id, 0.0) - now)
+        return base + pending * self._chat_interval(chat_id)
 
-def get_all_user_ids():
+    def stats(self) -> dict:
+        """
+        Số liệu hàng đợi: độ sâu theo độ ưu tiên, các chat đang phải chờ lâu nhất.
+        """
+        now = time.monotonic()
+        depth = {}
+        waiting_chats = set()
+        for priority, _, chat_id, fut, _ in self._heap:
+            if fut.done():
+                continue
+            depth[priority] = depth.get(priority, 0) + 1
+            waiting_chats.add(chat_id)
+
+        chat_waits = sorted(
+            ((cid, self.chat_wait(cid)) for cid in waiting_chats),
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        recent_waits = sorted(
+            (
+                (cid, w) for cid, w in self._chat_last_wait.items()
+                if self._chat_next.get(cid, 0.0) > now - 60
+            ),
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        return {
+            "queue_depth": sum(depth.values()),
+            "depth_by_priority": depth,
+            "chat_waits": chat_waits[:5],
+            "recent_waits": recent_waits[:5],
+            "retry_after_count": self._retry_after_count,
+        }
+
+
+# ========================= CACHE =========================
+
+_MISSING = object()
+
+
+class TTLCache:
     """
-    Lấy toàn bộ telegram_id của user đã từng start bot.
+    Cache nhỏ trong RAM: mỗi phần tử hết hạn sau ttl giây,
+    vượt maxsize thì bỏ phần tử ít dùng nhất.
+    Phần tử hết hạn còn nằm lại tới lần expire() (đọc được bằng allow_stale khi DB lỗi).
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id FROM users;")
-    rows = cur.fetchall()
-    conn.close()
-    return [r["telegram_id"] for r in rows]
 
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None, allow_stale=False):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic() and not allow_stale:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def expire(self):
+        """
+        Bỏ hẳn các phần tử đã hết hạn (bình thường chỉ bị bỏ khi có người đọc tới).
+        """
+        now = time.monotonic()
+        dead = [k for k, (expires_at, _) in self._data.items() if expires_at < now]
+        for k in dead:
+            del self._data[k]
+        return len(dead)
 
-def create_or_get_folder(owner_id, name):
-    conn = get_conn()
-    cur = conn.cursor()
+    def __len__(self):
+        return len(self._data)
+
+
+# (tenant, user_id, từ khoá, vị trí khối) -> danh sách FileRef tìm được
+INLINE_CACHE = TTLCache(ttl=INLINE_CACHE_TTL, maxsize=5000)
+
+# tenant -> set telegram_id trong whitelist (nạp cả bảng); tenant -> quảng cáo mới nhất.
+# Job làm mới mỗi CACHE_REFRESH_SECONDS, TTL gấp đôi để không bao giờ nguội giữa 2 lần.
+WHITELIST_CACHE = TTLCache(ttl=2 * CACHE_REFRESH_SECONDS, maxsize=1000)
+LATEST_AD_CACHE = TTLCache(ttl=2 * CACHE_REFRESH_SECONDS, maxsize=1000)
+
+
+def read_through(cache: TTLCache, key, loader):
+    """
+    Lấy từ cache, hết hạn thì gọi loader() (loader tự ghi lại cache).
+    DB lỗi → dùng tạm bản đã hết hạn nếu còn.
+    """
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    try:
+        return loader()
+    except DB_DOWN_ERRORS:
+        value = cache.get(key, _MISSING, allow_stale=True)
+        if value is _MISSING:
+            raise
+        return value
+
+
+# Phiên bản nội dung, chỉ tăng: (tenant, folder_id) cho từng thư mục,
+# (tenant, "owner", owner_id) cho các thay đổi cấu trúc (xoá, khôi phục, đổi chỗ thư mục).
+CONTENT_VERSIONS = {}
+
+
+def touch_folders(folder_ids):
+    """
+    Tăng phiên bản các thư mục (truyền cả thư mục cha: link chia sẻ gồm cả thư mục con).
+    """
+    invalidate("folders", folder_ids)
+
+
+def touch_owner(owner_id):
+    invalidate("owner", [owner_id])
 
-    cur.execute(
-        "SELECT * FROM folders WHERE owner_telegram_id = %s AND name = %s",
-        (owner_id, name),
-    )
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row
-
-    cur.execute(
-        "INSERT INTO folders (owner_telegram_id, name) VALUES (%s, %s)",
-        (owner_id, name),
-    )
-    conn.commit()
 
-    cur.execute(
-        "SELECT * FROM folders WHERE owner_telegram_id = %s AND name = %s",
-        (owner_id, name),
+def content_version(owner_id, folder_id):
+    tenant = db().tenant
+    return (
+        CONTENT_VERSIONS.get((tenant, "owner", owner_id), 0),
+        CONTENT_VERSIONS.get((tenant, folder_id), 0),
     )
-    row = cur.fetchone()
-    conn.close()
-    return row
 
 
-def set_current_folder(owner_id, folder_id):
-    conn = get_conn()
-    cur = conn.cursor()
+# Sự kiện vô hiệu cache: {"t": tenant, "k": loại, "ids": [...]}, áp ở tiến trình ghi rồi NOTIFY
+# cho tiến trình khác (CacheListener). Phiên bản thư mục là số đếm riêng từng tiến trình:
+# bên nhận chỉ cần tăng bản của mình để bỏ album / ảnh xem trước đã dựng.
+
+
+def apply_invalidation(event):
+    tenant, kind, ids = event["t"], event["k"], event.get("ids") or ()
+    if kind in ("folders", "owner"):
+        for i in ids:
+            key = (tenant, i) if kind == "folders" else (tenant, "owner", i)
+            CONTENT_VERSIONS[key] = CONTENT_VERSIONS.get(key, 0) + 1
+    elif kind in ("allow", "revoke"):
+        allowed = WHITELIST_CACHE.get(tenant, allow_stale=True)
+        if allowed is not None:
+            if kind == "allow":
+                allowed.update(ids)
+            else:
+                allowed.difference_update(ids)
+    elif kind == "ad":
+        LATEST_AD_CACHE.pop(tenant)
+    elif kind == "jobs":
+        wakeup = JOB_WAKEUP.get(tenant)
+        if wakeup:
+            wakeup.set()
+
+
+def invalidate(kind, ids=()):
+    store = db()
+    event = {"t": store.tenant, "k": kind, "ids": list(ids)}
+    apply_invalidation(event)
+    store.publish_invalidation(event)
+
+
+class CacheListener:
+    """
+    1 kết nối LISTEN riêng mỗi tiến trình (ngoài pool), đọc bằng loop.add_reader:
+    không tốn thread, không chặn event loop. Nhận sự kiện của tiến trình khác thì bỏ cache tương ứng.
+    """
+
+    def __init__(self, dsn, channel=CACHE_CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self.conn = None
+        self._fd = None
+        self._connected_once = False
+        self.received = 0
+        self.last_delay = None  # giây từ lúc NOTIFY tới lúc áp xong ở đây
+        self.reconnects = 0
+
+    def _open(self):
+        conn = psycopg2.connect(
+            self.dsn, connect_timeout=DB_CONNECT_TIMEOUT,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+        )
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+        return conn
+
+    def _close(self):
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._fd = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _on_readable(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error as e:
+            logger.warning("Mất kết nối LISTEN %s: %s", self.channel, e)
+            self._close()
+            return
+        while self.conn.notifies:
+            self._handle(self.conn.notifies.pop(0).payload)
+
+    def _handle(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if event.get("o") == PROCESS_ID:
+            return
+        apply_invalidation(event)
+        self.received += 1
+        self.last_delay = max(0.0, time.time() - event.get("ts", time.time()))
 
-    cur.execute(
+    def resync(self):
         """
-        INSERT INTO user_current_folder (owner_telegram_id, folder_id, updated_at)
-        VALUES (%s, %s, CURRENT_TIMESTAMP)
-        ON CONFLICT (owner_telegram_id) DO UPDATE SET
-            folder_id = EXCLUDED.folder_id,
-            updated_at = EXCLUDED.updated_at;
-        """,
-        (owner_id, folder_id),
-    )
-    conn.commit()
-    conn.close()
+        Vừa nối lại sau khi mất LISTEN (có thể đã lỡ sự kiện): bỏ cache dữ liệu tiến trình khác ghi được.
+        """
+        SHARE_PLANS.clear()
+        PREVIEW_CACHE.clear()
+        WHITELIST_CACHE.clear()
+        LATEST_AD_CACHE.clear()
+        for wakeup in JOB_WAKEUP.values():
+            wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if self.conn is not None and self.conn.closed:
+                    self._close()
+                if self.conn is None:
+                    try:
+                        self.conn = await asyncio.to_thread(self._open)
+                        self._fd = self.conn.fileno()
+                        loop.add_reader(self._fd, self._on_readable)
+                        if self._connected_once:
+                            self.reconnects += 1
+                            self.resync()
+                            logger.info("Đã nối lại LISTEN %s, làm mới cache.", self.channel)
+                        self._connected_once = True
+                    except psycopg2.Error as e:
+                        logger.warning("Không LISTEN được %s: %s", self.channel, e)
+                await asyncio.sleep(CACHE_LISTEN_RECONNECT_SECONDS)
+        finally:
+            self._close()
+
+
+CACHE_LISTENER = None  # tạo trong run_bots khi dùng Postgres
+
+
+# ========================= DATABASE =========================
+
+# Storage / PgPool / SQLite: xem storage.py.
+def state_key(user_id: int):
+    """
+    Key cho trạng thái hội thoại / cache trong RAM, tách riêng theo từng bot.
+    """
+    return db().tenant, user_id
+
+
+# Các hàm dưới đây giữ nguyên tên cũ, chỉ chuyển tiếp sang backend đang dùng.
+
+def get_or_create_user(tg_user):
+    return db().get_or_create_user(tg_user)
+
+
+def get_all_user_ids():
+    """
+    Lấy toàn bộ telegram_id của user đã từng start bot.
+    """
+    return db().get_all_user_ids()
+
+
+def create_or_get_folder(owner_id, name):
+    return db().create_or_get_folder(owner_id, name)
+
+
+def set_current_folder(owner_id, folder_id):
+    db().set_current_folder(owner_id, folder_id)
 
 
 def get_current_folder(owner_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT f.*
-        FROM user_current_folder u
-        JOIN folders f ON f.id = u.folder_id
-        WHERE u.owner_telegram_id = %s;
-        """,
-        (owner_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return db().get_current_folder(owner_id)
 
 
 def ensure_current_folder(owner_id):
@@ -269,134 +636,147 @@ def ensure_current_folder(owner_id):
 
 
 def list_folders(owner_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM folders WHERE owner_telegram_id = %s ORDER BY created_at DESC",
-        (owner_id,),
-    )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return db().list_folders(owner_id)
+
+
+def list_folders_page(owner_id, limit, offset=0, parent_id=None):
+    return db().list_folders_page(owner_id, limit, offset=offset, parent_id=parent_id)
+
+
+def list_subtree(owner_id, folder_id=None):
+    return db().list_subtree(owner_id, folder_id=folder_id)
+
+
+def move_folder(owner_id, old_name, new_name):
+    moved = db().move_folder(owner_id, old_name, new_name)
+    if moved:
+        touch_owner(owner_id)
+    return moved
+
+
+def get_folder_by_name(owner_id, name):
+    return db().get_folder_by_name(owner_id, name)
 
 
 def get_folder_by_id(folder_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM folders WHERE id = %s", (folder_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-
-def update_folder_password(folder_id, password):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE folders SET password = %s WHERE id = %s",
-        (password, folder_id),
-    )
-    conn.commit()
-    conn.close()
+    return db().get_folder_by_id(folder_id)
+
+
+def update_folder_password(owner_id, folder_id, password):
+    db().update_folder_password(owner_id, folder_id, password)
+    touch_folders([folder_id])
 
 
 def save_file(owner_id, folder_id, file_unique_id, file_id,
-              file_name, file_type, file_size, mime_type):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO files
-        (file_unique_id, file_id, owner_telegram_id, folder_id,
-         file_name, file_type, file_size, mime_type)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (file_unique_id) DO NOTHING;
-        """,
-        (
-            file_unique_id,
-            file_id,
-            owner_id,
-            folder_id,
-            file_name,
-            file_type,
-            file_size,
-            mime_type,
-        ),
-    )
-    conn.commit()
-    conn.close()
+              file_name, file_type, file_size, mime_type, thumb_file_id=None):
+    db().save_file(owner_id, folder_id, file_unique_id, file_id,
+                   file_name, file_type, file_size, mime_type, thumb_file_id)
+    touch_folders(db().get_folder_ancestor_ids(folder_id))
 
 
-def get_share_token(owner_id, folder_id):
-    conn = get_conn()
-    cur = conn.cursor()
+def set_storage_message(owner_id, file_unique_id, chat_id, message_id):
+    folder_id = db().set_storage_message(owner_id, file_unique_id, chat_id, message_id)
+    if folder_id:
+        touch_folders(db().get_folder_ancestor_ids(folder_id))
 
-    cur.execute(
-        """
-        SELECT token FROM share_tokens
-        WHERE owner_telegram_id = %s AND folder_id = %s
-        """,
-        (owner_id, folder_id),
-    )
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row["token"]
 
-    token = secrets.token_urlsafe(8)
-    cur.execute(
-        """
-        INSERT INTO share_tokens (owner_telegram_id, folder_id, token)
-        VALUES (%s, %s, %s)
-        """,
-        (owner_id, folder_id, token),
-    )
-    conn.commit()
-    conn.close()
-    return token
+def get_share_token(owner_id, folder_id):
+    return db().get_share_token(owner_id, folder_id)
 
 
 def get_owner_and_folder_by_token(token):
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute(
-        "SELECT owner_telegram_id, folder_id FROM share_tokens WHERE token = %s",
-        (token,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None, None
-    return row["owner_telegram_id"], row["folder_id"]
+    return db().get_owner_and_folder_by_token(token)
 
 
 def get_files_of_owner(owner_id, folder_id=None, limit=30):
-    conn = get_conn()
-    cur = conn.cursor()
-    if folder_id:
-        cur.execute(
-            """
-            SELECT * FROM files
-            WHERE owner_telegram_id = %s AND folder_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s
-            """,
-            (owner_id, folder_id, limit),
-        )
-    else:
-        cur.execute(
-            """
-            SELECT * FROM files
-            WHERE owner_telegram_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s
-            """,
-            (owner_id, limit),
-        )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return db().get_files_of_owner(owner_id, folder_id=folder_id, limit=limit)
+
+
+def get_subtree_files(owner_id, folder_id, limit=30):
+    return db().get_subtree_files(owner_id, folder_id, limit=limit)
+
+
+def export_summary(owner_id, folder_id):
+    return db().export_summary(owner_id, folder_id)
+
+
+def search_files(owner_id, query, limit, offset=0):
+    return db().search_files(owner_id, query, limit, offset=offset)
+
+
+def top_share_links(owner_id, limit=10):
+    return db().top_share_links(owner_id, limit=limit)
+
+
+def soft_delete_files(owner_id, file_ids):
+    result = db().soft_delete_files(owner_id, file_ids)
+    touch_owner(owner_id)
+    return result
+
+
+def soft_delete_folder(owner_id, name):
+    result = db().soft_delete_folder(owner_id, name)
+    touch_owner(owner_id)
+    return result
+
+
+def list_trash(owner_id, limit=TRASH_PAGE_SIZE):
+    return db().list_trash(owner_id, limit)
+
+
+def restore_file(owner_id, file_id):
+    result = db().restore_file(owner_id, file_id)
+    touch_owner(owner_id)
+    return result
+
+
+def restore_folder(owner_id, folder_id):
+    result = db().restore_folder(owner_id, folder_id)
+    touch_owner(owner_id)
+    return result
+
+
+# ============ THỐNG KÊ LINK CHIA SẺ (write-behind) ============
+
+# (tenant, token) -> [số lần mở, số lần gửi file, lần truy cập cuối (epoch)]
+SHARE_STATS = {}
+
+
+def record_share_event(token: str, opened: int = 0, delivered: int = 0):
+    """
+    Chỉ cộng trong RAM, không đụng DB (hot path của link chia sẻ).
+    """
+    key = (db().tenant, token)
+    stats = SHARE_STATS.get(key)
+    if stats is None:
+        stats = SHARE_STATS[key] = [0, 0, 0.0]
+    stats[0] += opened
+    stats[1] += delivered
+    stats[2] = time.time()
+
+
+def flush_share_stats(store: Storage):
+    """
+    Ghi các bộ đếm của 1 bot xuống DB trong 1 lô; lỗi thì cộng trả lại để lần sau ghi tiếp.
+    """
+    keys = [k for k in SHARE_STATS if k[0] == store.tenant]
+    if not keys:
+        return 0
+    batch = {k: SHARE_STATS.pop(k) for k in keys}
+    rows = [
+        (k[1], v[0], v[1], utc_timestamp(v[2]))
+        for k, v in batch.items()
+    ]
+    try:
+        store.add_share_stats(rows)
+    except Exception:
+        for k, v in batch.items():
+            cur = SHARE_STATS.setdefault(k, [0, 0, 0.0])
+            cur[0] += v[0]
+            cur[1] += v[1]
+            cur[2] = max(cur[2], v[2])
+        raise
+    return len(rows)
 
 
 # ============ ADS (QUẢNG CÁO GHIM) ============
@@ -406,60 +786,32 @@ def create_ad(chat_id: int, message_id: int, content: str) -> str:
     Tạo bản ghi quảng cáo, trả về code dạng qc1, qc2...
     content: nội dung QUẢNG CÁO (không có prefix [QC qc1])
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO ads (code, chat_id, message_id, content)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id;
-        """,
-        ("", chat_id, message_id, content),
-    )
-    row = cur.fetchone()
-    ad_id = row["id"]
-    code = f"qc{ad_id}"
-    cur.execute("UPDATE ads SET code = %s WHERE id = %s", (code, ad_id))
-    conn.commit()
-    conn.close()
+    code = db().create_ad(chat_id, message_id, content)
+    invalidate("ad")
     return code
 
 
 def get_ad_by_code(code: str, chat_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM ads WHERE code = %s AND chat_id = %s",
-        (code, chat_id),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return db().get_ad_by_code(code, chat_id)
 
 
 def delete_ad(code: str, chat_id: int) -> bool:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "DELETE FROM ads WHERE code = %s AND chat_id = %s",
-        (code, chat_id),
-    )
-    deleted = cur.rowcount > 0
-    conn.commit()
-    conn.close()
+    deleted = db().delete_ad(code, chat_id)
+    invalidate("ad")
     return deleted
 
 
 def get_latest_ad():
     """
-    Lấy quảng cáo mới nhất (dùng cho user mới /start).
+    Lấy quảng cáo mới nhất (dùng cho user mới /start), qua cache.
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM ads ORDER BY id DESC LIMIT 1;")
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return read_through(LATEST_AD_CACHE, db().tenant, load_latest_ad)
+
+
+def load_latest_ad():
+    ad = db().get_latest_ad()
+    LATEST_AD_CACHE.set(db().tenant, ad)
+    return ad
 
 
 # ============ WHITELIST ============
@@ -467,30 +819,37 @@ def get_latest_ad():
 def is_user_allowed(user_id: int) -> bool:
     if OWNER_ID and user_id == OWNER_ID:
         return True
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT 1 AS ok FROM allowed_users WHERE telegram_id = %s",
-        (user_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row is not None
+    return user_id in read_through(WHITELIST_CACHE, db().tenant, load_whitelist)
+
+
+def load_whitelist():
+    """
+    Nạp toàn bộ whitelist vào RAM: user lạ cũng được trả lời mà không cần truy vấn DB.
+    """
+    allowed = set(db().get_allowed_user_ids())
+    WHITELIST_CACHE.set(db().tenant, allowed)
+    return allowed
 
 
 def add_allowed_user(user_id: int, added_by: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO allowed_users (telegram_id, added_by)
-        VALUES (%s, %s)
-        ON CONFLICT (telegram_id) DO NOTHING
-        """,
-        (user_id, added_by),
-    )
-    conn.commit()
-    conn.close()
+    db().add_allowed_user(user_id, added_by)
+    invalidate("allow", [user_id])
+
+
+def add_allowed_users(user_ids, added_by: int):
+    added = db().add_allowed_users(user_ids, added_by)
+    invalidate("allow", added)
+    return added
+
+
+def remove_allowed_users(user_ids):
+    removed = db().remove_allowed_users(user_ids)
+    invalidate("revoke", removed)
+    return removed
+
+
+def list_allowed_users_page(limit, offset=0):
+    return db().list_allowed_users_page(limit, offset=offset)
 
 
 async def ensure_allowed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -523,7 +882,7 @@ async def ensure_allowed(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 WELCOME_TEXT = (
     "🌤 *Bot Lưu Trữ File*\n\n"
     "• Lưu hình ảnh, video, tài liệu, file bất kỳ.\n"
-    "• Dữ liệu lưu trên PostgreSQL – không lo mất.\n\n"
+    "• Dữ liệu lưu trong database (PostgreSQL/SQLite) – không lo mất.\n\n"
     "👉 Bấm *📁 Tạo thư mục mới* để tạo thư mục.\n"
     "👉 Dùng /upload để gửi file.\n"
     "👉 Dùng /getlink để lấy link chia sẻ.\n"
@@ -534,40 +893,81 @@ WELCOME_TEXT = (
 
 # ========================= UTIL: gửi file chia sẻ =========================
 
-async def send_shared_folder_files(chat_id: int, owner_id: int, folder_id: int,
-                                   context: ContextTypes.DEFAULT_TYPE):
-    folder = get_folder_by_id(folder_id)
-    folder_name = folder["name"] if folder else "Không tên"
-
-    files = get_files_of_owner(owner_id, folder_id=folder_id, limit=30)
-    if not files:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"📂 Thư mục *{folder_name}* chưa có file.",
-            parse_mode="Markdown",
+async def send_media_batch(bot, chat_id: int, batch):
+    """
+    Gửi 1 album (ưu tiên thấp – hàng loạt); lỗi thì gửi từng file.
+    """
+    try:
+        await bot.send_media_group(
+            chat_id=chat_id, media=batch, rate_limit_args=PRIORITY_BULK
         )
         return
+    except Exception as e:
+        logger.exception("Lỗi khi gửi media group: %s", e)
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=(
-            f"📂 *Thư mục được chia sẻ:* {folder_name}\n"
-            f"(tối đa 30 file mới nhất)\n"
-            f"Bot sẽ gửi file theo lố {MEDIA_GROUP_SIZE} cái một lần."
-        ),
-        parse_mode="Markdown",
-        reply_markup=get_main_keyboard(),
+    # fallback: gửi từng cái
+    for m in batch:
+        try:
+            if isinstance(m, InputMediaVideo):
+                await bot.send_video(
+                    chat_id=chat_id, video=m.media, caption=m.caption,
+                    rate_limit_args=PRIORITY_BULK,
+                )
+            elif isinstance(m, InputMediaPhoto):
+                await bot.send_photo(
+                    chat_id=chat_id, photo=m.media, caption=m.caption,
+                    rate_limit_args=PRIORITY_BULK,
+                )
+            elif isinstance(m, InputMediaDocument):
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=m.media,
+                    caption=m.caption,
+                    rate_limit_args=PRIORITY_BULK,
+                )
+        except Exception as e2:
+            logger.exception("Lỗi khi gửi từng media: %s", e2)
+
+
+class SharePlan:
+    """
+    Những gì cần để gửi 1 link chia sẻ, dựng sẵn từ DB.
+    steps: danh sách ("album", [InputMedia...]), ("text", nội dung)
+    hoặc ("copy", (kênh, [message_id...], các bước dự phòng)) theo đúng thứ tự gửi.
+    previews: [(thumbnail file_id hoặc None, loại)] các ô của ảnh xem trước (rỗng = không dùng),
+    pages: các bước gửi cho từng nút trang của ảnh xem trước.
+    """
+
+    __slots__ = (
+        "owner_id", "folder_id", "folder_name", "password", "steps", "version", "previews", "pages", "markup",
     )
 
-    batch = []
-    count_in_batch = 0
+    def __init__(self, owner_id, folder_id, folder_name, password, steps, version, previews=(), pages=()):
+        self.owner_id = owner_id
+        self.folder_id = folder_id
+        self.folder_name = folder_name
+        self.password = password
+        self.steps = steps
+        self.version = version
+        self.previews = previews
+        self.pages = pages
+        self.markup = None  # bàn phím của ảnh xem trước, dựng ở lần gửi đầu
+
+
+# (tenant, token) -> SharePlan
+SHARE_PLANS = TTLCache(ttl=SHARE_PLAN_TTL, maxsize=SHARE_PLAN_CACHE_SIZE)
+
 
+def _album_steps(files):
+    """
+    Gom file thành các album MEDIA_GROUP_SIZE cái; loại không gửi được trong album thành tin nhắn.
+    """
+    steps = []
+    batch = []
     for f in files:
         file_type = f["file_type"]
         file_id = f["file_id"]
-        file_name = f["file_name"]
-        file_size = f["file_size"]
-        caption = f"{file_name} — {file_size} bytes"
+        caption = f"{f['file_name']} — {f['file_size']} bytes"
 
         media = None
         if file_type == "video":
@@ -579,117 +979,945 @@ async def send_shared_folder_files(chat_id: int, owner_id: int, folder_id: int,
 
         if media:
             batch.append(media)
-            count_in_batch += 1
-
-            if count_in_batch >= MEDIA_GROUP_SIZE:
-                try:
-                    await context.bot.send_media_group(chat_id=chat_id, media=batch)
-                except Exception as e:
-                    logger.exception("Lỗi khi gửi media group: %s", e)
-                    # fallback: gửi từng cái
-                    for m in batch:
-                        try:
-                            if isinstance(m, InputMediaVideo):
-                                await context.bot.send_video(
-                                    chat_id=chat_id, video=m.media, caption=m.caption
-                                )
-                            elif isinstance(m, InputMediaPhoto):
-                                await context.bot.send_photo(
-                                    chat_id=chat_id, photo=m.media, caption=m.caption
-                                )
-                            elif isinstance(m, InputMediaDocument):
-                                await context.bot.send_document(
-                                    chat_id=chat_id,
-                                    document=m.media,
-                                    caption=m.caption,
-                                )
-                        except Exception as e2:
-                            logger.exception("Lỗi khi gửi từng media: %s", e2)
+            if len(batch) >= MEDIA_GROUP_SIZE:
+                steps.append(("album", batch))
                 batch = []
-                count_in_batch = 0
         else:
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Không gửi được trong album: {caption} (loại: {file_type})",
-                )
-            except Exception as e:
-                logger.exception("Lỗi khi gửi message loại không hỗ trợ: %s", e)
-
+            steps.append(("text", f"Không gửi được trong album: {caption} (loại: {file_type})"))
     if batch:
-        try:
-            await context.bot.send_media_group(chat_id=chat_id, media=batch)
-        except Exception as e:
-            logger.exception("Lỗi khi gửi media group cuối: %s", e)
-            for m in batch:
-                try:
-                    if isinstance(m, InputMediaVideo):
-                        await context.bot.send_video(
-                            chat_id=chat_id, video=m.media, caption=m.caption
-                        )
-                    elif isinstance(m, InputMediaPhoto):
-                        await context.bot.send_photo(
-                            chat_id=chat_id, photo=m.media, caption=m.caption
-                        )
-                    elif isinstance(m, InputMediaDocument):
-                        await context.bot.send_document(
-                            chat_id=chat_id,
-                            document=m.media,
-                            caption=m.caption,
-                        )
-                except Exception as e2:
-                    logger.exception("Lỗi khi gửi từng media (batch cuối): %s", e2)
+        steps.append(("album", batch))
+    return steps
 
 
-# ========================= HANDLERS =========================
+def _copy_steps(files):
+    """
+    File đã có bản trong kênh lưu trữ → các bước copy_messages (<= COPY_MESSAGES_LIMIT tin, id tăng dần
+    như Bot API yêu cầu), kèm album dự phòng khi copy lỗi.
+    """
+    by_chat = {}
+    for f in files:
+        by_chat.setdefault(f["storage_chat_id"], []).append(f)
 
-async def version_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"Bot version: {APP_VERSION}")
+    steps = []
+    for chat_id, chat_files in by_chat.items():
+        chat_files.sort(key=lambda f: f["storage_message_id"])
+        for i in range(0, len(chat_files), COPY_MESSAGES_LIMIT):
+            chunk = chat_files[i:i + COPY_MESSAGES_LIMIT]
+            message_ids = [f["storage_message_id"] for f in chunk]
+            steps.append(("copy", (chat_id, message_ids, _album_steps(chunk))))
+    return steps
 
 
-async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    real_username = context.bot.username
-    await update.message.reply_text(
-        "DEBUG INFO:\n"
-        f"- bot.username (thật): {real_username}\n"
-        f"- version: {APP_VERSION}"
-    )
+def _delivery_steps(files):
+    if not STORAGE_CHANNEL_ID:
+        return _album_steps(files)
+    stored = [f for f in files if f["storage_message_id"]]
+    rest = [f for f in files if not f["storage_message_id"]]
+    return _copy_steps(stored) + _album_steps(rest)
 
 
-async def allow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if OWNER_ID and user.id != OWNER_ID:
-        await update.message.reply_text("❌ Bạn không có quyền dùng lệnh này.")
-        return
+def build_share_plan(owner_id: int, folder_id: int):
+    # chụp phiên bản TRƯỚC khi đọc DB: có ghi xen giữa thì lần sau sẽ dựng lại
+    version = content_version(owner_id, folder_id)
+    folder = get_folder_by_id(folder_id)
+    if not folder:
+        return None
+
+    # gồm cả file trong các thư mục con
+    files = get_subtree_files(owner_id, folder_id, limit=30)
+
+    previews = []
+    pages = []
+    if SHARE_PREVIEW and Image is not None:
+        media = [f for f in files if f["file_type"] in ("photo", "video")][:PREVIEW_TILES]
+        if len(media) >= PREVIEW_MIN_FILES:
+            previews = [
+                (f["thumb_file_id"] or (f["file_id"] if f["file_type"] == "photo" else None), f["file_type"])
+                for f in media
+            ]
+            pages = [
+                _delivery_steps(media[i:i + PREVIEW_PAGE_SIZE])
+                for i in range(0, len(media), PREVIEW_PAGE_SIZE)
+            ]
+
+    return SharePlan(
+        owner_id, folder_id, folder["name"], folder["password"], _delivery_steps(files), version,
+        previews, pages,
+    )
 
-    if not context.args:
-        await update.message.reply_text(
-            "Cách dùng:\n"
-            "/allow <telegram_id>\n\n"
-            "Ví dụ:\n"
-            "/allow 123456789",
-        )
-        return
 
-    try:
-        target_id = int(context.args[0])
-    except ValueError:
-        await update.message.reply_text("❌ ID không hợp lệ, phải là số.")
-        return
+def get_share_plan(token: str):
+    """
+    Kế hoạch gửi của link chia sẻ. Phiên bản thư mục chưa đổi → lấy thẳng từ RAM,
+    không truy vấn DB. None nếu link không hợp lệ hoặc thư mục đã bị xoá.
+    """
+    key = (db().tenant, token)
+    plan = SHARE_PLANS.get(key)
+    if plan and plan.version == content_version(plan.owner_id, plan.folder_id):
+        return plan
 
-    add_allowed_user(target_id, user.id)
-    await update.message.reply_text(
-        f"✅ Đã thêm ID {target_id} vào danh sách được phép dùng bot."
-    )
+    try:
+        owner_id, folder_id = get_owner_and_folder_by_token(token)
+        plan = build_share_plan(owner_id, folder_id) if owner_id else None
+    except DB_DOWN_ERRORS:
+        # DB lỗi: vẫn gửi bản đã hết TTL nếu nội dung chưa đổi (đổi rồi thì có thể đã thêm mật khẩu)
+        plan = SHARE_PLANS.get(key, allow_stale=True)
+        if plan and plan.version == content_version(plan.owner_id, plan.folder_id):
+            return plan
+        raise
+    if plan:
+        SHARE_PLANS.set(key, plan)
+    else:
+        SHARE_PLANS.pop(key)
+    return plan
 
 
-async def ad_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def run_share_steps(bot, chat_id: int, steps):
+    for kind, payload in steps:
+        if kind == "copy":
+            from_chat_id, message_ids, fallback = payload
+            try:
+                await bot.copy_messages(
+                    chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids,
+                    rate_limit_args=PRIORITY_BULK,
+                )
+            except Exception as e:
+                logger.exception("Lỗi copy từ kênh lưu trữ, gửi lại theo album: %s", e)
+                await run_share_steps(bot, chat_id, fallback)
+        elif kind == "album":
+            await send_media_batch(bot, chat_id, payload)
+        else:
+            try:
+                await bot.send_message(
+                    chat_id=chat_id, text=payload, rate_limit_args=PRIORITY_BULK,
+                )
+            except Exception as e:
+                logger.exception("Lỗi khi gửi message loại không hỗ trợ: %s", e)
+
+
+async def copy_to_storage_channel(bot, message, owner_id: int, file_unique_id: str):
+    """
+    Copy file vừa tải lên vào kênh lưu trữ và ghi lại message id (chạy nền, lỗi thì bỏ qua:
+    link chia sẻ vẫn gửi file đó theo album như cũ).
+    """
+    try:
+        copied = await bot.copy_message(
+            chat_id=STORAGE_CHANNEL_ID,
+            from_chat_id=message.chat_id,
+            message_id=message.message_id,
+            rate_limit_args=PRIORITY_BULK,
+        )
+    except Exception as e:
+        logger.warning("Không copy được file vào kênh lưu trữ: %s", e)
+        return
+    set_storage_message(owner_id, file_unique_id, STORAGE_CHANNEL_ID, copied.message_id)
+
+
+# ---------- ẢNH XEM TRƯỚC (CONTACT SHEET) ----------
+
+# (tenant, folder_id, phiên bản) -> file_id Telegram của ảnh xem trước đã gửi
+PREVIEW_CACHE = TTLCache(ttl=86400, maxsize=SHARE_PLAN_CACHE_SIZE)
+# cùng key -> task đang dựng ảnh, để nhiều người mở cùng lúc chỉ dựng 1 lần
+PREVIEW_BUILDS = {}
+PREVIEW_POOL = None  # ThreadPoolExecutor, tạo khi cần
+
+
+def render_contact_sheet(tiles, columns=PREVIEW_COLUMNS, tile=PREVIEW_TILE_SIZE) -> bytes:
+    """
+    Ghép các ô (số thứ tự, bytes ảnh hoặc None, loại) thành 1 ảnh JPEG có đánh số.
+    Chạy trong PREVIEW_POOL: giải nén / thu nhỏ ảnh tốn CPU.
+    """
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * tile, rows * tile), (24, 24, 24))
+    draw = ImageDraw.Draw(sheet)
+    for i, (number, data, file_type) in enumerate(tiles):
+        x = (i % columns) * tile
+        y = (i // columns) * tile
+        if data:
+            try:
+                with Image.open(io.BytesIO(data)) as im:
+                    sheet.paste(ImageOps.fit(im.convert("RGB"), (tile - 4, tile - 4)), (x + 2, y + 2))
+            except Exception as e:
+                logger.warning("Không đọc được thumbnail ô %d: %s", number, e)
+        if file_type == "video":
+            cx, cy = x + tile // 2, y + tile // 2
+            draw.polygon([(cx - 14, cy - 18), (cx - 14, cy + 18), (cx + 18, cy)], fill=(255, 255, 255))
+        draw.rectangle([x + 2, y + 2, x + 30, y + 18], fill=(0, 0, 0))
+        draw.text((x + 6, y + 4), str(number), fill=(255, 255, 255))
+    out = io.BytesIO()
+    sheet.save(out, "JPEG", quality=80)
+    return out.getvalue()
+
+
+async def _download_thumb(bot, file_id, sem):
+    if not file_id:
+        return None
+    async with sem:
+        try:
+            tg_file = await bot.get_file(file_id)
+            return bytes(await tg_file.download_as_bytearray())
+        except Exception as e:
+            logger.warning("Không tải được thumbnail %s: %s", file_id, e)
+            return None
+
+
+async def _render_preview(bot, plan: SharePlan) -> bytes:
+    global PREVIEW_POOL
+    sem = asyncio.Semaphore(5)
+    images = await asyncio.gather(*(_download_thumb(bot, fid, sem) for fid, _ in plan.previews))
+    tiles = [(i + 1, data, ftype) for i, (data, (_, ftype)) in enumerate(zip(images, plan.previews))]
+    if PREVIEW_POOL is None:
+        PREVIEW_POOL = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="preview")
+    return await asyncio.get_running_loop().run_in_executor(PREVIEW_POOL, render_contact_sheet, tiles)
+
+
+async def get_preview_photo(bot, plan: SharePlan):
+    """
+    file_id của ảnh xem trước nếu đã gửi ở phiên bản thư mục này, không thì bytes ảnh vừa dựng.
+    """
+    key = (db().tenant, plan.folder_id, plan.version)
+    photo = PREVIEW_CACHE.get(key)
+    if photo:
+        return key, photo
+    task = PREVIEW_BUILDS.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_render_preview(bot, plan))
+        PREVIEW_BUILDS[key] = task
+        task.add_done_callback(lambda _: PREVIEW_BUILDS.pop(key, None))
+    return key, await asyncio.shield(task)
+
+
+def preview_keyboard(token: str, plan: SharePlan):
+    # mỗi plan thuộc đúng 1 token (khoá của SHARE_PLANS) → dựng 1 lần, dùng lại đến khi plan bị dựng lại
+    if plan.markup is not None:
+        return plan.markup
+    buttons = []
+    for i in range(len(plan.pages)):
+        first = i * PREVIEW_PAGE_SIZE + 1
+        last = min(len(plan.previews), first + PREVIEW_PAGE_SIZE - 1)
+        buttons.append(InlineKeyboardButton(f"📥 {first}–{last}", callback_data=f"pv:{token}:{i}"))
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton("📥 Tất cả", callback_data=f"pv:{token}:all")])
+    plan.markup = InlineKeyboardMarkup(rows)
+    return plan.markup
+
+
+async def send_share_preview(chat_id: int, plan: SharePlan,
+                             context: ContextTypes.DEFAULT_TYPE, token: str) -> bool:
+    """
+    Gửi 1 ảnh ghép thay cho cả loạt album. False nếu không dựng / gửi được (gửi file như cũ).
+    """
+    try:
+        key, photo = await get_preview_photo(context.bot, plan)
+        msg = await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=(
+                f"🖼 *{plan.folder_name}*: {len(plan.previews)} ảnh/video mới nhất.\n"
+                "Bấm nút để nhận file theo số thứ tự trên ảnh."
+            ),
+            parse_mode="Markdown",
+            reply_markup=preview_keyboard(token, plan),
+        )
+    except Exception as e:
+        logger.exception("Không gửi được ảnh xem trước: %s", e)
+        return False
+    if not isinstance(photo, str) and msg.photo:
+        PREVIEW_CACHE.set(key, msg.photo[-1].file_id)
+    return True
+
+
+async def send_shared_folder_files(chat_id: int, plan: SharePlan,
+                                   context: ContextTypes.DEFAULT_TYPE, token: str = None, job_key: str = None):
+    """
+    Thư mục nhiều lượt gửi (quá JOB_INLINE_STEPS) chuyển sang job nền "deliver_share";
+    job_key (theo update) để Telegram gửi lại cùng update thì không tạo job thứ 2.
+    """
+    if token and plan.previews and await send_share_preview(chat_id, plan, context, token):
+        return
+
+    if not plan.steps:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"📂 Thư mục *{plan.folder_name}* chưa có file.",
+            parse_mode="Markdown",
+        )
+        return
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            f"📂 *Thư mục được chia sẻ:* {plan.folder_name}\n"
+            f"(tối đa 30 file mới nhất, gồm cả thư mục con)\n"
+            f"Bot sẽ gửi file theo lố {MEDIA_GROUP_SIZE} cái một lần."
+        ),
+        parse_mode="Markdown",
+        reply_markup=get_main_keyboard(),
+    )
+
+    if token and JOB_WORKERS and len(plan.steps) > JOB_INLINE_STEPS:
+        enqueue_job("deliver_share", {"token": token, "chat_id": chat_id}, idempotency_key=job_key)
+        return
+
+    await run_share_steps(context.bot, chat_id, plan.steps)
+
+    if token:
+        record_share_event(token, delivered=1)
+
+
+# ========================= GIÁM SÁT EVENT LOOP =========================
+
+class LoopMonitor:
+    """
+    Đo độ trễ event loop: 1 task asyncio đập nhịp mỗi interval giây, 1 thread canh nhịp.
+    Nhịp trễ quá threshold → loop đang bị chặn (psycopg2, vòng lặp dài…): log stack của
+    đoạn code đang chạy trên thread của loop ngay lúc đó.
+    """
+
+    def __init__(self, threshold=LOOP_STALL_THRESHOLD, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.last_stack = None
+        self._beat = time.monotonic()
+        self._reported = False
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._loop_thread = None
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - expected
+            self.max_lag = max(self.max_lag, lag)
+            self._beat = time.monotonic()
+            if self._reported:
+                self._reported = False
+                logger.warning("Event loop chạy lại sau khi bị chặn %.2fs.", lag)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            blocked = time.monotonic() - self._beat - self.interval
+            if blocked < self.threshold or self._reported:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(không lấy được stack)"
+            self._reported = True
+            self.stalls += 1
+            self.last_stack = stack
+            logger.warning("Event loop bị chặn > %.2fs, đang chạy:\n%s", blocked, stack)
+
+    def stats(self) -> dict:
+        return {"stalls": self.stalls, "max_lag": self.max_lag}
+
+
+LOOP_MONITOR = None  # tạo trong run_bots
+
+
+def sample_stacks(thread_id, seconds, interval=0.005):
+    """
+    Profiler lấy mẫu: cứ interval giây chụp stack của thread_id 1 lần, trong seconds giây.
+    Trả về (số mẫu, Counter hàm đang ở đỉnh stack, Counter hàm có mặt trong stack).
+    """
+    own = Counter()
+    total = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            seen = set()
+            top = True
+            while frame is not None:
+                code = frame.f_code
+                key = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                if top:
+                    own[key] += 1
+                    top = False
+                if key not in seen:
+                    seen.add(key)
+                    total[key] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+    return samples, own, total
+
+
+def format_profile(samples, own, total, seconds, top=30) -> str:
+    lines = [
+        f"Profile event loop trong {seconds:g}s – {samples} mẫu",
+        "(select/epoll ở đỉnh stack = loop đang rảnh chờ I/O)",
+        "",
+        f"== Top {top} hàm tự chạy (đỉnh stack) ==",
+    ]
+    for key, n in own.most_common(top):
+        lines.append(f"{n * 100 / max(samples, 1):6.1f}%  {n:6d}  {key}")
+    lines += ["", f"== Top {top} hàm tính cả hàm con =="]
+    for key, n in total.most_common(top):
+        lines.append(f"{n * 100 / max(samples, 1):6.1f}%  {n:6d}  {key}")
+    return "\n".join(lines) + "\n"
+
+
+# ========================= HÀNG ĐỢI JOB (việc nặng chạy nền) =========================
+
+# Bộ máy hàng đợi (worker, thử lại): xem jobs.py. Dưới đây là các loại job của bot.
+
+def enqueue_job(kind, payload, priority=PRIORITY_INTERACTIVE, idempotency_key=None):
+    """
+    Thêm job cho bot hiện tại. Trả về (job_id, True nếu vừa tạo; False nếu key đã có job).
+    """
+    job_id, created = db().enqueue_job(kind, payload, priority, idempotency_key)
+    if created:
+        invalidate("jobs")  # đánh thức worker, cả ở tiến trình khác
+    return job_id, created
+
+
+async def send_and_pin_ad(bot, chat_id: int, text: str):
+    try:
+        sent = await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=PRIORITY_BULK)
+        try:
+            await bot.pin_chat_message(
+                chat_id=chat_id,
+                message_id=sent.message_id,
+                disable_notification=True,
+                rate_limit_args=PRIORITY_BULK,
+            )
+        except Exception as e_pin:
+            logger.exception("Không ghim được QC ở user %s: %s", chat_id, e_pin)
+    except Exception as e_send:
+        logger.exception("Không gửi QC tới user %s: %s", chat_id, e_send)
+
+
+@job_handler("broadcast_ad")
+async def broadcast_ad_job(bot, store: Storage, job):
+    """
+    Gửi + ghim QC tới mọi user theo telegram_id tăng dần. Checkpoint (= telegram_id cuối đã gửi) lưu sau mỗi
+    BROADCAST_CHECKPOINT_EVERY user hoặc BROADCAST_CHECKPOINT_SECONDS giây thay vì sau từng user:
+    chạy lại chỉ gửi trùng cho các user từ checkpoint cuối tới lúc job chết.
+    """
+    p = job["payload"]
+    after = int(job["checkpoint"] or 0)
+    done = job["progress"] or 0
+    total = job["total"] or store.count_users()
+    saved = done
+    saved_at = time.monotonic()
+    while True:
+        uids = store.get_user_ids_after(after, JOB_BATCH_SIZE)
+        if not uids:
+            break
+        for uid in uids:
+            # chat của owner đã có tin + ghim từ lúc /ad
+            if uid != p["owner_chat_id"]:
+                await send_and_pin_ad(bot, uid, p["text"])
+            done += 1
+            after = uid
+            if (done - saved >= BROADCAST_CHECKPOINT_EVERY
+                    or time.monotonic() - saved_at >= BROADCAST_CHECKPOINT_SECONDS):
+                store.update_job_progress(job["id"], done, total, str(after))
+                saved, saved_at = done, time.monotonic()
+    if done != saved:
+        store.update_job_progress(job["id"], done, total, str(after))
+    try:
+        await bot.send_message(
+            chat_id=p["owner_chat_id"],
+            text=f"✅ Đã phát QC {p['code']} tới {done} user.",
+        )
+    except Exception as e:
+        logger.exception("Không báo được kết quả phát QC: %s", e)
+
+
+@job_handler("deliver_share")
+async def deliver_share_job(bot, store: Storage, job):
+    """
+    Gửi toàn bộ file của link chia sẻ; progress = số lượt (album / copy) đã gửi.
+    """
+    p = job["payload"]
+    plan = get_share_plan(p["token"])
+    if plan is None:
+        return  # link đã bị xoá
+    steps = plan.steps
+    for i in range(job["progress"] or 0, len(steps)):
+        await run_share_steps(bot, p["chat_id"], steps[i:i + 1])
+        store.update_job_progress(job["id"], i + 1, len(steps))
+    record_share_event(p["token"], delivered=1)
+
+
+def _export_arcname(f, root: str, used: set) -> str:
+    """
+    Đường dẫn trong zip: thư mục con tính từ thư mục được xuất, tên trùng thì thêm id file.
+    """
+    folder = f["folder_name"]
+    rel = "" if folder == root else folder[len(root) + 1:] if folder.startswith(root + "/") else folder
+    name = (f["file_name"] or f"{f['file_type']}_{f['id']}").replace("/", "_")
+    arcname = f"{rel}/{name}" if rel else name
+    if arcname in used:
+        stem, ext = os.path.splitext(arcname)
+        arcname = f"{stem}_{f['id']}{ext}"
+    used.add(arcname)
+    return arcname
+
+
+@job_handler("export_folder")
+async def export_folder_job(bot, store: Storage, job):
+    """
+    Nén thư mục thành các phần zip < EXPORT_PART_SIZE, gửi xong phần nào lưu checkpoint phần đó:
+    chạy lại (retry / restart) thì dựng tiếp từ phần kế tiếp.
+    """
+    p = job["payload"]
+    root = p["folder_name"]
+    state = json.loads(job["checkpoint"]) if job["checkpoint"] else {
+        "after": 0, "done": 0, "parts": 0, "skipped": [],
+    }
+    total = job["total"] or store.export_summary(p["owner_id"], p["folder_id"])[0]
+    after, done = state["after"], state["done"]
+    part = None  # (file tạm, ZipFile, tên đã dùng trong phần này)
+    reported = time.monotonic()
+
+    async def report(text):
+        try:
+            await bot.edit_message_text(
+                text, chat_id=p["chat_id"], message_id=p["message_id"], rate_limit_args=PRIORITY_BULK
+            )
+        except Exception as e:
+            logger.debug("Không sửa được tin tiến độ /export: %s", e)
+
+    async def send_part():
+        nonlocal part
+        spool, zf, _ = part
+        zf.close()
+        spool.seek(0)
+        n = state["parts"] + 1
+        await bot.send_document(
+            chat_id=p["chat_id"],
+            # đưa thẳng file (không .read() ra bytes trước): không giữ thêm 1 bản sao của phần trong RAM
+            document=spool,
+            filename=f"{root.replace('/', '_')}-{n}.zip",
+            caption=f"📦 {root} – phần {n}",
+            write_timeout=EXPORT_UPLOAD_TIMEOUT,
+            rate_limit_args=PRIORITY_BULK,
+        )
+        spool.close()
+        part = None
+        state.update(after=after, done=done, parts=n)
+        store.update_job_progress(job["id"], done, total, json.dumps(state, ensure_ascii=False))
+
+    try:
+        async with httpx.AsyncClient(timeout=60) as client:
+            while True:
+                rows = store.get_export_files(p["owner_id"], p["folder_id"], after, EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                for f in rows:
+                    size = f["file_size"] or 0
+                    if size > TELEGRAM_DOWNLOAD_LIMIT:
+                        state["skipped"].append(f["file_name"] or f"#{f['id']}")
+                    else:
+                        # phần hiện tại không đủ chỗ cho file này (kèm header zip) → gửi đi, mở phần mới
+                        if part and part[0].tell() + size + 512 > EXPORT_PART_SIZE:
+                            await send_part()
+                        if part is None:
+                            spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+                            part = (spool, zipfile.ZipFile(spool, "w"), set())
+                        try:
+                            tg_file = await bot.get_file(f["file_id"], rate_limit_args=PRIORITY_BULK)
+                        except BadRequest as e:
+                            state["skipped"].append(f["file_name"] or f"#{f['id']}")
+                            logger.warning("/export bỏ qua file %s: %s", f["id"], safe_error(e))
+                        else:
+                            info = zipfile.ZipInfo(_export_arcname(f, root, part[2]), time.localtime()[:6])
+                            # ảnh / video / nhạc đã nén sẵn, chỉ tài liệu mới đáng deflate
+                            info.compress_type = (
+                                zipfile.ZIP_DEFLATED if f["file_type"] == "document" else zipfile.ZIP_STORED
+                            )
+                            with part[1].open(info, "w") as dst:
+                                async for chunk in stream_telegram_file(client, tg_file):
+                                    dst.write(chunk)
+                    after = f["id"]
+                    done += 1
+                    if time.monotonic() - reported >= EXPORT_PROGRESS_SECONDS:
+                        reported = time.monotonic()
+                        store.update_job_progress(job["id"], done, total)
+                        await report(
+                            f"⏳ Đang nén thư mục {root}: {done}/{total} file, đã gửi {state['parts']} phần..."
+                        )
+            if part:
+                await send_part()
+    finally:
+        if part:
+            part[0].close()
+
+    lines = [f"✅ Đã xuất thư mục {root}: {done - len(state['skipped'])} file trong {state['parts']} file zip."]
+    if state["skipped"]:
+        lines.append(f"⚠️ Bỏ qua {len(state['skipped'])} file (lớn hơn 20MB hoặc không tải được):")
+        lines.extend(f"• {name}" for name in state["skipped"][:20])
+    await report("\n".join(lines))
+
+
+# ========================= HANDLERS =========================
+
+async def version_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(f"Bot version: {APP_VERSION}")
+
+
+async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args and context.args[0] == "profile":
+        await profile_cmd(update, context)
+        return
+
+    real_username = context.bot.username
+    lines = [
+        "DEBUG INFO:",
+        f"- bot.username (thật): {real_username}",
+        f"- version: {APP_VERSION}",
+    ]
+
+    limiter = context.bot.rate_limiter
+    if isinstance(limiter, OutboundLimiter):
+        stats = limiter.stats()
+        lines.append(
+            f"- outbound queue: {stats['queue_depth']} "
+            f"(theo ưu tiên: {stats['depth_by_priority']})"
+        )
+        lines.append(f"- RetryAfter: {stats['retry_after_count']} lần")
+        for cid, wait in stats["chat_waits"]:
+            lines.append(f"  • chat {cid}: chờ ~{wait:.1f}s")
+        lines.append(f"- chat này chờ ~{limiter.chat_wait(update.effective_chat.id):.1f}s")
+
+    lines.append(f"- link chia sẻ dựng sẵn trong RAM: {len(SHARE_PLANS)}")
+
+    try:
+        lines.append(f"- hàng đợi job: {db().job_stats()}, {len(context.bot_data.get('job_workers', []))} worker")
+    except DB_DOWN_ERRORS as e:
+        lines.append(f"- hàng đợi job: không đọc được ({e})")
+
+    if CACHE_LISTENER:
+        delay = CACHE_LISTENER.last_delay
+        lines.append(
+            f"- đồng bộ cache (LISTEN): {'đang nối' if CACHE_LISTENER.conn else 'mất kết nối'}, "
+            f"nhận {CACHE_LISTENER.received} sự kiện"
+            + (f", trễ gần nhất {delay * 1000:.1f}ms" if delay is not None else "")
+        )
+
+    lines.append(
+        f"- DB circuit breaker: {DB_BREAKER.state} "
+        f"(lỗi liên tiếp {DB_BREAKER.failures}, đã ngắt {DB_BREAKER.trips} lần)"
+    )
+
+    sink = context.bot_data.get("mirror")
+    if sink:
+        try:
+            lines.append(f"- sao lưu ({sink.name}): {db().mirror_stats()}")
+        except DB_DOWN_ERRORS as e:
+            lines.append(f"- sao lưu ({sink.name}): không đọc được ({e})")
+
+    if LOOP_MONITOR:
+        stats = LOOP_MONITOR.stats()
+        lines.append(
+            f"- event loop: trễ tối đa {stats['max_lag'] * 1000:.0f}ms, "
+            f"{stats['stalls']} lần bị chặn > {LOOP_MONITOR.threshold:g}s"
+        )
+
+    await update.message.reply_text("\n".join(lines))
+
+
+PROFILE_RUNNING = False
+
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /debug profile [giây] – chỉ OWNER_ID: lấy mẫu stack event loop N giây, gửi kết quả dạng file.
+    """
+    global PROFILE_RUNNING
+    user = update.effective_user
+    if not OWNER_ID or user.id != OWNER_ID:
+        await update.message.reply_text("❌ Chỉ chủ bot được dùng lệnh này.")
+        return
+
+    try:
+        seconds = float(context.args[1]) if len(context.args) > 1 else 10.0
+    except ValueError:
+        seconds = 10.0
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+
+    if PROFILE_RUNNING:
+        await update.message.reply_text("⏳ Đang có 1 lượt profile chạy, đợi xong đã.")
+        return
+
+    PROFILE_RUNNING = True
+    try:
+        # lấy mẫu ở thread khác, loop vẫn phục vụ update bình thường
+        sampling = asyncio.ensure_future(
+            asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+        )
+        await update.message.reply_text(f"⏱ Đang profile event loop {seconds:g} giây...")
+        samples, own, total = await sampling
+    finally:
+        PROFILE_RUNNING = False
+
+    await update.message.reply_document(
+        document=format_profile(samples, own, total, seconds).encode(),
+        filename=f"profile-{int(time.time())}.txt",
+        caption=f"Profile {seconds:g}s – {samples} mẫu",
+    )
+
+
+async def jobs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /jobs – chỉ OWNER_ID: các job nền đang chờ / đang chạy và mới nhất, kèm tiến độ.
+    """
+    user = update.effective_user
+    if not OWNER_ID or user.id != OWNER_ID:
+        await update.message.reply_text("❌ Chỉ chủ bot được dùng lệnh này.")
+        return
+
+    jobs = db().list_jobs(10)
+    if not jobs:
+        await update.message.reply_text("Chưa có job nào.")
+        return
+
+    lines = ["🧰 Job nền:"]
+    for j in jobs:
+        progress = f"{j['progress']}/{j['total']}" if j["total"] else str(j["progress"])
+        line = (
+            f"#{j['id']} {j['kind']} – {j['status']}, tiến độ {progress}, "
+            f"lần thử {j['attempts']}/{j['max_attempts']}"
+        )
+        if j["error"] and j["status"] != "done":
+            line += f"\n   lỗi: {_short(j['error'], 80)}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))
+
+
+def can_manage_whitelist(user) -> bool:
+    return not OWNER_ID or user.id == OWNER_ID
+
+
+def parse_user_ids(values):
+    """
+    telegram_id từ các chuỗi (tham số lệnh, ô của file CSV): bỏ trùng, giữ thứ tự.
+    Trả về (danh sách id, số mục không hợp lệ).
+    """
+    ids = {}
+    bad = 0
+    for v in values:
+        v = v.strip()
+        if not v:
+            continue
+        try:
+            user_id = int(v)
+        except ValueError:
+            bad += 1
+            continue
+        if user_id <= 0:
+            bad += 1
+            continue
+        ids[user_id] = None
+    return list(ids), bad
+
+
+def read_csv_user_ids(data: bytes):
+    """
+    File CSV: lấy cột telegram_id / user_id / id nếu dòng đầu là tiêu đề, không thì cột đầu tiên.
+    Nhận dấu phân cách , ; hoặc tab.
+    """
+    text = data.decode("utf-8-sig", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = [r for r in csv.reader(io.StringIO(text), dialect) if r]
+    col = 0
+    if rows:
+        header = [c.strip().lower() for c in rows[0]]
+        for name in ("telegram_id", "user_id", "id"):
+            if name in header:
+                col = header.index(name)
+                rows = rows[1:]
+                break
+    return parse_user_ids(r[col] if len(r) > col else "" for r in rows)
+
+
+async def apply_whitelist_change(update: Update, action: str, ids, bad: int):
+    """
+    action "allow" / "revoke": ghi cả danh sách bằng 1 câu SQL, cache whitelist (mọi tiến trình) đổi ngay.
+    """
+    message = update.message
+    if not ids:
+        await message.reply_text("❌ Không có ID hợp lệ nào (ID là số dương).")
+        return
+    if len(ids) > WHITELIST_BULK_MAX:
+        await message.reply_text(f"❌ Tối đa {WHITELIST_BULK_MAX} ID mỗi lần, bạn gửi {len(ids)}.")
+        return
+
+    if action == "allow":
+        changed = add_allowed_users(ids, update.effective_user.id)
+        if len(ids) == 1 and not bad:
+            text = f"✅ Đã thêm ID {ids[0]} vào danh sách được phép dùng bot."
+        else:
+            text = f"✅ Đã thêm {len(changed)} user vào whitelist ({len(ids) - len(changed)} đã có sẵn)."
+    else:
+        changed = remove_allowed_users(ids)
+        if len(ids) == 1 and not bad:
+            text = (
+                f"✅ Đã bỏ ID {ids[0]} khỏi danh sách được phép dùng bot." if changed
+                else f"ID {ids[0]} không có trong whitelist."
+            )
+        else:
+            text = f"✅ Đã bỏ {len(changed)} user khỏi whitelist ({len(ids) - len(changed)} không có trong đó)."
+    if bad:
+        text += f"\n⚠️ Bỏ qua {bad} mục không hợp lệ."
+    await message.reply_text(text)
+
+
+async def apply_whitelist_file(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, document):
+    if document.file_size and document.file_size > WHITELIST_CSV_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ File CSV quá lớn (tối đa {format_size(WHITELIST_CSV_MAX_BYTES)})."
+        )
+        return
+    tg_file = await context.bot.get_file(document.file_id)
+    data = bytes(await tg_file.download_as_bytearray())
+    ids, bad = read_csv_user_ids(data)
+    await apply_whitelist_change(update, action, ids, bad)
+
+
+async def whitelist_cmd_common(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    """
+    /allow, /revoke: nhiều ID cách nhau bởi dấu cách / dấu phẩy, hoặc trả lời (reply) 1 file CSV.
+    """
+    user = update.effective_user
+    if not can_manage_whitelist(user):
+        await update.message.reply_text("❌ Bạn không có quyền dùng lệnh này.")
+        return
+
+    reply = update.message.reply_to_message
+    if not context.args and reply and reply.document:
+        await apply_whitelist_file(update, context, action, reply.document)
+        return
+
+    if not context.args:
+        await update.message.reply_text(
+            "Cách dùng:\n"
+            f"/{action} <telegram_id> [telegram_id ...]\n"
+            f"hoặc gửi file CSV (cột telegram_id hoặc cột đầu tiên) kèm chú thích /{action},\n"
+            f"hoặc trả lời file CSV đó bằng /{action}\n\n"
+            "Ví dụ:\n"
+            f"/{action} 123456789 987654321",
+        )
+        return
+
+    tokens = " ".join(context.args).replace(",", " ").replace(";", " ").split()
+    ids, bad = parse_user_ids(tokens)
+    await apply_whitelist_change(update, action, ids, bad)
+
+
+async def allow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await whitelist_cmd_common(update, context, "allow")
+
+
+async def revoke_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await whitelist_cmd_common(update, context, "revoke")
+
+
+async def whitelist_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    File CSV gửi kèm chú thích /allow hoặc /revoke (không lưu vào thư mục như file thường).
+    Người không quản lý whitelist: chú thích chỉ là chữ, file được lưu như bình thường.
+    """
+    if not can_manage_whitelist(update.effective_user):
+        await handle_file(update, context)
+        return
+    command = update.message.caption.split()[0].split("@")[0].lstrip("/").lower()
+    await apply_whitelist_file(update, context, command, update.message.document)
+
+
+def build_whitelist_page(page: int):
+    """
+    Nội dung + nút chuyển trang của /whitelist. (None, None) nếu whitelist trống.
+    """
+    page = max(0, page)
+    rows = list_allowed_users_page(WHITELIST_PAGE_SIZE, page * WHITELIST_PAGE_SIZE)
+    if not rows and page > 0:
+        page = 0
+        rows = list_allowed_users_page(WHITELIST_PAGE_SIZE, 0)
+    if not rows:
+        return None, None
+
+    total = rows[0]["total"]
+    pages = max(1, (total + WHITELIST_PAGE_SIZE - 1) // WHITELIST_PAGE_SIZE)
+    lines = [f"👥 Whitelist ({total} user) – trang {page + 1}/{pages}:\n"]
+    for r in rows:
+        name = r["full_name"] or ""
+        if r["username"]:
+            name = f"{name} (@{r['username']})".strip()
+        added = str(r["created_at"] or "")[:10]
+        lines.append(f"• {r['telegram_id']}" + (f" – {_short(name, 40)}" if name else "") + f" – {added}")
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"wl:{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"wl:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([nav] if nav else [])
+
+
+async def whitelist_list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /whitelist [trang] – danh sách user được phép dùng bot.
+    """
+    if not can_manage_whitelist(update.effective_user):
+        await update.message.reply_text("❌ Bạn không có quyền dùng lệnh này.")
+        return
+
+    try:
+        page = int(context.args[0]) - 1 if context.args else 0
+    except ValueError:
+        page = 0
+    text, markup = build_whitelist_page(page)
+    await update.message.reply_text(text or "Whitelist đang trống.", reply_markup=markup)
+
+
+async def whitelist_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Nút chuyển trang của /whitelist: wl:<trang>.
+    """
+    query = update.callback_query
+    if not can_manage_whitelist(update.effective_user):
+        await query.answer("❌ Bạn không có quyền.", show_alert=True)
+        return
+    try:
+        page = int(query.data.split(":")[1])
+    except (IndexError, ValueError):
+        await query.answer()
+        return
+
+    await query.answer()
+    text, markup = build_whitelist_page(page)
+    await query.edit_message_text(text or "Whitelist đang trống.", reply_markup=markup)
+
+
+async def ad_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /ad Nội dung quảng cáo
     Chỉ OWNER dùng.
     - Bot gửi tin trong chat của owner, ghim.
     - Lưu DB (mã qc1, qc2...)
-    - Gửi + ghim QC đó cho TẤT CẢ user đã từng dùng bot.
+    - Gửi + ghim QC đó cho TẤT CẢ user đã từng dùng bot (job nền "broadcast_ad").
     """
     user = update.effective_user
     chat = update.effective_chat
@@ -727,26 +1955,18 @@ async def ad_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.exception("Không ghim được QC ở chat owner: %s", e)
 
-    # 5) GỬI & GHIM TỚI TẤT CẢ USER ĐÃ TỪNG DÙNG BOT
-    all_user_ids = get_all_user_ids()
-    for uid in all_user_ids:
-        # đã có rồi trong bước 4
-        if uid == chat.id:
-            continue
-        try:
-            sent = await context.bot.send_message(chat_id=uid, text=final_text)
-            try:
-                await context.bot.pin_chat_message(
-                    chat_id=uid,
-                    message_id=sent.message_id,
-                    disable_notification=True,
-                )
-            except Exception as e_pin:
-                logger.exception("Không ghim được QC ở user %s: %s", uid, e_pin)
-        except Exception as e_send:
-            logger.exception("Không gửi QC tới user %s: %s", uid, e_send)
+    # 5) GỬI & GHIM TỚI TẤT CẢ USER ĐÃ TỪNG DÙNG BOT: chạy nền trong hàng đợi job
+    job_id, _ = enqueue_job(
+        "broadcast_ad",
+        {"code": code, "text": final_text, "owner_chat_id": chat.id},
+        priority=PRIORITY_BULK,
+        idempotency_key=f"ad:{code}",
+    )
 
-    await update.message.reply_text(f"✅ Đã đăng & ghim quảng cáo với mã: {code}")
+    await update.message.reply_text(
+        f"✅ Đã đăng & ghim quảng cáo với mã: {code}\n"
+        f"Đang gửi tới các user trong nền (job #{job_id}, xem tiến độ: /jobs)."
+    )
 
 
 async def delad_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -798,10 +2018,14 @@ async def delad_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    get_or_create_user(user)
+    try:
+        get_or_create_user(user)
+    except DB_DOWN_ERRORS as e:
+        # chỉ dùng cho danh sách nhận QC; link chia sẻ / lời chào vẫn trả lời được từ cache
+        logger.warning("Không ghi được user %s: %s", user.id, e)
 
     # reset trạng thái chờ nhập mật khẩu
-    PASS_WAIT_USERS.pop(user.id, None)
+    PASS_WAIT_USERS.pop(state_key(user.id), None)
 
     args = context.args or []
 
@@ -810,24 +2034,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         arg = args[0]
         if arg.startswith("share_"):
             token = arg[len("share_"):]
-            owner_id, folder_id = get_owner_and_folder_by_token(token)
-            if not owner_id:
+            plan = get_share_plan(token)
+            if not plan:
                 await update.message.reply_text("❌ Link chia sẻ không hợp lệ.")
                 return
 
-            folder = get_folder_by_id(folder_id)
-            if not folder:
-                await update.message.reply_text("❌ Thư mục không tồn tại.")
-                return
-
-            folder_name = folder["name"]
-            folder_pass = folder["password"]
+            record_share_event(token, opened=1)
 
             # có mật khẩu → yêu cầu nhập
-            if folder_pass and folder_pass.strip():
-                PASS_WAIT_USERS[user.id] = (owner_id, folder_id)
+            if plan.password and plan.password.strip():
+                PASS_WAIT_USERS[state_key(user.id)] = (plan.owner_id, plan.folder_id, token)
                 await update.message.reply_text(
-                    f"🔐 Thư mục *{folder_name}* đã được đặt mật khẩu.\n"
+                    f"🔐 Thư mục *{plan.folder_name}* đã được đặt mật khẩu.\n"
                     "Vui lòng nhập mật khẩu để xem file.",
                     reply_markup=get_main_keyboard(),
                     parse_mode="Markdown",
@@ -837,9 +2055,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # không có mật khẩu → gửi file luôn
             await send_shared_folder_files(
                 chat_id=update.effective_chat.id,
-                owner_id=owner_id,
-                folder_id=folder_id,
+                plan=plan,
                 context=context,
+                token=token,
+                job_key=f"share:{update.update_id}",
             )
             return
 
@@ -862,12 +2081,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             msg = await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=final_text,
+                rate_limit_args=PRIORITY_BULK,
             )
             try:
                 await context.bot.pin_chat_message(
                     chat_id=update.effective_chat.id,
                     message_id=msg.message_id,
                     disable_notification=True,
+                    rate_limit_args=PRIORITY_BULK,
                 )
             except Exception as e_pin:
                 logger.exception("Không ghim được QC trong start: %s", e_pin)
@@ -879,89 +2100,513 @@ async def upload_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_allowed(update, context):
         return
 
-    user = update.effective_user
-    folder = ensure_current_folder(user.id)
-    UPLOAD_MODE_USERS.add(user.id)
+    user = update.effective_user
+    folder = ensure_current_folder(user.id)
+    UPLOAD_MODE_USERS.add(state_key(user.id))
+    await update.message.reply_text(
+        f"📁 Đang lưu vào thư mục: *{folder['name']}*\n"
+        "➡ Gửi file cho bot.",
+        reply_markup=get_main_keyboard(),
+        parse_mode="Markdown",
+    )
+
+
+async def new_folder_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    FOLDER_NAME_WAIT_USERS.add(state_key(user.id))
+    await update.message.reply_text(
+        "✏️ Nhập tên thư mục mới bạn muốn tạo:",
+        reply_markup=get_main_keyboard(),
+    )
+
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    text = update.message.text.strip()
+
+    # 1) ĐANG NHẬP MẬT KHẨU CHO LINK share_
+    #    → KHÔNG kiểm tra whitelist
+    if state_key(user.id) in PASS_WAIT_USERS and not text.startswith("/"):
+        owner_id, folder_id, token = PASS_WAIT_USERS[state_key(user.id)]
+        plan = get_share_plan(token)
+        real_pass = plan.password if plan else None
+
+        if not real_pass:
+            PASS_WAIT_USERS.pop(state_key(user.id), None)
+            await update.message.reply_text(
+                "Thư mục này hiện không còn đặt mật khẩu.",
+                reply_markup=get_main_keyboard(),
+            )
+            return
+
+        if text == real_pass:
+            PASS_WAIT_USERS.pop(state_key(user.id), None)
+            SHARE_UNLOCKED.setdefault(state_key(user.id), set()).add(token)
+            await update.message.reply_text(
+                "✅ Mật khẩu đúng, đang gửi file...",
+                reply_markup=get_main_keyboard(),
+            )
+            await send_shared_folder_files(
+                chat_id=update.effective_chat.id,
+                plan=plan,
+                context=context,
+                token=token,
+                job_key=f"share:{update.update_id}",
+            )
+        else:
+            await update.message.reply_text(
+                "❌ Mật khẩu sai, vui lòng nhập lại.\n"
+                "Hoặc gửi /start để thoát.",
+                reply_markup=get_main_keyboard(),
+            )
+        return
+
+    # 2) Các trường hợp còn lại mới cần check whitelist
+    if not await ensure_allowed(update, context):
+        return
+
+    # 3) ĐANG CHỜ TÊN THƯ MỤC MỚI
+    if state_key(user.id) in FOLDER_NAME_WAIT_USERS and not text.startswith("/"):
+        FOLDER_NAME_WAIT_USERS.discard(state_key(user.id))
+
+        if not normalize_folder_path(text):
+            await update.message.reply_text(
+                "❌ Tên thư mục không hợp lệ.",
+                reply_markup=get_main_keyboard(),
+            )
+            return
+
+        folder = create_or_get_folder(user.id, text)
+        set_current_folder(user.id, folder["id"])
+        UPLOAD_MODE_USERS.add(state_key(user.id))
+
+        await update.message.reply_text(
+            f"📁 Đã tạo / chọn thư mục: *{folder['name']}*\n"
+            "➡ Bây giờ hãy gửi file cho bot.",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+
+async def setfolder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+
+    name = normalize_folder_path(" ".join(context.args))
+    if not name:
+        await update.message.reply_text(
+            "Cách dùng:\n/setfolder Tên_thư_mục\n"
+            "Thư mục con: /setfolder Cha/Con",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    folder = create_or_get_folder(user.id, name)
+    set_current_folder(user.id, folder["id"])
+    UPLOAD_MODE_USERS.add(state_key(user.id))
+
+    await update.message.reply_text(
+        f"📁 Đã chuyển sang thư mục: *{folder['name']}*",
+        reply_markup=get_main_keyboard(),
+        parse_mode="Markdown",
+    )
+
+
+def format_size(num_bytes) -> str:
+    size = float(num_bytes or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _short(text, limit=40):
+    text = text or ""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def build_folders_page(owner_id: int, page: int, parent=None):
+    """
+    Nội dung + nút bấm cho 1 trang /folders (các thư mục con trực tiếp của parent, None = gốc).
+    Trả về (text, markup) hoặc (None, None) nếu chưa có thư mục.
+    """
+    page = max(0, page)
+    parent_id = parent["id"] if parent else None
+    rows = list_folders_page(owner_id, FOLDERS_PAGE_SIZE, page * FOLDERS_PAGE_SIZE, parent_id=parent_id)
+    if not rows and page > 0:
+        page = 0
+        rows = list_folders_page(owner_id, FOLDERS_PAGE_SIZE, 0, parent_id=parent_id)
+    if not rows and not parent:
+        return None, None
+
+    total = rows[0]["total_folders"] if rows else 0
+    pages = max(1, (total + FOLDERS_PAGE_SIZE - 1) // FOLDERS_PAGE_SIZE)
+    prefix = len(parent["name"]) + 1 if parent else 0
+    p = parent_id or 0
+
+    if parent:
+        lines = [f"📂 Thư mục con của {parent['name']} ({total}) – trang {page + 1}/{pages}:\n"]
+    else:
+        lines = [f"📂 Các thư mục của bạn ({total}) – trang {page + 1}/{pages}:\n"]
+    buttons = []
+    for f in rows:
+        name = f["name"][prefix:]
+        is_current = f["current_id"] == f["id"]
+        mark = "⭐" if is_current else "•"
+        has_pass = " 🔐" if f["password"] else ""
+        subs = f", {f['child_count']} thư mục con" if f["child_count"] else ""
+        lines.append(
+            f"{mark} {_short(name, 60)}{has_pass} — "
+            f"{f['file_count']} file, {format_size(f['total_size'])}{subs}"
+        )
+        row = [
+            InlineKeyboardButton(
+                f"{'⭐' if is_current else '📁'} {_short(name)} ({f['file_count']})",
+                callback_data=f"fd:set:{f['id']}:{p}:{page}",
+            )
+        ]
+        if f["child_count"]:
+            row.append(InlineKeyboardButton(f"📂 {f['child_count']} ›", callback_data=f"fd:open:{f['id']}"))
+        buttons.append(row)
+
+    nav = []
+    if parent:
+        nav.append(InlineKeyboardButton("⬆️", callback_data=f"fd:open:{parent['parent_id'] or 0}"))
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"fd:page:{p}:{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"fd:page:{p}:{page + 1}"))
+    if nav:
+        buttons.append(nav)
+
+    lines.append("\nBấm vào thư mục để chuyển sang thư mục đó, 📂 để xem thư mục con.")
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+
+async def folders_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    text, markup = build_folders_page(user.id, 0)
+
+    if not text:
+        await update.message.reply_text(
+            "Bạn chưa có thư mục nào. Hãy bấm 📁 Tạo thư mục mới.",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def folders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Nút trong /folders: fd:page:<cha>:<trang> – chuyển trang, fd:open:<cha> – xem thư mục con,
+    fd:set:<folder_id>:<cha>:<trang> – chọn thư mục. <cha> = 0 là thư mục gốc.
+    """
+    query = update.callback_query
+    if not await ensure_allowed(update, context):
+        await query.answer()
+        return
+
+    user = update.effective_user
+    parts = query.data.split(":")
+    action = parts[1] if len(parts) > 1 else ""
+    notice = None
+
+    try:
+        if action == "page":
+            parent_id, page = int(parts[2]), int(parts[3])
+        elif action == "open":
+            parent_id, page = int(parts[2]), 0
+        elif action == "set":
+            folder_id, parent_id, page = int(parts[2]), int(parts[3]), int(parts[4])
+            folder = get_folder_by_id(folder_id)
+            if not folder or folder["owner_telegram_id"] != user.id:
+                await query.answer("❌ Thư mục không tồn tại.", show_alert=True)
+                return
+            set_current_folder(user.id, folder_id)
+            UPLOAD_MODE_USERS.add(state_key(user.id))
+            notice = f"📁 Đã chuyển sang thư mục: {folder['name']}"
+        else:
+            await query.answer()
+            return
+    except (IndexError, ValueError):
+        await query.answer()
+        return
+
+    parent = get_folder_by_id(parent_id) if parent_id else None
+    if parent and parent["owner_telegram_id"] != user.id:
+        parent = None
+
+    text, markup = build_folders_page(user.id, page, parent)
+    await query.answer(notice)
+    if text:
+        try:
+            await query.edit_message_text(text, reply_markup=markup)
+        except Exception as e:
+            # "message is not modified" khi bấm lại đúng trang đang xem
+            logger.info("Không sửa được tin /folders: %s", e)
+
+
+async def myfiles_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    folder = ensure_current_folder(user.id)
+    files = get_files_of_owner(user.id, folder_id=folder["id"], limit=30)
+
+    if not files:
+        await update.message.reply_text(
+            f"Thư mục {folder['name']} chưa có file nào.",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    lines = [f"📂 30 file mới nhất trong thư mục {folder['name']}:\n"]
+    for f in files:
+        lines.append(f"• #{f['id']} {f['file_name']} — {f['file_size']} bytes")
+    lines.append("\nXoá file: /rm <số #> … hoặc /rm để chọn từ danh sách.")
+
+    await update.message.reply_text(
+        "\n".join(lines),
+        reply_markup=get_main_keyboard(),
+    )
+
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /export – nén thư mục hiện tại (kèm thư mục con) thành file zip, chạy nền, báo tiến độ trong 1 tin.
+    """
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    folder = ensure_current_folder(user.id)
+    n, size = export_summary(user.id, folder["id"])
+    if not n:
+        await update.message.reply_text(
+            f"Thư mục {folder['name']} chưa có file nào.",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    status = await update.message.reply_text(
+        f"⏳ Đang chuẩn bị file zip thư mục {folder['name']} ({n} file, {format_size(size)})...\n"
+        f"File lớn được chia thành nhiều phần, mỗi phần tối đa {format_size(EXPORT_PART_SIZE)}."
+    )
+    enqueue_job(
+        "export_folder",
+        {
+            "owner_id": user.id,
+            "folder_id": folder["id"],
+            "folder_name": folder["name"],
+            "chat_id": update.effective_chat.id,
+            "message_id": status.message_id,
+        },
+        priority=PRIORITY_BULK,
+        idempotency_key=f"export:{update.update_id}",
+    )
+
+
+async def tree_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /tree [đường_dẫn] – cây thư mục (mặc định: tất cả thư mục của bạn).
+    """
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    path = normalize_folder_path(" ".join(context.args))
+    base = None
+    if path:
+        base = get_folder_by_name(user.id, path)
+        if not base:
+            await update.message.reply_text(
+                f"❌ Không có thư mục: {path}",
+                reply_markup=get_main_keyboard(),
+            )
+            return
+
+    rows = list_subtree(user.id, base["id"] if base else None)
+    if not rows:
+        await update.message.reply_text(
+            "Bạn chưa có thư mục nào. Hãy bấm 📁 Tạo thư mục mới.",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    rows.sort(key=lambda r: r["name"].split("/"))
+    top = base["name"].count("/") if base else 0
+    lines = [f"🌳 {base['name'] if base else 'Cây thư mục'}:\n"]
+    for r in rows[:TREE_MAX_LINES]:
+        depth = r["name"].count("/") - top
+        leaf = r["name"].rsplit("/", 1)[-1]
+        lines.append(f"{'    ' * depth}📁 {_short(leaf, 50)} — {r['file_count']} file, {format_size(r['total_size'])}")
+    if len(rows) > TREE_MAX_LINES:
+        lines.append(f"… và {len(rows) - TREE_MAX_LINES} thư mục khác")
+
+    await update.message.reply_text(
+        "\n".join(lines),
+        reply_markup=get_main_keyboard(),
+    )
+
+
+async def mvfolder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /mvfolder Cũ -> Mới – đổi tên hoặc chuyển thư mục (kèm thư mục con) sang chỗ khác.
+    """
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    old, sep, new = " ".join(context.args).partition("->")
+    if not sep or not normalize_folder_path(old) or not normalize_folder_path(new):
+        await update.message.reply_text(
+            "Cách dùng:\n/mvfolder Ảnh/2023 -> Lưu trữ/Ảnh 2023\n"
+            "(đổi tên: /mvfolder Tên cũ -> Tên mới)",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    try:
+        folder = move_folder(user.id, old, new)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}", reply_markup=get_main_keyboard())
+        return
+
+    if not folder:
+        await update.message.reply_text(
+            f"❌ Không có thư mục: {normalize_folder_path(old)}",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    await update.message.reply_text(
+        f"📁 Đã chuyển thành: {folder['name']}",
+        reply_markup=get_main_keyboard(),
+    )
+
+
+def build_rm_page(owner_id: int, selected: set):
+    """
+    Danh sách chọn nhiều file để xoá (30 file mới nhất của thư mục hiện tại).
+    Trả về (text, markup) hoặc (None, None) nếu thư mục trống.
+    """
+    folder = ensure_current_folder(owner_id)
+    files = get_files_of_owner(owner_id, folder_id=folder["id"], limit=30)
+    if not files:
+        return None, None
+
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"{'☑️' if f['id'] in selected else '⬜'} {_short(f['file_name'])}",
+                callback_data=f"rm:t:{f['id']}",
+            )
+        ]
+        for f in files
+    ]
+    buttons.append([
+        InlineKeyboardButton(f"🗑 Xoá {len(selected)} file", callback_data="rm:go"),
+        InlineKeyboardButton("Huỷ", callback_data="rm:x"),
+    ])
+    text = f"🗑 Chọn file cần xoá trong thư mục {folder['name']}:"
+    return text, InlineKeyboardMarkup(buttons)
+
+
+async def rm_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /rm <id> [id...] – chuyển file vào thùng rác; /rm không kèm gì → chọn từ danh sách.
+    """
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+
+    if not context.args:
+        selected = RM_SELECTED.setdefault(state_key(user.id), set())
+        selected.clear()
+        text, markup = build_rm_page(user.id, selected)
+        if not text:
+            await update.message.reply_text(
+                "Thư mục hiện tại chưa có file nào.",
+                reply_markup=get_main_keyboard(),
+            )
+            return
+        await update.message.reply_text(text, reply_markup=markup)
+        return
+
+    try:
+        file_ids = sorted({int(a.lstrip("#")) for a in context.args})
+    except ValueError:
+        await update.message.reply_text(
+            "Cách dùng:\n/rm 12 15 20 (số # trong /myfiles)",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    count = soft_delete_files(user.id, file_ids)
     await update.message.reply_text(
-        f"📁 Đang lưu vào thư mục: *{folder['name']}*\n"
-        "➡ Gửi file cho bot.",
+        f"🗑 Đã chuyển {count} file vào thùng rác. Xem / khôi phục: /trash",
         reply_markup=get_main_keyboard(),
-        parse_mode="Markdown",
     )
 
 
-async def new_folder_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Nút trong /rm: rm:t:<file_id> – chọn/bỏ chọn, rm:go – xoá các file đã chọn, rm:x – huỷ.
+    """
+    query = update.callback_query
     if not await ensure_allowed(update, context):
+        await query.answer()
         return
 
     user = update.effective_user
-    FOLDER_NAME_WAIT_USERS.add(user.id)
-    await update.message.reply_text(
-        "✏️ Nhập tên thư mục mới bạn muốn tạo:",
-        reply_markup=get_main_keyboard(),
-    )
-
-
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    text = update.message.text.strip()
-
-    # 1) ĐANG NHẬP MẬT KHẨU CHO LINK share_
-    #    → KHÔNG kiểm tra whitelist
-    if user.id in PASS_WAIT_USERS and not text.startswith("/"):
-        owner_id, folder_id = PASS_WAIT_USERS[user.id]
-        folder = get_folder_by_id(folder_id)
-        real_pass = folder["password"] if folder else None
+    parts = query.data.split(":")
+    action = parts[1] if len(parts) > 1 else ""
+    selected = RM_SELECTED.setdefault(state_key(user.id), set())
 
-        if not real_pass:
-            PASS_WAIT_USERS.pop(user.id, None)
-            await update.message.reply_text(
-                "Thư mục này hiện không còn đặt mật khẩu.",
-                reply_markup=get_main_keyboard(),
-            )
+    if action == "t":
+        try:
+            file_id = int(parts[2])
+        except (IndexError, ValueError):
+            await query.answer()
             return
-
-        if text == real_pass:
-            PASS_WAIT_USERS.pop(user.id, None)
-            await update.message.reply_text(
-                "✅ Mật khẩu đúng, đang gửi file...",
-                reply_markup=get_main_keyboard(),
-            )
-            await send_shared_folder_files(
-                chat_id=update.effective_chat.id,
-                owner_id=owner_id,
-                folder_id=folder_id,
-                context=context,
-            )
-        else:
-            await update.message.reply_text(
-                "❌ Mật khẩu sai, vui lòng nhập lại.\n"
-                "Hoặc gửi /start để thoát.",
-                reply_markup=get_main_keyboard(),
-            )
+        selected.symmetric_difference_update({file_id})
+        text, markup = build_rm_page(user.id, selected)
+        await query.answer()
+        if text:
+            await query.edit_message_text(text, reply_markup=markup)
         return
 
-    # 2) Các trường hợp còn lại mới cần check whitelist
-    if not await ensure_allowed(update, context):
+    if action == "go" and not selected:
+        await query.answer("Chưa chọn file nào.")
         return
 
-    # 3) ĐANG CHỜ TÊN THƯ MỤC MỚI
-    if user.id in FOLDER_NAME_WAIT_USERS and not text.startswith("/"):
-        FOLDER_NAME_WAIT_USERS.remove(user.id)
-
-        folder = create_or_get_folder(user.id, text)
-        set_current_folder(user.id, folder["id"])
-        UPLOAD_MODE_USERS.add(user.id)
-
-        await update.message.reply_text(
-            f"📁 Đã tạo / chọn thư mục: *{text}*\n"
-            "➡ Bây giờ hãy gửi file cho bot.",
-            reply_markup=get_main_keyboard(),
+    RM_SELECTED.pop(state_key(user.id), None)
+    if action == "go":
+        count = soft_delete_files(user.id, sorted(selected))
+        await query.answer()
+        await query.edit_message_text(
+            f"🗑 Đã chuyển {count} file vào thùng rác. Xem / khôi phục: /trash"
         )
-        return
+    else:
+        await query.answer()
+        await query.edit_message_text("Đã huỷ.")
 
 
-async def setfolder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rmfolder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /rmfolder Tên_thư_mục – chuyển thư mục và toàn bộ file trong đó vào thùng rác.
+    """
     if not await ensure_allowed(update, context):
         return
 
@@ -969,73 +2614,136 @@ async def setfolder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not context.args:
         await update.message.reply_text(
-            "Cách dùng:\n/setfolder Tên_thư_mục",
+            "Cách dùng:\n/rmfolder Tên_thư_mục",
             reply_markup=get_main_keyboard(),
         )
         return
 
-    name = " ".join(context.args).strip()
-    folder = create_or_get_folder(user.id, name)
-    set_current_folder(user.id, folder["id"])
-    UPLOAD_MODE_USERS.add(user.id)
+    name = normalize_folder_path(" ".join(context.args))
+    count = soft_delete_folder(user.id, name)
+    if count is None:
+        await update.message.reply_text(
+            f"❌ Không có thư mục: {name}",
+            reply_markup=get_main_keyboard(),
+        )
+        return
 
     await update.message.reply_text(
-        f"📁 Đã chuyển sang thư mục: *{name}*",
+        f"🗑 Đã chuyển thư mục {name} ({count} file) vào thùng rác. Xem / khôi phục: /trash",
         reply_markup=get_main_keyboard(),
-        parse_mode="Markdown",
     )
 
 
-async def folders_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def build_trash_page(owner_id: int):
+    """
+    Nội dung + nút khôi phục cho /trash. Trả về (text, markup) hoặc (None, None) nếu thùng rác trống.
+    """
+    folders, files = list_trash(owner_id)
+    if not folders and not files:
+        return None, None
+
+    days = f"{TRASH_RETENTION_DAYS:g}"
+    lines = [f"🗑 Thùng rác (tự xoá hẳn sau {days} ngày):\n"]
+    buttons = []
+    for f in folders:
+        lines.append(f"📁 {_short(f['name'], 60)} — xoá lúc {f['deleted_at']}")
+        buttons.append([
+            InlineKeyboardButton(f"♻️ 📁 {_short(f['name'])}", callback_data=f"tr:d:{f['id']}")
+        ])
+    for f in files:
+        lines.append(f"• {_short(f['file_name'], 60)} — {format_size(f['file_size'])}")
+        buttons.append([
+            InlineKeyboardButton(f"♻️ {_short(f['file_name'])}", callback_data=f"tr:f:{f['id']}")
+        ])
+
+    lines.append("\nBấm vào mục để khôi phục.")
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+
+async def trash_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_allowed(update, context):
         return
 
-    user = update.effective_user
-    folders = list_folders(user.id)
-    cur = get_current_folder(user.id)
-
-    if not folders:
+    text, markup = build_trash_page(update.effective_user.id)
+    if not text:
         await update.message.reply_text(
-            "Bạn chưa có thư mục nào. Hãy bấm 📁 Tạo thư mục mới.",
+            "Thùng rác trống.",
             reply_markup=get_main_keyboard(),
         )
         return
 
-    lines = ["📂 Các thư mục của bạn:\n"]
-    for f in folders:
-        mark = "⭐" if cur and cur["id"] == f["id"] else "•"
-        has_pass = " 🔐" if f["password"] else ""
-        lines.append(f"{mark} {f['name']}{has_pass} — {f['created_at']}")
-
-    await update.message.reply_text(
-        "\n".join(lines),
-        reply_markup=get_main_keyboard(),
-    )
+    await update.message.reply_text(text, reply_markup=markup)
 
 
-async def myfiles_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def trash_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Nút trong /trash: tr:d:<folder_id> – khôi phục thư mục, tr:f:<file_id> – khôi phục file.
+    """
+    query = update.callback_query
     if not await ensure_allowed(update, context):
+        await query.answer()
         return
 
     user = update.effective_user
-    folder = ensure_current_folder(user.id)
-    files = get_files_of_owner(user.id, folder_id=folder["id"], limit=30)
+    parts = query.data.split(":")
+    try:
+        kind, item_id = parts[1], int(parts[2])
+    except (IndexError, ValueError):
+        await query.answer()
+        return
 
-    if not files:
-        await update.message.reply_text(
-            f"Thư mục {folder['name']} chưa có file nào.",
-            reply_markup=get_main_keyboard(),
-        )
+    if kind == "d":
+        ok = restore_folder(user.id, item_id)
+    elif kind == "f":
+        ok = restore_file(user.id, item_id)
+    else:
+        ok = False
+
+    await query.answer("♻️ Đã khôi phục." if ok else "❌ Mục này không còn trong thùng rác.")
+    text, markup = build_trash_page(user.id)
+    await query.edit_message_text(text or "Thùng rác trống.", reply_markup=markup)
+
+
+async def preview_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Nút dưới ảnh xem trước: pv:<token>:<trang> hoặc pv:<token>:all.
+    """
+    query = update.callback_query
+    user = update.effective_user
+    parts = query.data.split(":", 2)
+    if len(parts) != 3 or not (parts[2] == "all" or parts[2].isdecimal()):
+        await query.answer("❌ Nút không hợp lệ hoặc đã hết hạn, hãy mở lại link.", show_alert=True)
         return
+    _, token, page = parts
 
-    lines = [f"📂 30 file mới nhất trong thư mục {folder['name']}:\n"]
-    for f in files:
-        lines.append(f"• {f['file_name']} — {f['file_size']} bytes")
+    plan = get_share_plan(token)
+    if not plan:
+        await query.answer("❌ Link chia sẻ không còn hợp lệ.", show_alert=True)
+        return
+    if plan.password and token not in SHARE_UNLOCKED.get(state_key(user.id), ()):
+        await query.answer("🔐 Mở lại link và nhập mật khẩu để nhận file.", show_alert=True)
+        return
 
-    await update.message.reply_text(
-        "\n".join(lines),
-        reply_markup=get_main_keyboard(),
-    )
+    if page == "all":
+        if JOB_WORKERS and len(plan.steps) > JOB_INLINE_STEPS:
+            enqueue_job(
+                "deliver_share",
+                {"token": token, "chat_id": query.message.chat_id},
+                idempotency_key=f"share:{update.update_id}",
+            )
+            await query.answer("Đang gửi file...")
+            return
+        steps = plan.steps
+    else:
+        index = int(page)
+        if index >= len(plan.pages):
+            await query.answer("Thư mục đã thay đổi, hãy mở lại link.", show_alert=True)
+            return
+        steps = plan.pages[index]
+
+    await query.answer("Đang gửi file...")
+    await run_share_steps(context.bot, query.message.chat_id, steps)
+    record_share_event(token, delivered=1)
 
 
 async def getlink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1046,7 +2754,7 @@ async def getlink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     folder = ensure_current_folder(user.id)
     token = get_share_token(user.id, folder["id"])
 
-    real_username = os.getenv("BOT_USERNAME") or context.bot.username
+    real_username = context.bot_data.get("username") or context.bot.username
     link = f"https://t.me/{real_username}?start=share_{token}"
 
     text = (
@@ -1062,6 +2770,42 @@ async def getlink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def toplinks_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /toplinks – các link chia sẻ của bạn được mở nhiều nhất.
+    """
+    if not await ensure_allowed(update, context):
+        return
+
+    user = update.effective_user
+    try:
+        flush_share_stats(db())  # để số liệu vừa phát sinh cũng được tính
+    except Exception as e:
+        logger.exception("Không ghi được thống kê link: %s", e)
+
+    rows = top_share_links(user.id, limit=10)
+    if not rows:
+        await update.message.reply_text(
+            "Bạn chưa có link chia sẻ nào. Dùng /getlink để tạo.",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+
+    lines = ["📊 Link chia sẻ được mở nhiều nhất:\n"]
+    for i, r in enumerate(rows, 1):
+        last = r["last_access"] or "chưa có"
+        lines.append(
+            f"{i}. {r['folder_name']} – {r['opens']} lượt mở, "
+            f"{r['deliveries']} lượt nhận file (gần nhất: {last})\n"
+            f"   share_{r['token']}"
+        )
+
+    await update.message.reply_text(
+        "\n".join(lines),
+        reply_markup=get_main_keyboard(),
+    )
+
+
 async def setpass_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_allowed(update, context):
         return
@@ -1081,13 +2825,13 @@ async def setpass_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     arg = " ".join(context.args).strip()
     if arg.lower() in ["off", "none", "0", "bo", "bỏ"]:
-        update_folder_password(folder["id"], None)
+        update_folder_password(user.id, folder["id"], None)
         await update.message.reply_text(
             f"🔓 Đã tắt mật khẩu cho thư mục {folder['name']}.",
             reply_markup=get_main_keyboard(),
         )
     else:
-        update_folder_password(folder["id"], arg)
+        update_folder_password(user.id, folder["id"], arg)
         await update.message.reply_text(
             f"🔐 Đã đặt mật khẩu cho thư mục {folder['name']}.",
             reply_markup=get_main_keyboard(),
@@ -1107,6 +2851,7 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_name = None
     file_size = None
     mime_type = None
+    thumb = None
 
     if message.document:
         file_obj = message.document
@@ -1116,12 +2861,15 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mime_type = file_obj.mime_type
     elif message.photo:
         file_obj = message.photo[-1]
+        # cỡ nhỏ nhất vẫn đủ nét cho 1 ô ảnh xem trước
+        thumb = next((p for p in message.photo if min(p.width, p.height) >= PREVIEW_TILE_SIZE), file_obj)
         file_type = "photo"
         file_name = "photo.jpg"
         file_size = file_obj.file_size
         mime_type = "image/jpeg"
     elif message.video:
         file_obj = message.video
+        thumb = file_obj.thumbnail
         file_type = "video"
         file_name = "video.mp4"
         file_size = file_obj.file_size
@@ -1144,7 +2892,12 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_type,
         file_size,
         mime_type,
+        thumb.file_id if thumb else None,
     )
+    if STORAGE_CHANNEL_ID:
+        context.application.create_task(
+            copy_to_storage_channel(context.bot, message, user.id, file_obj.file_unique_id)
+        )
 
     await message.reply_text(
         f"✅ Đã lưu file vào thư mục {folder['name']}:\n• {file_name}",
@@ -1152,29 +2905,290 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# ========================= INLINE MODE =========================
+
+def _inline_lookup(user_id: int, query: str, offset: int):
+    """
+    Lấy kết quả tìm kiếm cho inline query, ưu tiên cache:
+    - cùng (user, từ khoá, khối) → dùng luôn,
+    - khối đầu của 1 tiền tố đã lấy đủ (ít hơn INLINE_FETCH_LIMIT dòng) → lọc trong RAM,
+      nên gõ thêm chữ không phải truy vấn DB lại.
+    Trả về (danh sách file của khối, vị trí đầu khối).
+    """
+    block_start = offset - offset % INLINE_FETCH_LIMIT
+    tenant = db().tenant
+    key = (tenant, user_id, query, block_start)
+    rows = INLINE_CACHE.get(key)
+    if rows is not None:
+        return rows, block_start
+
+    if block_start == 0:
+        for k in range(len(query) - 1, -1, -1):
+            prefix_rows = INLINE_CACHE.get((tenant, user_id, query[:k], 0))
+            if prefix_rows is not None and len(prefix_rows) < INLINE_FETCH_LIMIT:
+                rows = [r for r in prefix_rows if query in fold_name(r.file_name)]
+                INLINE_CACHE.set(key, rows)
+                return rows, block_start
+
+    rows = search_files(user_id, query, limit=INLINE_FETCH_LIMIT, offset=block_start)
+    INLINE_CACHE.set(key, rows)
+    return rows, block_start
+
+
+def _inline_result(f: FileRef):
+    result_id = str(f.id)
+    name = f.file_name or f.file_type
+    if f.file_type == "photo":
+        return InlineQueryResultCachedPhoto(
+            id=result_id, photo_file_id=f.file_id, title=name, caption=name
+        )
+    if f.file_type == "video":
+        return InlineQueryResultCachedVideo(
+            id=result_id, video_file_id=f.file_id, title=name, caption=name
+        )
+    if f.file_type == "audio":
+        return InlineQueryResultCachedAudio(id=result_id, audio_file_id=f.file_id)
+    return InlineQueryResultCachedDocument(
+        id=result_id, title=name, document_file_id=f.file_id,
+        description=f"{f.file_size} bytes",
+    )
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    @bot <từ khoá> ở chat bất kỳ → tìm trong file của chính người gõ.
+    """
+    iq = update.inline_query
+    user = iq.from_user
+
+    if not is_user_allowed(user.id):
+        await iq.answer(
+            [],
+            cache_time=60,
+            is_personal=True,
+            button=InlineQueryResultsButton(text="🔒 Bot riêng tư", start_parameter="inline"),
+        )
+        return
+
+    query = fold_name(iq.query.strip())
+    try:
+        offset = max(0, int(iq.offset or 0))
+    except ValueError:
+        offset = 0
+
+    rows, block_start = _inline_lookup(user.id, query, offset)
+    start_in_block = offset - block_start
+    page = rows[start_in_block:start_in_block + INLINE_PAGE_SIZE]
+
+    has_more = (
+        start_in_block + INLINE_PAGE_SIZE < len(rows)
+        or len(rows) == INLINE_FETCH_LIMIT
+    )
+    next_offset = str(offset + len(page)) if page and has_more else ""
+
+    await iq.answer(
+        [_inline_result(f) for f in page],
+        cache_time=int(INLINE_CACHE_TTL),
+        is_personal=True,
+        next_offset=next_offset,
+    )
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """
+    DB lỗi / đang bị ngắt → báo user thử lại sau thay vì im lặng; lỗi khác chỉ ghi log.
+    """
+    err = context.error
+    if not isinstance(err, DB_DOWN_ERRORS):
+        logger.error("Lỗi khi xử lý update:", exc_info=err)
+        return
+
+    logger.warning("DB lỗi khi xử lý update: %s", err)
+    if not isinstance(update, Update):
+        return
+    text = "⚠️ Hệ thống lưu trữ đang tạm gián đoạn, vui lòng thử lại sau ít phút."
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.effective_chat:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    except Exception as e:
+        logger.warning("Không gửi được thông báo lỗi DB: %s", e)
+
+
 async def unknown_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_allowed(update, context):
         return
 
     await update.message.reply_text(
         "Lệnh không tồn tại. Hãy dùng:\n"
-        "/upload /getlink /myfiles /folders /setfolder /setpass /version /ad /delad",
+        "/upload /getlink /myfiles /folders /tree /setfolder /mvfolder /setpass /rm /rmfolder /trash "
+        "/toplinks /version /ad /delad /allow /revoke /whitelist",
         reply_markup=get_main_keyboard(),
     )
 
 
 # ========================= MAIN =========================
 
-def main():
-    if not BOT_TOKEN:
-        raise SystemExit("❌ Chưa thiết lập BOT_TOKEN hoặc Token.")
-    if not DATABASE_URL:
-        raise SystemExit("❌ Chưa thiết lập DATABASE_URL.")
+def use_store(context: ContextTypes.DEFAULT_TYPE) -> Storage:
+    """
+    Chọn Storage của bot đang chạy (handler hoặc job).
+    """
+    store = context.bot_data["store"]
+    CURRENT_STORE.set(store)
+    return store
+
+
+async def bind_store(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Chạy trước mọi handler: chọn Storage của bot nhận update này.
+    """
+    use_store(context)
+    if update.effective_user:
+        STATE_TOUCHED[state_key(update.effective_user.id)] = time.monotonic()
+
+
+def evict_idle_state(tenant, idle_seconds) -> int:
+    """
+    Bỏ trạng thái hội thoại của user im lặng quá idle_seconds (chờ mật khẩu, chờ tên thư mục,
+    chế độ upload, lựa chọn /rm, link đã mở khoá) và các phần tử cache đã hết hạn. Trả về số user được dọn.
+    """
+    cutoff = time.monotonic() - idle_seconds
+    idle = [k for k, t in STATE_TOUCHED.items() if k[0] == tenant and t < cutoff]
+    for key in idle:
+        STATE_TOUCHED.pop(key, None)
+        UPLOAD_MODE_USERS.discard(key)
+        FOLDER_NAME_WAIT_USERS.discard(key)
+        PASS_WAIT_USERS.pop(key, None)
+        RM_SELECTED.pop(key, None)
+        SHARE_UNLOCKED.pop(key, None)
+    # DB đang lỗi thì giữ bản cũ để còn trả lời được (whitelist / QC chỉ 1 phần tử mỗi bot, không cần dọn)
+    if DB_BREAKER.state == "closed":
+        INLINE_CACHE.expire()
+        SHARE_PLANS.expire()
+        PREVIEW_CACHE.expire()
+    return len(idle)
+
+
+async def flush_share_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    store = use_store(context)
+    try:
+        n = flush_share_stats(store)
+        if n:
+            logger.info("Đã ghi thống kê %d link chia sẻ.", n)
+    except Exception as e:
+        logger.exception("Lỗi ghi thống kê link: %s", e)
+
+
+async def purge_trash_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Xoá hẳn dữ liệu quá hạn trong thùng rác, từng lô nhỏ để không giữ khoá lâu / chặn bot.
+    """
+    store = use_store(context)
+    before = utc_timestamp(time.time() - TRASH_RETENTION_DAYS * 86400)
+    total = 0
+    try:
+        while True:
+            removed = store.purge_deleted(before, PURGE_BATCH_SIZE)
+            total += removed
+            if removed < PURGE_BATCH_SIZE:
+                break
+            await asyncio.sleep(0.1)  # nhường event loop cho update khác
+    except Exception as e:
+        logger.exception("Lỗi dọn thùng rác: %s", e)
+    if total:
+        logger.info("Đã xoá hẳn %d dòng khỏi thùng rác.", total)
+
 
-    init_db()
-    logger.info("Bot started with PostgreSQL.")
+async def expire_tokens_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Xoá link chia sẻ của thư mục đã bị xoá hẳn, từng lô nhỏ.
+    """
+    store = use_store(context)
+    total = 0
+    try:
+        while True:
+            removed = store.expire_orphan_tokens(TOKEN_CLEANUP_BATCH_SIZE)
+            total += removed
+            if removed < TOKEN_CLEANUP_BATCH_SIZE:
+                break
+            await asyncio.sleep(0.1)
+    except Exception as e:
+        logger.exception("Lỗi dọn link chia sẻ mồ côi: %s", e)
+    if total:
+        logger.info("Đã xoá %d link chia sẻ của thư mục không còn tồn tại.", total)
+
+
+async def analyze_job(context: ContextTypes.DEFAULT_TYPE):
+    store = use_store(context)
+    try:
+        tables = store.analyze_hot_tables(ANALYZE_MIN_CHANGES)
+        if tables:
+            logger.info("Đã ANALYZE: %s", ", ".join(tables))
+    except Exception as e:
+        logger.exception("Lỗi ANALYZE: %s", e)
+
+
+async def evict_state_job(context: ContextTypes.DEFAULT_TYPE):
+    store = use_store(context)
+    n = evict_idle_state(store.tenant, STATE_IDLE_SECONDS)
+    if n:
+        logger.info("Đã dọn trạng thái của %d user không hoạt động.", n)
+
+
+def warm_caches(store: Storage):
+    """
+    Nạp lại whitelist + quảng cáo mới nhất của 1 bot (gọi cả lúc khởi động để cache không nguội sau deploy).
+    """
+    token = CURRENT_STORE.set(store)
+    try:
+        load_whitelist()
+        load_latest_ad()
+    except Exception as e:
+        logger.exception("Lỗi làm mới cache: %s", e)
+    finally:
+        CURRENT_STORE.reset(token)
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+
+async def job_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Hàng đợi job: chạy lại job của worker đã chết, xoá job cũ đã xong.
+    """
+    store = use_store(context)
+    try:
+        n = store.requeue_stale_jobs(utc_timestamp(time.time() - JOB_LOCK_TIMEOUT_SECONDS))
+        if n:
+            logger.warning("Đã đưa %d job bị treo về hàng đợi.", n)
+        store.prune_jobs(utc_timestamp(time.time() - JOB_KEEP_DAYS * 86400), PURGE_BATCH_SIZE)
+    except Exception as e:
+        logger.exception("Lỗi bảo trì hàng đợi job: %s", e)
+
+
+async def warm_caches_job(context: ContextTypes.DEFAULT_TYPE):
+    warm_caches(context.bot_data["store"])
+
+
+async def mirror_job(context: ContextTypes.DEFAULT_TYPE):
+    store = use_store(context)
+    try:
+        n = await mirror_pending(context.bot, store, context.bot_data["mirror"])
+        if n:
+            logger.info("Đã xử lý sao lưu %d file.", n)
+    except Exception as e:
+        logger.exception("Lỗi job sao lưu: %s", e)
+
+
+def build_application(token: str, store: Storage, username=None):
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .rate_limiter(OutboundLimiter())
+        .build()
+    )
+    app.bot_data["store"] = store
+    app.bot_data["username"] = username
+
+    app.add_handler(TypeHandler(Update, bind_store), group=-100)
 
     app.add_handler(CommandHandler("version", version_cmd))
     app.add_handler(CommandHandler("debug", debug_cmd))
@@ -1182,12 +3196,28 @@ def main():
     app.add_handler(CommandHandler("upload", upload_cmd))
     app.add_handler(CommandHandler("getlink", getlink_cmd))
     app.add_handler(CommandHandler("myfiles", myfiles_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
     app.add_handler(CommandHandler("folders", folders_cmd))
     app.add_handler(CommandHandler("setfolder", setfolder_cmd))
+    app.add_handler(CommandHandler("tree", tree_cmd))
+    app.add_handler(CommandHandler("mvfolder", mvfolder_cmd))
     app.add_handler(CommandHandler("setpass", setpass_cmd))
+    app.add_handler(CommandHandler("toplinks", toplinks_cmd))
+    app.add_handler(CommandHandler("rm", rm_cmd))
+    app.add_handler(CommandHandler("rmfolder", rmfolder_cmd))
+    app.add_handler(CommandHandler("trash", trash_cmd))
     app.add_handler(CommandHandler("allow", allow_cmd))
+    app.add_handler(CommandHandler("revoke", revoke_cmd))
+    app.add_handler(CommandHandler("whitelist", whitelist_list_cmd))
     app.add_handler(CommandHandler("ad", ad_cmd))
     app.add_handler(CommandHandler("delad", delad_cmd))
+    app.add_handler(CommandHandler("jobs", jobs_cmd))
+    app.add_handler(InlineQueryHandler(inline_query))
+    app.add_handler(CallbackQueryHandler(folders_callback, pattern=r"^fd:"))
+    app.add_handler(CallbackQueryHandler(rm_callback, pattern=r"^rm:"))
+    app.add_handler(CallbackQueryHandler(trash_callback, pattern=r"^tr:"))
+    app.add_handler(CallbackQueryHandler(preview_callback, pattern=r"^pv:"))
+    app.add_handler(CallbackQueryHandler(whitelist_callback, pattern=r"^wl:"))
 
     app.add_handler(
         MessageHandler(
@@ -1208,11 +3238,153 @@ def main():
         | filters.VIDEO
         | filters.AUDIO
     )
+    # file CSV kèm chú thích /allow, /revoke: cập nhật whitelist thay vì lưu như file thường
+    app.add_handler(
+        MessageHandler(
+            filters.Document.ALL & filters.CaptionRegex(r"^/(allow|revoke)(@\w+)?(\s|$)"),
+            whitelist_file,
+        )
+    )
     app.add_handler(MessageHandler(file_filter, handle_file))
 
     app.add_handler(MessageHandler(filters.COMMAND, unknown_cmd))
+    app.add_error_handler(error_handler)
+
+    app.job_queue.run_repeating(
+        flush_share_stats_job,
+        interval=SHARE_STATS_FLUSH_SECONDS,
+        first=SHARE_STATS_FLUSH_SECONDS,
+        name="flush_share_stats",
+    )
+    app.job_queue.run_repeating(
+        purge_trash_job,
+        interval=PURGE_INTERVAL_SECONDS,
+        first=60,
+        name="purge_trash",
+    )
+
+    # bảo trì định kỳ
+    app.job_queue.run_repeating(
+        warm_caches_job,
+        interval=CACHE_REFRESH_SECONDS,
+        first=CACHE_REFRESH_SECONDS,
+        name="warm_caches",
+    )
+    app.job_queue.run_repeating(
+        expire_tokens_job,
+        interval=TOKEN_CLEANUP_INTERVAL_SECONDS,
+        first=120,
+        name="expire_orphan_tokens",
+    )
+    app.job_queue.run_repeating(
+        analyze_job,
+        interval=ANALYZE_INTERVAL_SECONDS,
+        first=ANALYZE_INTERVAL_SECONDS,
+        name="analyze_hot_tables",
+    )
+    app.job_queue.run_repeating(
+        evict_state_job,
+        interval=STATE_EVICT_INTERVAL_SECONDS,
+        first=STATE_EVICT_INTERVAL_SECONDS,
+        name="evict_idle_state",
+    )
+    app.job_queue.run_repeating(
+        job_maintenance_job,
+        interval=60,
+        first=60,
+        name="job_maintenance",
+    )
+
+    mirror = open_mirror()
+    if mirror:
+        app.bot_data["mirror"] = mirror
+        app.job_queue.run_repeating(
+            mirror_job,
+            interval=MIRROR_INTERVAL_SECONDS,
+            first=10,
+            name="mirror_files",
+        )
+
+    return app
+
 
-    app.run_polling()
+async def run_bots(apps):
+    """
+    Chạy nhiều Application trong cùng 1 event loop cho tới khi nhận SIGINT/SIGTERM.
+    """
+    global LOOP_MONITOR, CACHE_LISTENER
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C vẫn dừng qua KeyboardInterrupt
+
+    if LOOP_STALL_THRESHOLD > 0:
+        LOOP_MONITOR = LoopMonitor(LOOP_STALL_THRESHOLD)
+        LOOP_MONITOR.start()
+
+    listener_task = None
+    if DATABASE_URL and CACHE_NOTIFY:
+        CACHE_LISTENER = CacheListener(DATABASE_URL)
+        listener_task = asyncio.create_task(CACHE_LISTENER.run())
+
+    started = []
+    try:
+        for app in apps:
+            await app.initialize()
+            started.append(app)
+            warm_caches(app.bot_data["store"])
+            await app.start()
+            start_job_workers(app)
+            await app.updater.start_polling()
+            logger.info("Bot @%s đang chạy.", app.bot.username)
+        await stop.wait()
+    finally:
+        for app in reversed(started):
+            if app.updater.running:
+                await app.updater.stop()
+            await stop_job_workers(app)
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+            try:
+                flush_share_stats(app.bot_data["store"])
+            except Exception as e:
+                logger.exception("Không ghi được thống kê link khi tắt bot: %s", e)
+        if LOOP_MONITOR:
+            LOOP_MONITOR.stop()
+        if listener_task:
+            listener_task.cancel()
+            await asyncio.gather(listener_task, return_exceptions=True)
+
+
+def main():
+    tokens = []
+    for token in [BOT_TOKEN] + BOT_TOKENS:
+        if token and token not in tokens:
+            tokens.append(token)
+    if not tokens:
+        raise SystemExit("❌ Chưa thiết lập BOT_TOKEN hoặc Token.")
+
+    apps = []
+    for i, token in enumerate(tokens):
+        bot_id = token.split(":", 1)[0]
+        store = init_db(tenant=bot_id, primary=(i == 0))
+        # BOT_USERNAME chỉ áp dụng cho bot chính
+        username = os.getenv("BOT_USERNAME") if i == 0 else None
+        apps.append(build_application(token, store, username=username))
+    logger.info("Bot started with %s (%d bot).", db().name, len(apps))
+
+    try:
+        asyncio.run(run_bots(apps))
+    finally:
+        for store in STORES.values():
+            store.close()
+        close_shared_pg_pools()
+        if PREVIEW_POOL:
+            PREVIEW_POOL.shutdown(wait=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+"""
+Sao lưu file ra ngoài Telegram (thư mục local hoặc S3) và tải file từ Bot API theo từng chunk.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import re
+import tempfile
+import time
+from urllib.parse import quote, urlsplit
+
+import httpx
+
+from config import (
+    MIRROR_BATCH_SIZE,
+    MIRROR_CHUNK_SIZE,
+    MIRROR_CONCURRENCY,
+    MIRROR_DIR,
+    MIRROR_MAX_ATTEMPTS,
+    MIRROR_S3_ACCESS_KEY,
+    MIRROR_S3_BUCKET,
+    MIRROR_S3_ENDPOINT,
+    MIRROR_S3_REGION,
+    MIRROR_S3_SECRET_KEY,
+    PRIORITY_BULK,
+    TELEGRAM_DOWNLOAD_LIMIT,
+)
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class LocalMirror:
+    """
+    Lưu bản sao vào thư mục local: <root>/<key>.
+    """
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, ".tmp")  # cùng ổ đĩa để os.replace là đổi tên
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    async def put(self, client, key, path, size, sha256):
+        dest = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+
+
+class S3Mirror:
+    """
+    Lưu bản sao lên S3 / MinIO / R2… (path-style, ký AWS SigV4).
+    Thân request đọc dần từ file tạm nên không giữ cả file trong RAM.
+    """
+
+    name = "s3"
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region="us-east-1"):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.tmp_dir = tempfile.gettempdir()
+
+    def _sign(self, method, url, payload_hash):
+        parts = urlsplit(url)
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        day = amz_date[:8]
+        headers = {
+            "host": parts.netloc,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+        }
+        signed = ";".join(sorted(headers))
+        canonical = "\n".join([
+            method,
+            parts.path,
+            parts.query,
+            *(f"{k}:{headers[k]}" for k in sorted(headers)),
+            "",
+            signed,
+            payload_hash,
+        ])
+        scope = f"{day}/{self.region}/s3/aws4_request"
+        to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical.encode()).hexdigest(),
+        ])
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (day, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed}, Signature={signature}"
+        )
+        del headers["host"]  # httpx tự gửi đúng giá trị này
+        return headers
+
+    async def put(self, client, key, path, size, sha256):
+        url = f"{self.endpoint}/{quote(self.bucket)}/{quote(key)}"
+        headers = self._sign("PUT", url, sha256)
+        headers["content-length"] = str(size)
+
+        async def body():
+            with open(path, "rb") as fh:
+                while chunk := fh.read(MIRROR_CHUNK_SIZE):
+                    yield chunk
+
+        resp = await client.put(url, content=body(), headers=headers)
+        resp.raise_for_status()
+
+
+def open_mirror():
+    """
+    Nơi sao lưu theo biến môi trường, None nếu không bật.
+    """
+    if MIRROR_S3_ENDPOINT and MIRROR_S3_BUCKET:
+        return S3Mirror(
+            MIRROR_S3_ENDPOINT,
+            MIRROR_S3_BUCKET,
+            MIRROR_S3_ACCESS_KEY,
+            MIRROR_S3_SECRET_KEY,
+            MIRROR_S3_REGION,
+        )
+    if MIRROR_DIR:
+        return LocalMirror(MIRROR_DIR)
+    return None
+
+
+def mirror_key(tenant, f):
+    ext = os.path.splitext(f["file_name"] or "")[1][:10]
+    return f"{tenant}/{f['owner_telegram_id']}/{f['file_unique_id']}{ext}"
+
+
+class DownloadError(Exception):
+    """
+    Tải file từ Telegram lỗi. Thông điệp chỉ có loại lỗi + HTTP status (đã che URL).
+    """
+
+
+_URL_RE = re.compile(r"https?://\S+")
+_BOT_TOKEN_RE = re.compile(r"\d{5,}:[A-Za-z0-9_-]{20,}")
+
+
+def safe_error(e) -> str:
+    """
+    Mô tả lỗi để ghi DB / log: URL tải file của Bot API có dạng .../file/bot<TOKEN>/...
+    nên không bao giờ ghi nguyên str(e) của httpx.
+    """
+    if isinstance(e, DownloadError):
+        return str(e)
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"{type(e).__name__}: HTTP {e.response.status_code}"
+    text = _URL_RE.sub("<url>", f"{type(e).__name__}: {e}")
+    return _BOT_TOKEN_RE.sub("<token>", text)
+
+
+async def stream_telegram_file(client, tg_file):
+    """
+    Đọc file đã get_file theo từng chunk MIRROR_CHUNK_SIZE, không giữ cả file trong RAM.
+    Lỗi tải → DownloadError (không kèm lỗi gốc: trong đó có URL chứa token bot).
+    """
+    if os.path.isabs(tg_file.file_path):
+        # Bot API server chạy --local: file_path là đường dẫn trên máy
+        with open(tg_file.file_path, "rb") as src:
+            while chunk := src.read(MIRROR_CHUNK_SIZE):
+                yield chunk
+        return
+    try:
+        async with client.stream("GET", tg_file.file_path) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes(MIRROR_CHUNK_SIZE):
+                yield chunk
+    except httpx.HTTPError as e:
+        raise DownloadError(safe_error(e)) from None
+
+
+async def mirror_one(bot, client, sink, store: Storage, f):
+    """
+    Tải 1 file từ Telegram theo từng chunk vào file tạm (tính sha256 khi ghi), rồi đẩy sang nơi sao lưu.
+    """
+    if (f["file_size"] or 0) > TELEGRAM_DOWNLOAD_LIMIT:
+        store.record_mirror(f["id"], "skipped", error="file lớn hơn 20MB, Bot API không cho tải")
+        return
+
+    tmp = os.path.join(sink.tmp_dir, f"{store.tenant}-{f['id']}.part")
+    try:
+        tg_file = await bot.get_file(f["file_id"], rate_limit_args=PRIORITY_BULK)
+        digest = hashlib.sha256()
+        size = 0
+        with open(tmp, "wb") as out:
+            async for chunk in stream_telegram_file(client, tg_file):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        key = mirror_key(store.tenant, f)
+        await sink.put(client, key, tmp, size, digest.hexdigest())
+        store.record_mirror(f["id"], "done", key, digest.hexdigest(), size)
+    except Exception as e:
+        error = safe_error(e)
+        logger.warning("Sao lưu file %s lỗi: %s", f["id"], error)
+        store.record_mirror(f["id"], "failed", error=error[:500])
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+async def mirror_pending(bot, store: Storage, sink):
+    """
+    Sao lưu mọi file còn thiếu, mỗi lúc tối đa MIRROR_CONCURRENCY file.
+    Trạng thái ghi theo từng file nên tắt bot giữa chừng thì lần sau làm tiếp phần còn lại.
+    """
+    sem = asyncio.Semaphore(MIRROR_CONCURRENCY)
+    total = 0
+    after_id = 0
+    async with httpx.AsyncClient(timeout=60) as client:
+
+        async def run(f):
+            async with sem:
+                await mirror_one(bot, client, sink, store, f)
+
+        while True:
+            rows = store.pending_mirrors(after_id, MIRROR_BATCH_SIZE, MIRROR_MAX_ATTEMPTS)
+            if not rows:
+                break
+            await asyncio.gather(*(run(f) for f in rows))
+            after_id = rows[-1]["id"]
+            total += len(rows)
+    return total
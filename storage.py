@@ -0,0 +1,2054 @@
+"""
+Lưu trữ của bot: lớp Storage (SQL dùng chung) với 2 backend PostgreSQL / SQLite, pool kết nối,
+circuit breaker, kiểu dòng gọn cho cache và Storage của bot đang xử lý update (db()).
+"""
+
+import contextvars
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from psycopg2 import sql
+
+from config import (
+    CACHE_CHANNEL,
+    CACHE_NOTIFY,
+    CACHE_NOTIFY_IDS,
+    DATABASE_REPLICA_URL,
+    DATABASE_URL,
+    DB_BREAKER_RESET_SECONDS,
+    DB_BREAKER_THRESHOLD,
+    DB_CONNECT_TIMEOUT,
+    DB_MAINTENANCE_TIMEOUT_MS,
+    DB_PATH,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_STATEMENT_TIMEOUT_MS,
+    JOB_MAX_ATTEMPTS,
+    REPLICA_RYW_SECONDS,
+    WHITELIST_SQL_CHUNK,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def record_type(name, fields):
+    """
+    Kiểu dòng gọn cho dữ liệu nằm lâu trong cache: tuple có tên (không có dict riêng mỗi dòng),
+    chỉ gồm các cột cần dùng. Vẫn đọc được kiểu row["cột"] như dòng dict trả về từ DB.
+    """
+    base = namedtuple(name, fields)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def from_row(cls, row):
+        return cls._make([row[f] for f in cls._fields])
+
+    return type(name, (base,), {
+        "__slots__": (),
+        "__getitem__": __getitem__,
+        "from_row": classmethod(from_row),
+    })
+
+
+# 1 kết quả tìm kiếm (INLINE_CACHE), 1 file khi dựng link chia sẻ, quảng cáo mới nhất (LATEST_AD_CACHE)
+FileRef = record_type("FileRef", "id file_id file_name file_type file_size")
+ShareFile = record_type(
+    "ShareFile",
+    "file_id file_name file_type file_size thumb_file_id storage_chat_id storage_message_id",
+)
+AdRef = record_type("AdRef", "code content")
+
+
+def utc_timestamp(epoch=None) -> str:
+    """
+    Mốc thời gian UTC dạng 'YYYY-MM-DD HH:MM:SS' – so sánh được trên cả Postgres lẫn SQLite.
+    """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+def normalize_folder_path(name: str) -> str:
+    """
+    " A / B/ " -> "A/B": tên thư mục lồng nhau là đường dẫn ngăn bởi "/".
+    """
+    return "/".join(p.strip() for p in (name or "").split("/") if p.strip())
+
+
+def fold_name(text) -> str:
+    """
+    Dạng so khớp tên file không phân biệt hoa thường, kể cả chữ có dấu ("Ảnh Đẹp" -> "ảnh đẹp").
+    LOWER() của SQLite (và Postgres locale C) chỉ đổi chữ ASCII nên luôn tính bằng Python.
+    """
+    return unicodedata.normalize("NFC", text or "").casefold()
+
+
+class DatabaseUnavailable(Exception):
+    """
+    DB đang lỗi / quá tải: circuit breaker đang mở hoặc hết kết nối rảnh trong pool.
+    """
+
+
+class PoolTimeout(DatabaseUnavailable):
+    """
+    Chờ quá DB_POOL_TIMEOUT mà pool không có kết nối rảnh (bot quá tải, DB vẫn có thể bình thường).
+    """
+
+
+# lỗi cho thấy bản thân DB có vấn đề (mất kết nối, quá statement timeout, bị khoá),
+# khác với lỗi dữ liệu như trùng khoá
+DB_DOWN_ERRORS = (
+    DatabaseUnavailable,
+    psycopg2.OperationalError,
+    psycopg2.InterfaceError,
+    sqlite3.OperationalError,
+)
+
+# OperationalError của SQLite gồm cả lỗi viết SQL sai ("no such table"...): chỉ những lỗi này là DB có sự cố
+SQLITE_OUTAGE_MARKERS = ("locked", "busy", "disk i/o", "unable to open", "disk is full", "malformed")
+
+
+def is_db_outage(e) -> bool:
+    """
+    Lỗi đáng tính vào circuit breaker: DB không phục vụ được.
+    Hết kết nối rảnh trong pool và lỗi lập trình (sai tên bảng / cột) thì không.
+    """
+    if isinstance(e, PoolTimeout):
+        return False
+    if isinstance(e, sqlite3.OperationalError):
+        message = str(e).lower()
+        return any(m in message for m in SQLITE_OUTAGE_MARKERS)
+    return isinstance(e, DB_DOWN_ERRORS)
+
+
+class CircuitBreaker:
+    """
+    Đếm lỗi DB liên tiếp; đủ threshold lần thì "mở": mọi truy vấn báo DatabaseUnavailable ngay
+    trong reset_seconds giây, hết hạn thì cho đúng 1 truy vấn thử lại (thành công → đóng, lỗi → mở tiếp),
+    các truy vấn khác trong lúc đó vẫn bị từ chối.
+    """
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._probing = False  # đang có 1 truy vấn thử lại (half-open)
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def record_success(self):
+        if not self.failures:
+            return
+        with self._lock:
+            if self.opened_at is not None:
+                logger.warning("DB hoạt động lại, đóng circuit breaker.")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None:
+                # lần thử lại vẫn lỗi → ngắt thêm 1 chu kỳ
+                self.opened_at = time.monotonic()
+            elif self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                logger.error(
+                    "DB lỗi %d lần liên tiếp, ngắt truy vấn trong %.0fs.", self.failures, self.reset_seconds
+                )
+
+    @contextmanager
+    def guard(self):
+        probe = False
+        with self._lock:
+            state = self.state
+            if state == "open":
+                raise DatabaseUnavailable("Circuit breaker đang mở")
+            if state == "half-open":
+                if self._probing:
+                    raise DatabaseUnavailable("Circuit breaker đang thử lại DB")
+                self._probing = probe = True
+        try:
+            yield
+        except DB_DOWN_ERRORS as e:
+            if is_db_outage(e):
+                self.record_failure()
+            raise
+        else:
+            self.record_success()
+        finally:
+            if probe:
+                self._probing = False
+
+
+DB_BREAKER = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET_SECONDS)
+
+
+class Storage:
+    """
+    Lớp truy cập dữ liệu chung cho mọi backend.
+    SQL viết theo kiểu placeholder %s của psycopg2; backend con cung cấp
+    kết nối và những chỗ khác cú pháp (kiểu khoá chính, thêm cột...).
+    Row trả về truy cập kiểu row["field"].
+    """
+
+    name = "base"
+    PK = "SERIAL PRIMARY KEY"
+    tenant = "default"  # bot sở hữu dữ liệu này (dùng làm tiền tố key cache)
+    # bảng đọc/ghi nhiều, cần thống kê mới để planner chọn đúng index
+    HOT_TABLES = ("files", "folders", "folder_tree", "share_tokens", "share_stats", "allowed_users")
+    # nhiều worker cùng lấy job: bỏ qua dòng worker khác đang giữ thay vì chờ khoá
+    SKIP_LOCKED = "FOR UPDATE SKIP LOCKED"
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _release(self, conn):
+        conn.close()
+
+    @contextmanager
+    def _cursor(self, statement_timeout=None):
+        """
+        Transaction ngắn qua circuit breaker.
+        statement_timeout (ms, 0 = không giới hạn): thay DB_STATEMENT_TIMEOUT_MS cho transaction này.
+        """
+        with DB_BREAKER.guard():
+            conn = self._connect()
+            try:
+                cur = conn.cursor()
+                if statement_timeout is not None:
+                    cur.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout),))
+                yield cur
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._release(conn)
+
+    def _read(self, query_fn, owner_id=None, recheck_empty=False, primary=False):
+        """
+        Chạy truy vấn chỉ-đọc query_fn(cur). Backend có replica ghi đè hàm này.
+        owner_id: user vừa ghi thì phải đọc từ primary (read-your-writes).
+        recheck_empty: replica trả rỗng thì hỏi lại primary (dữ liệu có thể chưa kịp sync).
+        primary: luôn đọc từ primary.
+        """
+        with self._cursor() as cur:
+            return query_fn(cur)
+
+    def _note_write(self, owner_id):
+        pass
+
+    def publish_invalidation(self, event):
+        pass  # SQLite: chỉ 1 tiến trình, không cần báo ai
+
+    def _add_column(self, cur, table, column, decl):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # ---------- SCHEMA ----------
+
+    def init_schema(self):
+        pk = self.PK
+        # tạo bảng / index có thể lâu: không áp statement timeout
+        with self._cursor(statement_timeout=0) as cur:
+            # USERS
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS users (
+                    id              {pk},
+                    telegram_id     BIGINT UNIQUE,
+                    full_name       TEXT,
+                    username        TEXT,
+                    created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # FOLDERS
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS folders (
+                    id               {pk},
+                    owner_telegram_id BIGINT,
+                    name             TEXT,
+                    created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # thêm cột password nếu chưa có
+            self._add_column(cur, "folders", "password", "TEXT")
+            # xoá mềm: khác NULL = đang nằm trong thùng rác
+            self._add_column(cur, "folders", "deleted_at", "TIMESTAMP")
+            # thư mục lồng nhau: name là đường dẫn đầy đủ "A/B/C", parent_id trỏ tới "A/B"
+            self._add_column(cur, "folders", "parent_id", "INTEGER")
+
+            # CÂY THƯ MỤC (closure table): mỗi cặp tổ tiên – con cháu 1 dòng, kể cả chính nó (depth 0)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS folder_tree (
+                    ancestor_id    INTEGER NOT NULL,
+                    descendant_id  INTEGER NOT NULL,
+                    depth          INTEGER NOT NULL,
+                    PRIMARY KEY (ancestor_id, descendant_id)
+                );
+            """)
+
+            # CURRENT FOLDER
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS user_current_folder (
+                    id               {pk},
+                    owner_telegram_id BIGINT UNIQUE,
+                    folder_id        INTEGER,
+                    updated_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # FILES
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS files (
+                    id               {pk},
+                    file_unique_id   TEXT UNIQUE,
+                    file_id          TEXT,
+                    owner_telegram_id BIGINT,
+                    folder_id        INTEGER,
+                    file_name        TEXT,
+                    file_type        TEXT,
+                    file_size        BIGINT,
+                    mime_type        TEXT,
+                    created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            self._add_column(cur, "files", "deleted_at", "TIMESTAMP")
+            # bản copy trong kênh lưu trữ (STORAGE_CHANNEL_ID)
+            self._add_column(cur, "files", "storage_chat_id", "BIGINT")
+            self._add_column(cur, "files", "storage_message_id", "BIGINT")
+            # thumbnail nhỏ (ảnh / video) cho ảnh xem trước link chia sẻ
+            self._add_column(cur, "files", "thumb_file_id", "TEXT")
+            # tên file đã fold_name() để tìm kiếm
+            self._add_column(cur, "files", "name_fold", "TEXT")
+            self._backfill_name_fold(cur)
+
+            # SHARE TOKENS
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS share_tokens (
+                    id               {pk},
+                    owner_telegram_id BIGINT,
+                    folder_id        INTEGER,
+                    token            TEXT UNIQUE,
+                    created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # SAO LƯU FILE (id = files.id): done / failed / skipped
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS file_mirrors (
+                    id          INTEGER PRIMARY KEY,
+                    status      TEXT,
+                    object_key  TEXT,
+                    sha256      TEXT,
+                    size        BIGINT,
+                    attempts    INTEGER DEFAULT 0,
+                    error       TEXT,
+                    updated_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # THỐNG KÊ LINK CHIA SẺ (ghi theo lô, xem flush_share_stats)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS share_stats (
+                    token        TEXT PRIMARY KEY,
+                    opens        BIGINT DEFAULT 0,
+                    deliveries   BIGINT DEFAULT 0,
+                    last_access  TIMESTAMP
+                );
+            """)
+
+            # WHITELIST
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS allowed_users (
+                    id          {pk},
+                    telegram_id BIGINT UNIQUE,
+                    added_by    BIGINT,
+                    created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # ADS (quảng cáo ghim)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS ads (
+                    id          {pk},
+                    code        TEXT UNIQUE,        -- ví dụ: qc1, qc2
+                    chat_id     BIGINT,
+                    message_id  BIGINT,
+                    content     TEXT,
+                    created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            # HÀNG ĐỢI JOB: queued → running → done / failed (lỗi thì về queued chờ run_after)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id              {pk},
+                    kind            TEXT NOT NULL,
+                    payload         TEXT,               -- JSON
+                    priority        INTEGER DEFAULT 0,  -- số nhỏ = chạy trước
+                    status          TEXT DEFAULT 'queued',
+                    attempts        INTEGER DEFAULT 0,
+                    max_attempts    INTEGER DEFAULT 5,
+                    progress        INTEGER DEFAULT 0,
+                    total           INTEGER,
+                    checkpoint      TEXT,               -- chỗ làm tiếp khi chạy lại
+                    error           TEXT,
+                    idempotency_key TEXT UNIQUE,
+                    run_after       TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    locked_by       TEXT,
+                    locked_at       TIMESTAMP,
+                    created_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at      TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            # worker chỉ quét các job đang chờ
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS jobs_queue_idx
+                ON jobs (priority, id) WHERE status = 'queued';
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS jobs_status_updated_idx
+                ON jobs (status, updated_at);
+            """)
+
+            # file theo thư mục (liệt kê, đếm số file / dung lượng)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS files_folder_created_idx
+                ON files (folder_id, created_at);
+            """)
+
+            # liệt kê / tìm file theo chủ sở hữu, mới nhất trước
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS files_owner_created_idx
+                ON files (owner_telegram_id, created_at);
+            """)
+
+            # thùng rác / job dọn rác: chỉ index các dòng đã xoá mềm
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS files_deleted_idx
+                ON files (deleted_at) WHERE deleted_at IS NOT NULL;
+            """)
+
+            # tổ tiên của 1 thư mục / thư mục con trực tiếp
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS folder_tree_descendant_idx
+                ON folder_tree (descendant_id);
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS folders_parent_idx
+                ON folders (parent_id);
+            """)
+
+            self._ensure_unique_constraints(cur)
+
+            # thư mục tạo trước khi có cây thư mục: thành thư mục gốc
+            cur.execute("""
+                INSERT INTO folder_tree (ancestor_id, descendant_id, depth)
+                SELECT f.id, f.id, 0 FROM folders f
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM folder_tree t
+                    WHERE t.ancestor_id = f.id AND t.descendant_id = f.id
+                );
+            """)
+            self._backfill_folder_parents(cur)
+
+        logger.info("Database OK (%s, password + whitelist + ads).", self.name)
+
+    def _backfill_name_fold(self, cur, batch=5000):
+        """
+        Tính name_fold cho file lưu trước khi có cột này (1 lần, theo lô).
+        """
+        while True:
+            cur.execute(
+                """
+                SELECT id, file_name FROM files
+                WHERE name_fold IS NULL AND file_name IS NOT NULL
+                ORDER BY id LIMIT %s
+                """,
+                (batch,),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                return
+            self._set_name_folds(cur, [(fold_name(r["file_name"]), r["id"]) for r in rows])
+
+    def _set_name_folds(self, cur, rows):
+        cur.executemany("UPDATE files SET name_fold = %s WHERE id = %s", rows)
+
+    def _ensure_unique_constraints(self, cur):
+        """
+        Ràng buộc unique cho các upsert 1 câu lệnh.
+        Dữ liệu cũ có thể đã bị trùng (tạo đồng thời) → gộp về bản ghi id nhỏ nhất trước.
+        """
+        cur.execute("""
+            SELECT owner_telegram_id, name, MIN(id) AS keep_id
+            FROM folders
+            GROUP BY owner_telegram_id, name
+            HAVING COUNT(*) > 1
+        """)
+        for dup in cur.fetchall():
+            params = (dup["keep_id"], dup["owner_telegram_id"], dup["name"], dup["keep_id"])
+            for table in ("files", "share_tokens", "user_current_folder"):
+                cur.execute(
+                    f"""
+                    UPDATE {table} SET folder_id = %s
+                    WHERE folder_id IN (
+                        SELECT id FROM folders
+                        WHERE owner_telegram_id = %s AND name = %s AND id <> %s
+                    )
+                    """,
+                    params,
+                )
+            cur.execute(
+                "DELETE FROM folders WHERE owner_telegram_id = %s AND name = %s AND id <> %s",
+                params[1:],
+            )
+        cur.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS folders_owner_name_uq
+            ON folders (owner_telegram_id, name);
+        """)
+
+        cur.execute("""
+            DELETE FROM share_tokens
+            WHERE id NOT IN (
+                SELECT MIN(id) FROM share_tokens GROUP BY owner_telegram_id, folder_id
+            )
+        """)
+        cur.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS share_tokens_owner_folder_uq
+            ON share_tokens (owner_telegram_id, folder_id);
+        """)
+
+    # ---------- USERS ----------
+
+    def get_or_create_user(self, tg_user):
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO users (telegram_id, full_name, username)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (telegram_id) DO UPDATE SET
+                    full_name = EXCLUDED.full_name,
+                    username = EXCLUDED.username
+                RETURNING *;
+                """,
+                (tg_user.id, tg_user.full_name, tg_user.username),
+            )
+            return cur.fetchone()
+
+    def get_all_user_ids(self):
+        with self._cursor() as cur:
+            cur.execute("SELECT telegram_id FROM users;")
+            rows = cur.fetchall()
+        return [r["telegram_id"] for r in rows]
+
+    def get_user_ids_after(self, after_id, limit):
+        """
+        1 lô telegram_id tăng dần sau after_id (duyệt toàn bộ user mà không nạp hết vào RAM).
+        """
+        with self._cursor() as cur:
+            cur.execute(
+                "SELECT telegram_id FROM users WHERE telegram_id > %s ORDER BY telegram_id LIMIT %s",
+                (after_id, limit),
+            )
+            return [r["telegram_id"] for r in cur.fetchall()]
+
+    def count_users(self):
+        with self._cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS n FROM users")
+            return cur.fetchone()["n"]
+
+    # ---------- FOLDERS ----------
+
+    def create_or_get_folder(self, owner_id, name):
+        """
+        name có thể là đường dẫn "A/B/C": tạo luôn các thư mục cha còn thiếu.
+        """
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            return self._ensure_folder_path(cur, owner_id, normalize_folder_path(name))
+
+    def _ensure_folder_path(self, cur, owner_id, path):
+        folder = None
+        parts = path.split("/")
+        for i in range(len(parts)):
+            # DO UPDATE để RETURNING trả cả thư mục đã có (đang trong thùng rác thì lấy lại)
+            cur.execute(
+                """
+                INSERT INTO folders (owner_telegram_id, name, parent_id)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (owner_telegram_id, name) DO UPDATE SET
+                    name = EXCLUDED.name,
+                    parent_id = EXCLUDED.parent_id,
+                    deleted_at = NULL
+                RETURNING *;
+                """,
+                (owner_id, "/".join(parts[:i + 1]), folder["id"] if folder else None),
+            )
+            folder = cur.fetchone()
+            self._link_folder(cur, folder["id"], folder["parent_id"])
+        return folder
+
+    def _link_folder(self, cur, folder_id, parent_id):
+        """
+        Thêm các dòng closure của 1 thư mục (chạy lại nhiều lần không sao).
+        Thư mục chưa nối vào parent_id (vd "A/B" tạo từ trước khi có cây thư mục)
+        thì nối cả cây con của nó.
+        """
+        cur.execute(
+            """
+            INSERT INTO folder_tree (ancestor_id, descendant_id, depth)
+            VALUES (%s, %s, 0)
+            ON CONFLICT DO NOTHING
+            """,
+            (folder_id, folder_id),
+        )
+        if not parent_id:
+            return
+        cur.execute(
+            "SELECT 1 FROM folder_tree WHERE ancestor_id = %s AND descendant_id = %s",
+            (parent_id, folder_id),
+        )
+        if cur.fetchone():
+            return
+        cur.execute(
+            """
+            INSERT INTO folder_tree (ancestor_id, descendant_id, depth)
+            SELECT p.ancestor_id, s.descendant_id, p.depth + s.depth + 1
+            FROM folder_tree p
+            JOIN folder_tree s ON s.ancestor_id = %s
+            WHERE p.descendant_id = %s
+            ON CONFLICT DO NOTHING
+            """,
+            (folder_id, parent_id),
+        )
+
+    def _backfill_folder_parents(self, cur):
+        """
+        Thư mục tên "A/B" tạo từ trước khi có thư mục lồng nhau vẫn là thư mục gốc:
+        nối vào "A" (tạo "A" nếu thiếu). Thư mục ngắn trước để cha luôn được nối trước con.
+        """
+        cur.execute(
+            """
+            SELECT owner_telegram_id, name FROM folders
+            WHERE parent_id IS NULL AND deleted_at IS NULL AND name LIKE %s
+            ORDER BY LENGTH(name), id
+            """,
+            ("%/%",),
+        )
+        for row in cur.fetchall():
+            # tên không chuẩn ("A//B", " A/B") không tự đổi được: để nguyên là thư mục gốc
+            if normalize_folder_path(row["name"]) == row["name"]:
+                self._ensure_folder_path(cur, row["owner_telegram_id"], row["name"])
+
+    def move_folder(self, owner_id, old_name, new_name):
+        """
+        Đổi tên / chuyển thư mục (kèm cả cây con) sang đường dẫn mới.
+        Trả về thư mục sau khi chuyển, None nếu không có thư mục cũ;
+        ValueError nếu đường dẫn mới không hợp lệ.
+        """
+        old = normalize_folder_path(old_name)
+        new = normalize_folder_path(new_name)
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT * FROM folders
+                WHERE owner_telegram_id = %s AND name = %s AND deleted_at IS NULL
+                """,
+                (owner_id, old),
+            )
+            folder = cur.fetchone()
+            if not folder:
+                return None
+            if new == old or new.startswith(old + "/"):
+                raise ValueError("Không thể chuyển thư mục vào chính nó.")
+
+            folder_id = folder["id"]
+            cut = len(old) + 1  # SUBSTR(name, cut) = phần đường dẫn sau thư mục cũ
+
+            # tên mới của cả cây con không được trùng thư mục nào đang có (kể cả trong thùng rác)
+            cur.execute(
+                """
+                SELECT o.name FROM folders o
+                WHERE o.owner_telegram_id = %s AND o.name IN (
+                    SELECT %s || SUBSTR(f.name, %s)
+                    FROM folder_tree t
+                    JOIN folders f ON f.id = t.descendant_id
+                    WHERE t.ancestor_id = %s
+                )
+                LIMIT 1
+                """,
+                (owner_id, new, cut, folder_id),
+            )
+            clash = cur.fetchone()
+            if clash:
+                raise ValueError(f"Đã có thư mục {clash['name']} (có thể đang trong thùng rác).")
+
+            parent_path = new.rpartition("/")[0]
+            parent = self._ensure_folder_path(cur, owner_id, parent_path) if parent_path else None
+
+            # tách cây con khỏi các tổ tiên cũ rồi nối vào tổ tiên mới
+            cur.execute(
+                """
+                DELETE FROM folder_tree
+                WHERE descendant_id IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                  AND ancestor_id NOT IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                """,
+                (folder_id, folder_id),
+            )
+            if parent:
+                cur.execute(
+                    """
+                    INSERT INTO folder_tree (ancestor_id, descendant_id, depth)
+                    SELECT p.ancestor_id, s.descendant_id, p.depth + s.depth + 1
+                    FROM folder_tree p
+                    JOIN folder_tree s ON s.ancestor_id = %s
+                    WHERE p.descendant_id = %s
+                    """,
+                    (folder_id, parent["id"]),
+                )
+
+            cur.execute(
+                """
+                UPDATE folders SET name = %s || SUBSTR(name, %s)
+                WHERE id IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                """,
+                (new, cut, folder_id),
+            )
+            cur.execute(
+                "UPDATE folders SET parent_id = %s WHERE id = %s RETURNING *",
+                (parent["id"] if parent else None, folder_id),
+            )
+            return cur.fetchone()
+
+    def set_current_folder(self, owner_id, folder_id):
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO user_current_folder (owner_telegram_id, folder_id, updated_at)
+                VALUES (%s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (owner_telegram_id) DO UPDATE SET
+                    folder_id = EXCLUDED.folder_id,
+                    updated_at = EXCLUDED.updated_at;
+                """,
+                (owner_id, folder_id),
+            )
+
+    def get_current_folder(self, owner_id):
+        def q(cur):
+            cur.execute(
+                """
+                SELECT f.*
+                FROM user_current_folder u
+                JOIN folders f ON f.id = u.folder_id
+                WHERE u.owner_telegram_id = %s AND f.deleted_at IS NULL;
+                """,
+                (owner_id,),
+            )
+            return cur.fetchone()
+        return self._read(q, owner_id=owner_id)
+
+    def list_folders(self, owner_id):
+        def q(cur):
+            cur.execute(
+                """
+                SELECT * FROM folders
+                WHERE owner_telegram_id = %s AND deleted_at IS NULL
+                ORDER BY created_at DESC
+                """,
+                (owner_id,),
+            )
+            return cur.fetchall()
+        return self._read(q, owner_id=owner_id)
+
+    def list_folders_page(self, owner_id, limit, offset=0, parent_id=None):
+        """
+        1 trang thư mục con trực tiếp của parent_id (None = thư mục gốc) kèm số file,
+        tổng dung lượng của cả cây con, số thư mục con (child_count), tổng số thư mục
+        (total_folders) và id thư mục hiện tại (current_id) – tất cả trong 1 truy vấn.
+        Chỉ đếm file cho các thư mục của trang này.
+        """
+        parent_cond = "f.parent_id = %s" if parent_id else "f.parent_id IS NULL"
+        parent_args = (parent_id,) if parent_id else ()
+
+        def q(cur):
+            cur.execute(
+                f"""
+                SELECT p.id, p.name, p.password, p.created_at, p.child_count,
+                       p.total_folders, p.current_id,
+                       COUNT(fi.id) AS file_count,
+                       COALESCE(SUM(fi.file_size), 0) AS total_size
+                FROM (
+                    SELECT f.id, f.name, f.password, f.created_at,
+                           (SELECT COUNT(*) FROM folders c
+                            WHERE c.parent_id = f.id AND c.deleted_at IS NULL) AS child_count,
+                           COUNT(*) OVER () AS total_folders,
+                           (SELECT u.folder_id FROM user_current_folder u
+                            WHERE u.owner_telegram_id = %s) AS current_id
+                    FROM folders f
+                    WHERE f.owner_telegram_id = %s AND f.deleted_at IS NULL
+                      AND {parent_cond}
+                    ORDER BY f.created_at DESC, f.id DESC
+                    LIMIT %s OFFSET %s
+                ) p
+                LEFT JOIN folder_tree t ON t.ancestor_id = p.id
+                LEFT JOIN files fi ON fi.folder_id = t.descendant_id AND fi.deleted_at IS NULL
+                GROUP BY p.id, p.name, p.password, p.created_at, p.child_count,
+                         p.total_folders, p.current_id
+                ORDER BY p.created_at DESC, p.id DESC
+                """,
+                (owner_id, owner_id, *parent_args, limit, offset),
+            )
+            return cur.fetchall()
+        return self._read(q, owner_id=owner_id)
+
+    def list_subtree(self, owner_id, folder_id=None):
+        """
+        Các thư mục trong cây con của folder_id (None = mọi thư mục) kèm số file / dung lượng
+        của riêng từng thư mục.
+        """
+        def q(cur):
+            if folder_id:
+                cur.execute(
+                    """
+                    SELECT f.id, f.name, COUNT(fi.id) AS file_count,
+                           COALESCE(SUM(fi.file_size), 0) AS total_size
+                    FROM folder_tree t
+                    JOIN folders f ON f.id = t.descendant_id AND f.deleted_at IS NULL
+                    LEFT JOIN files fi ON fi.folder_id = f.id AND fi.deleted_at IS NULL
+                    WHERE t.ancestor_id = %s AND f.owner_telegram_id = %s
+                    GROUP BY f.id, f.name
+                    """,
+                    (folder_id, owner_id),
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT f.id, f.name, COUNT(fi.id) AS file_count,
+                           COALESCE(SUM(fi.file_size), 0) AS total_size
+                    FROM folders f
+                    LEFT JOIN files fi ON fi.folder_id = f.id AND fi.deleted_at IS NULL
+                    WHERE f.owner_telegram_id = %s AND f.deleted_at IS NULL
+                    GROUP BY f.id, f.name
+                    """,
+                    (owner_id,),
+                )
+            return cur.fetchall()
+        return self._read(q, owner_id=owner_id)
+
+    def get_folder_by_name(self, owner_id, name):
+        def q(cur):
+            cur.execute(
+                """
+                SELECT * FROM folders
+                WHERE owner_telegram_id = %s AND name = %s AND deleted_at IS NULL
+                """,
+                (owner_id, normalize_folder_path(name)),
+            )
+            return cur.fetchone()
+        return self._read(q, owner_id=owner_id)
+
+    def get_folder_by_id(self, folder_id):
+        def q(cur):
+            cur.execute(
+                "SELECT * FROM folders WHERE id = %s AND deleted_at IS NULL",
+                (folder_id,),
+            )
+            return cur.fetchone()
+        # mật khẩu / chủ thư mục dùng để mở link của người khác: read-your-writes theo owner không che được,
+        # đọc từ replica có thể bỏ qua mật khẩu vừa đặt
+        return self._read(q, primary=True)
+
+    def get_folder_ancestor_ids(self, folder_id):
+        """
+        id của thư mục và mọi thư mục cha (qua folder_tree).
+        """
+        def q(cur):
+            cur.execute(
+                "SELECT ancestor_id FROM folder_tree WHERE descendant_id = %s",
+                (folder_id,),
+            )
+            return [r["ancestor_id"] for r in cur.fetchall()]
+        return self._read(q) or [folder_id]
+
+    def update_folder_password(self, owner_id, folder_id, password):
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                "UPDATE folders SET password = %s WHERE id = %s",
+                (password, folder_id),
+            )
+
+    # ---------- FILES ----------
+
+    def save_file(self, owner_id, folder_id, file_unique_id, file_id,
+                  file_name, file_type, file_size, mime_type, thumb_file_id=None):
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO files
+                (file_unique_id, file_id, owner_telegram_id, folder_id,
+                 file_name, name_fold, file_type, file_size, mime_type, thumb_file_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (file_unique_id) DO UPDATE SET
+                    file_id = EXCLUDED.file_id,
+                    thumb_file_id = EXCLUDED.thumb_file_id,
+                    folder_id = EXCLUDED.folder_id,
+                    file_name = EXCLUDED.file_name,
+                    name_fold = EXCLUDED.name_fold,
+                    file_type = EXCLUDED.file_type,
+                    file_size = EXCLUDED.file_size,
+                    mime_type = EXCLUDED.mime_type,
+                    created_at = CURRENT_TIMESTAMP,
+                    deleted_at = NULL
+                -- chỉ lấy lại dòng trong thùng rác của chính người gửi, không chiếm file của người khác
+                WHERE files.deleted_at IS NOT NULL
+                  AND files.owner_telegram_id = EXCLUDED.owner_telegram_id;
+                """,
+                (
+                    file_unique_id,
+                    file_id,
+                    owner_id,
+                    folder_id,
+                    file_name,
+                    fold_name(file_name),
+                    file_type,
+                    file_size,
+                    mime_type,
+                    thumb_file_id,
+                ),
+            )
+
+    def set_storage_message(self, owner_id, file_unique_id, chat_id, message_id):
+        """
+        Ghi lại bản copy của file trong kênh lưu trữ. Trả về folder_id của file (None nếu không có).
+        """
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE files SET storage_chat_id = %s, storage_message_id = %s
+                WHERE owner_telegram_id = %s AND file_unique_id = %s
+                RETURNING folder_id
+                """,
+                (chat_id, message_id, owner_id, file_unique_id),
+            )
+            row = cur.fetchone()
+        return row["folder_id"] if row else None
+
+    def get_files_of_owner(self, owner_id, folder_id=None, limit=30):
+        def q(cur):
+            if folder_id:
+                cur.execute(
+                    """
+                    SELECT * FROM files
+                    WHERE owner_telegram_id = %s AND folder_id = %s
+                      AND deleted_at IS NULL
+                    ORDER BY created_at DESC
+                    LIMIT %s
+                    """,
+                    (owner_id, folder_id, limit),
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT * FROM files
+                    WHERE owner_telegram_id = %s AND deleted_at IS NULL
+                    ORDER BY created_at DESC
+                    LIMIT %s
+                    """,
+                    (owner_id, limit),
+                )
+            return cur.fetchall()
+        return self._read(q, owner_id=owner_id)
+
+    def get_subtree_files(self, owner_id, folder_id, limit=30):
+        """
+        File mới nhất trong thư mục và mọi thư mục con – 1 truy vấn qua folder_tree.
+        """
+        def q(cur):
+            cur.execute(
+                """
+                SELECT fi.file_id, fi.file_name, fi.file_type, fi.file_size,
+                       fi.thumb_file_id, fi.storage_chat_id, fi.storage_message_id
+                FROM folder_tree t
+                JOIN files fi ON fi.folder_id = t.descendant_id
+                WHERE t.ancestor_id = %s AND fi.owner_telegram_id = %s
+                  AND fi.deleted_at IS NULL
+                ORDER BY fi.created_at DESC
+                LIMIT %s
+                """,
+                (folder_id, owner_id, limit),
+            )
+            return [ShareFile.from_row(r) for r in cur.fetchall()]
+        return self._read(q, owner_id=owner_id)
+
+    def export_summary(self, owner_id, folder_id):
+        """
+        (số file, tổng dung lượng) của thư mục và mọi thư mục con.
+        """
+        def q(cur):
+            cur.execute(
+                """
+                SELECT COUNT(*) AS n, COALESCE(SUM(fi.file_size), 0) AS size
+                FROM folder_tree t
+                JOIN files fi ON fi.folder_id = t.descendant_id
+                WHERE t.ancestor_id = %s AND fi.owner_telegram_id = %s
+                  AND fi.deleted_at IS NULL
+                """,
+                (folder_id, owner_id),
+            )
+            row = cur.fetchone()
+            return row["n"], row["size"]
+        return self._read(q, owner_id=owner_id)
+
+    def get_export_files(self, owner_id, folder_id, after_id, limit):
+        """
+        1 lô file (kèm tên thư mục chứa nó) của thư mục + thư mục con, theo id tăng dần sau after_id.
+        """
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT fi.id, fi.file_id, fi.file_name, fi.file_type, fi.file_size, fo.name AS folder_name
+                FROM folder_tree t
+                JOIN files fi ON fi.folder_id = t.descendant_id
+                JOIN folders fo ON fo.id = fi.folder_id
+                WHERE t.ancestor_id = %s AND fi.owner_telegram_id = %s
+                  AND fi.deleted_at IS NULL AND fi.id > %s
+                ORDER BY fi.id
+                LIMIT %s
+                """,
+                (folder_id, owner_id, after_id, limit),
+            )
+            return cur.fetchall()
+
+    def search_files(self, owner_id, query, limit, offset=0):
+        """
+        Tìm file theo tên (không phân biệt hoa thường, kể cả chữ có dấu), mới nhất trước.
+        """
+        pattern = "%" + (
+            fold_name(query)
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_")
+        ) + "%"
+
+        def q(cur):
+            cur.execute(
+                """
+                SELECT id, file_id, file_name, file_type, file_size
+                FROM files
+                WHERE owner_telegram_id = %s AND deleted_at IS NULL
+                  AND name_fold LIKE %s ESCAPE '\\'
+                ORDER BY created_at DESC
+                LIMIT %s OFFSET %s
+                """,
+                (owner_id, pattern, limit, offset),
+            )
+            return [FileRef.from_row(r) for r in cur.fetchall()]
+        return self._read(q, owner_id=owner_id)
+
+    # ---------- THÙNG RÁC ----------
+
+    def soft_delete_files(self, owner_id, file_ids):
+        """
+        Chuyển nhiều file vào thùng rác trong 1 câu lệnh. Trả về số file đã xoá.
+        """
+        if not file_ids:
+            return 0
+        self._note_write(owner_id)
+        marks = ", ".join(["%s"] * len(file_ids))
+        with self._cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE files SET deleted_at = %s
+                WHERE owner_telegram_id = %s AND deleted_at IS NULL
+                  AND id IN ({marks})
+                """,
+                (utc_timestamp(), owner_id, *file_ids),
+            )
+            return cur.rowcount
+
+    def soft_delete_folder(self, owner_id, name):
+        """
+        Chuyển thư mục + thư mục con + toàn bộ file trong đó vào thùng rác (1 transaction).
+        Trả về số file bị xoá theo, hoặc None nếu không có thư mục này.
+        """
+        self._note_write(owner_id)
+        now = utc_timestamp()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE folders SET deleted_at = %s
+                WHERE owner_telegram_id = %s AND name = %s AND deleted_at IS NULL
+                RETURNING id
+                """,
+                (now, owner_id, normalize_folder_path(name)),
+            )
+            row = cur.fetchone()
+            if not row:
+                return None
+            cur.execute(
+                """
+                UPDATE folders SET deleted_at = %s
+                WHERE deleted_at IS NULL
+                  AND id IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                """,
+                (now, row["id"]),
+            )
+            cur.execute(
+                """
+                UPDATE files SET deleted_at = %s
+                WHERE deleted_at IS NULL
+                  AND folder_id IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                """,
+                (now, row["id"]),
+            )
+            return cur.rowcount
+
+    def list_trash(self, owner_id, limit):
+        """
+        (thư mục, file) đang trong thùng rác, mới xoá trước.
+        File / thư mục con nằm trong thư mục đã xoá thì không liệt kê riêng.
+        """
+        def q(cur):
+            cur.execute(
+                """
+                SELECT f.id, f.name, f.deleted_at FROM folders f
+                WHERE f.owner_telegram_id = %s AND f.deleted_at IS NOT NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM folders p
+                      WHERE p.id = f.parent_id AND p.deleted_at IS NOT NULL
+                  )
+                ORDER BY f.deleted_at DESC, f.id DESC
+                LIMIT %s
+                """,
+                (owner_id, limit),
+            )
+            folders = cur.fetchall()
+            cur.execute(
+                """
+                SELECT fi.id, fi.file_name, fi.file_size, fi.deleted_at
+                FROM files fi
+                JOIN folders f ON f.id = fi.folder_id
+                WHERE fi.owner_telegram_id = %s AND fi.deleted_at IS NOT NULL
+                  AND f.deleted_at IS NULL
+                ORDER BY fi.deleted_at DESC, fi.id DESC
+                LIMIT %s
+                """,
+                (owner_id, limit),
+            )
+            return folders, cur.fetchall()
+        return self._read(q, owner_id=owner_id)
+
+    def restore_file(self, owner_id, file_id):
+        """
+        Lấy 1 file khỏi thùng rác (thư mục chứa nó và các thư mục cha cũng được lấy lại).
+        """
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE files SET deleted_at = NULL
+                WHERE id = %s AND owner_telegram_id = %s AND deleted_at IS NOT NULL
+                RETURNING folder_id
+                """,
+                (file_id, owner_id),
+            )
+            row = cur.fetchone()
+            if not row:
+                return False
+            self._restore_ancestors(cur, row["folder_id"])
+            return True
+
+    def _restore_ancestors(self, cur, folder_id):
+        cur.execute(
+            """
+            UPDATE folders SET deleted_at = NULL
+            WHERE deleted_at IS NOT NULL
+              AND id IN (SELECT ancestor_id FROM folder_tree WHERE descendant_id = %s)
+            """,
+            (folder_id,),
+        )
+
+    def restore_folder(self, owner_id, folder_id):
+        """
+        Lấy thư mục (và thư mục cha) khỏi thùng rác cùng các thư mục con / file bị xoá theo nó
+        (những thứ đã xoá riêng lẻ từ trước vẫn nằm trong thùng rác).
+        """
+        self._note_write(owner_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT deleted_at FROM folders
+                WHERE id = %s AND owner_telegram_id = %s AND deleted_at IS NOT NULL
+                """,
+                (folder_id, owner_id),
+            )
+            row = cur.fetchone()
+            if not row:
+                return False
+            self._restore_ancestors(cur, folder_id)
+            cur.execute(
+                """
+                UPDATE folders SET deleted_at = NULL
+                WHERE deleted_at >= %s
+                  AND id IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                """,
+                (row["deleted_at"], folder_id),
+            )
+            cur.execute(
+                """
+                UPDATE files SET deleted_at = NULL
+                WHERE deleted_at >= %s
+                  AND folder_id IN (SELECT descendant_id FROM folder_tree WHERE ancestor_id = %s)
+                """,
+                (row["deleted_at"], folder_id),
+            )
+            return True
+
+    def purge_deleted(self, before, batch_size):
+        """
+        Xoá hẳn tối đa batch_size file + batch_size thư mục lá rỗng đã vào thùng rác trước mốc before.
+        Mỗi lô là 1 transaction ngắn. Trả về số dòng đã xoá.
+        """
+        with self._cursor(statement_timeout=DB_MAINTENANCE_TIMEOUT_MS) as cur:
+            cur.execute(
+                """
+                SELECT id FROM files
+                WHERE deleted_at IS NOT NULL AND deleted_at < %s
+                LIMIT %s
+                """,
+                (before, batch_size),
+            )
+            file_ids = [r["id"] for r in cur.fetchall()]
+            if file_ids:
+                marks = ", ".join(["%s"] * len(file_ids))
+                cur.execute(f"DELETE FROM file_mirrors WHERE id IN ({marks})", file_ids)
+                cur.execute(f"DELETE FROM files WHERE id IN ({marks})", file_ids)
+            removed = len(file_ids)
+            # chỉ xoá thư mục lá đã rỗng; thư mục cha sẽ tới lượt ở các lô sau
+            cur.execute(
+                """
+                SELECT f.id FROM folders f
+                WHERE f.deleted_at IS NOT NULL AND f.deleted_at < %s
+                  AND NOT EXISTS (SELECT 1 FROM files fi WHERE fi.folder_id = f.id)
+                  AND NOT EXISTS (SELECT 1 FROM folders c WHERE c.parent_id = f.id)
+                LIMIT %s
+                """,
+                (before, batch_size),
+            )
+            folder_ids = [r["id"] for r in cur.fetchall()]
+            if folder_ids:
+                marks = ", ".join(["%s"] * len(folder_ids))
+                cur.execute(f"DELETE FROM folder_tree WHERE descendant_id IN ({marks})", folder_ids)
+                cur.execute(f"DELETE FROM folders WHERE id IN ({marks})", folder_ids)
+            return removed + len(folder_ids)
+
+    def expire_orphan_tokens(self, batch_size):
+        """
+        Xoá tối đa batch_size link chia sẻ (kèm thống kê) của thư mục đã bị xoá hẳn. Trả về số link đã xoá.
+        Link của thư mục còn trong thùng rác được giữ lại để khôi phục.
+        """
+        with self._cursor(statement_timeout=DB_MAINTENANCE_TIMEOUT_MS) as cur:
+            cur.execute(
+                """
+                DELETE FROM share_tokens WHERE id IN (
+                    SELECT t.id FROM share_tokens t
+                    LEFT JOIN folders f ON f.id = t.folder_id
+                    WHERE f.id IS NULL
+                    LIMIT %s
+                )
+                RETURNING token
+                """,
+                (batch_size,),
+            )
+            tokens = [r["token"] for r in cur.fetchall()]
+            if tokens:
+                marks = ", ".join(["%s"] * len(tokens))
+                cur.execute(f"DELETE FROM share_stats WHERE token IN ({marks})", tokens)
+            return len(tokens)
+
+    # ---------- SAO LƯU FILE ----------
+
+    def pending_mirrors(self, after_id, limit, max_attempts):
+        """
+        File chưa sao lưu (hoặc lỗi nhưng chưa quá số lần thử), theo id tăng dần từ sau after_id.
+        """
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT fi.id, fi.file_id, fi.file_unique_id, fi.file_name,
+                       fi.file_size, fi.owner_telegram_id
+                FROM files fi
+                LEFT JOIN file_mirrors m ON m.id = fi.id
+                WHERE fi.id > %s AND fi.deleted_at IS NULL
+                  AND (m.id IS NULL OR (m.status = 'failed' AND m.attempts < %s))
+                ORDER BY fi.id
+                LIMIT %s
+                """,
+                (after_id, max_attempts, limit),
+            )
+            return cur.fetchall()
+
+    def record_mirror(self, file_row_id, status, object_key=None, sha256=None, size=None, error=None):
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO file_mirrors
+                (id, status, object_key, sha256, size, attempts, error, updated_at)
+                VALUES (%s, %s, %s, %s, %s, 1, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (id) DO UPDATE SET
+                    status = EXCLUDED.status,
+                    object_key = EXCLUDED.object_key,
+                    sha256 = EXCLUDED.sha256,
+                    size = EXCLUDED.size,
+                    attempts = file_mirrors.attempts + 1,
+                    error = EXCLUDED.error,
+                    updated_at = EXCLUDED.updated_at
+                """,
+                (file_row_id, status, object_key, sha256, size, error),
+            )
+
+    def mirror_stats(self):
+        with self._cursor() as cur:
+            cur.execute("SELECT status, COUNT(*) AS n FROM file_mirrors GROUP BY status")
+            return {r["status"]: r["n"] for r in cur.fetchall()}
+
+    # ---------- HÀNG ĐỢI JOB ----------
+
+    @staticmethod
+    def _job_row(row):
+        if row is not None:
+            row["payload"] = json.loads(row["payload"]) if row["payload"] else {}
+        return row
+
+    def enqueue_job(self, kind, payload, priority=0, idempotency_key=None, max_attempts=JOB_MAX_ATTEMPTS):
+        """
+        Thêm job vào hàng đợi. Đã có job cùng idempotency_key thì không tạo thêm.
+        Trả về (job_id, True nếu vừa tạo).
+        """
+        now = utc_timestamp()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO jobs
+                (kind, payload, priority, max_attempts, idempotency_key, run_after, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING id
+                """,
+                (kind, json.dumps(payload, ensure_ascii=False), priority, max_attempts,
+                 idempotency_key, now, now, now),
+            )
+            row = cur.fetchone()
+            if row:
+                return row["id"], True
+            cur.execute("SELECT id FROM jobs WHERE idempotency_key = %s", (idempotency_key,))
+            return cur.fetchone()["id"], False
+
+    def claim_job(self, worker):
+        """
+        Lấy 1 job đến hạn (ưu tiên cao trước, cũ trước) và đánh dấu running. Không có thì None.
+        """
+        now = utc_timestamp()
+        with self._cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE jobs
+                SET status = 'running', attempts = attempts + 1,
+                    locked_by = %s, locked_at = %s, updated_at = %s
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued' AND run_after <= %s
+                    ORDER BY priority, id
+                    LIMIT 1
+                    {self.SKIP_LOCKED}
+                )
+                RETURNING *
+                """,
+                (worker, now, now, now),
+            )
+            return self._job_row(cur.fetchone())
+
+    def update_job_progress(self, job_id, progress, total=None, checkpoint=None):
+        """
+        Ghi tiến độ + checkpoint; đồng thời gia hạn khoá (job đang chạy thì không bị coi là treo).
+        """
+        now = utc_timestamp()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET progress = %s, total = COALESCE(%s, total), checkpoint = COALESCE(%s, checkpoint),
+                    locked_at = %s, updated_at = %s
+                WHERE id = %s
+                """,
+                (progress, total, checkpoint, now, now, job_id),
+            )
+
+    def finish_job(self, job_id, status, error=None, run_after=None):
+        """
+        Kết thúc 1 lượt chạy: status = done / failed, hoặc queued (thử lại từ run_after).
+        """
+        now = utc_timestamp()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = %s, error = %s, run_after = COALESCE(%s, run_after),
+                    locked_by = NULL, locked_at = NULL, updated_at = %s
+                WHERE id = %s
+                """,
+                (status, error, run_after, now, job_id),
+            )
+
+    def release_job(self, job_id):
+        """
+        Trả job đang chạy về hàng đợi khi tắt bot, không tính là 1 lần thử.
+        """
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = 'queued', attempts = attempts - 1, locked_by = NULL, locked_at = NULL
+                WHERE id = %s AND status = 'running'
+                """,
+                (job_id,),
+            )
+
+    def requeue_stale_jobs(self, before):
+        """
+        Job running không báo tiến độ từ trước mốc before (worker đã chết): chạy lại,
+        hoặc failed nếu đã hết lượt thử. Trả về số job được xử lý.
+        """
+        now = utc_timestamp()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                    error = 'worker dừng giữa chừng', locked_by = NULL, locked_at = NULL, updated_at = %s
+                WHERE status = 'running' AND locked_at < %s
+                """,
+                (now, before),
+            )
+            return cur.rowcount
+
+    def prune_jobs(self, before, batch_size):
+        """
+        Xoá tối đa batch_size job đã xong / lỗi hẳn trước mốc before.
+        """
+        with self._cursor(statement_timeout=DB_MAINTENANCE_TIMEOUT_MS) as cur:
+            cur.execute(
+                """
+                DELETE FROM jobs WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE status IN ('done', 'failed') AND updated_at < %s
+                    LIMIT %s
+                )
+                """,
+                (before, batch_size),
+            )
+            return cur.rowcount
+
+    def list_jobs(self, limit=10):
+        """
+        Job đang chờ / đang chạy trước, rồi tới job mới nhất.
+        """
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, kind, status, priority, attempts, max_attempts, progress, total, error, updated_at
+                FROM jobs
+                ORDER BY CASE WHEN status IN ('queued', 'running') THEN 0 ELSE 1 END, id DESC
+                LIMIT %s
+                """,
+                (limit,),
+            )
+            return cur.fetchall()
+
+    def job_stats(self):
+        with self._cursor() as cur:
+            cur.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")
+            return {r["status"]: r["n"] for r in cur.fetchall()}
+
+    # ---------- SHARE TOKENS ----------
+
+    def get_share_token(self, owner_id, folder_id):
+        with self._cursor() as cur:
+            # đã có token thì giữ token cũ
+            cur.execute(
+                """
+                INSERT INTO share_tokens (owner_telegram_id, folder_id, token)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (owner_telegram_id, folder_id) DO UPDATE SET
+                    token = share_tokens.token
+                RETURNING token;
+                """,
+                (owner_id, folder_id, secrets.token_urlsafe(8)),
+            )
+            return cur.fetchone()["token"]
+
+    def get_owner_and_folder_by_token(self, token):
+        def q(cur):
+            cur.execute(
+                """
+                SELECT t.owner_telegram_id, t.folder_id
+                FROM share_tokens t
+                JOIN folders f ON f.id = t.folder_id
+                WHERE t.token = %s AND f.deleted_at IS NULL
+                """,
+                (token,),
+            )
+            return cur.fetchone()
+        row = self._read(q, recheck_empty=True)
+        if not row:
+            return None, None
+        return row["owner_telegram_id"], row["folder_id"]
+
+    SHARE_STATS_UPSERT = """
+        INSERT INTO share_stats (token, opens, deliveries, last_access)
+        VALUES %s
+        ON CONFLICT (token) DO UPDATE SET
+            opens = share_stats.opens + EXCLUDED.opens,
+            deliveries = share_stats.deliveries + EXCLUDED.deliveries,
+            last_access = EXCLUDED.last_access
+    """
+
+    def add_share_stats(self, rows):
+        """
+        Cộng dồn thống kê link theo lô.
+        rows: [(token, số lần mở, số lần gửi file, last_access 'YYYY-MM-DD HH:MM:SS')]
+        """
+        with self._cursor() as cur:
+            cur.executemany(self.SHARE_STATS_UPSERT.replace("VALUES %s", "VALUES (%s, %s, %s, %s)"), rows)
+
+    def top_share_links(self, owner_id, limit=10):
+        def q(cur):
+            cur.execute(
+                """
+                SELECT t.token, f.name AS folder_name,
+                       COALESCE(s.opens, 0) AS opens,
+                       COALESCE(s.deliveries, 0) AS deliveries,
+                       s.last_access
+                FROM share_tokens t
+                JOIN folders f ON f.id = t.folder_id
+                LEFT JOIN share_stats s ON s.token = t.token
+                WHERE t.owner_telegram_id = %s AND f.deleted_at IS NULL
+                ORDER BY COALESCE(s.opens, 0) DESC, t.id DESC
+                LIMIT %s
+                """,
+                (owner_id, limit),
+            )
+            return cur.fetchall()
+        return self._read(q, owner_id=owner_id)
+
+    # ---------- ADS ----------
+
+    def create_ad(self, chat_id, message_id, content):
+        # lấy trước id từ sequence để ghi luôn code = qc<id> trong 1 câu lệnh
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                WITH n AS (SELECT nextval(pg_get_serial_sequence('ads', 'id')) AS id)
+                INSERT INTO ads (id, code, chat_id, message_id, content)
+                SELECT n.id, 'qc' || n.id, %s, %s, %s FROM n
+                RETURNING code;
+                """,
+                (chat_id, message_id, content),
+            )
+            return cur.fetchone()["code"]
+
+    def get_ad_by_code(self, code, chat_id):
+        with self._cursor() as cur:
+            cur.execute(
+                "SELECT * FROM ads WHERE code = %s AND chat_id = %s",
+                (code, chat_id),
+            )
+            return cur.fetchone()
+
+    def delete_ad(self, code, chat_id):
+        with self._cursor() as cur:
+            cur.execute(
+                "DELETE FROM ads WHERE code = %s AND chat_id = %s",
+                (code, chat_id),
+            )
+            return cur.rowcount > 0
+
+    def get_latest_ad(self):
+        def q(cur):
+            cur.execute("SELECT code, content FROM ads ORDER BY id DESC LIMIT 1;")
+            row = cur.fetchone()
+            return AdRef.from_row(row) if row else None
+        return self._read(q)
+
+    # ---------- WHITELIST ----------
+
+    def is_user_allowed(self, user_id):
+        def q(cur):
+            cur.execute(
+                "SELECT 1 AS ok FROM allowed_users WHERE telegram_id = %s",
+                (user_id,),
+            )
+            return cur.fetchone()
+        return self._read(q, recheck_empty=True) is not None
+
+    def get_allowed_user_ids(self):
+        def q(cur):
+            cur.execute("SELECT telegram_id FROM allowed_users")
+            return [r["telegram_id"] for r in cur.fetchall()]
+        return self._read(q)
+
+    def add_allowed_user(self, user_id, added_by):
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO allowed_users (telegram_id, added_by)
+                VALUES (%s, %s)
+                ON CONFLICT (telegram_id) DO NOTHING
+                """,
+                (user_id, added_by),
+            )
+
+    def add_allowed_users(self, user_ids, added_by):
+        """
+        Thêm nhiều user bằng các câu INSERT nhiều dòng (mỗi câu WHITELIST_SQL_CHUNK id, chung 1 transaction).
+        Trả về các id mới thêm (id đã có sẵn bị bỏ qua).
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        added = []
+        with self._cursor() as cur:
+            for i in range(0, len(user_ids), WHITELIST_SQL_CHUNK):
+                chunk = user_ids[i:i + WHITELIST_SQL_CHUNK]
+                marks = ", ".join(["(%s, %s)"] * len(chunk))
+                cur.execute(
+                    f"""
+                    INSERT INTO allowed_users (telegram_id, added_by)
+                    VALUES {marks}
+                    ON CONFLICT (telegram_id) DO NOTHING
+                    RETURNING telegram_id
+                    """,
+                    [v for user_id in chunk for v in (user_id, added_by)],
+                )
+                added.extend(r["telegram_id"] for r in cur.fetchall())
+        return added
+
+    def remove_allowed_users(self, user_ids):
+        """
+        Bỏ nhiều user khỏi whitelist (mỗi câu DELETE WHITELIST_SQL_CHUNK id, chung 1 transaction).
+        Trả về các id thật sự bị bỏ.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        removed = []
+        with self._cursor() as cur:
+            for i in range(0, len(user_ids), WHITELIST_SQL_CHUNK):
+                chunk = user_ids[i:i + WHITELIST_SQL_CHUNK]
+                marks = ", ".join(["%s"] * len(chunk))
+                cur.execute(
+                    f"DELETE FROM allowed_users WHERE telegram_id IN ({marks}) RETURNING telegram_id",
+                    chunk,
+                )
+                removed.extend(r["telegram_id"] for r in cur.fetchall())
+        return removed
+
+    def list_allowed_users_page(self, limit, offset=0):
+        """
+        1 trang whitelist (mới thêm trước) kèm tên user nếu đã từng /start và tổng số (total).
+        """
+        def q(cur):
+            cur.execute(
+                """
+                SELECT a.telegram_id, a.created_at, u.full_name, u.username,
+                       COUNT(*) OVER () AS total
+                FROM allowed_users a
+                LEFT JOIN users u ON u.telegram_id = a.telegram_id
+                ORDER BY a.id DESC
+                LIMIT %s OFFSET %s
+                """,
+                (limit, offset),
+            )
+            return cur.fetchall()
+        return self._read(q)
+
+
+class _CountingPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool đếm số kết nối đã mở tới DB (psycopg2 mở mọi kết nối qua _connect).
+    """
+
+    opened = 0
+
+    def _connect(self, key=None):
+        self.opened += 1
+        return super()._connect(key)
+
+
+class PgPool:
+    """
+    Pool kết nối Postgres dùng chung cho mọi bot trong tiến trình.
+    Mỗi bot dùng schema riêng: search_path chỉ được đặt lại khi kết nối lấy ra
+    đang trỏ sang schema khác. Hết kết nối thì chờ, không báo lỗi.
+    minconn = maxconn: kết nối trả về được giữ lại, không bị đóng rồi mở lại mỗi lần dùng.
+    """
+
+    def __init__(self, dsn, maxconn):
+        self._pool = _CountingPool(
+            maxconn, maxconn, dsn,
+            cursor_factory=psycopg2.extras.RealDictCursor,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # kết nối -> schema đang đặt trong search_path. Khoá bằng chính kết nối, không dùng id(conn):
+        # kết nối mới có thể trùng id với kết nối đã đóng và bỏ qua SET search_path (đọc nhầm schema bot khác)
+        self._schema_of = {}
+
+    def getconn(self, schema):
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise PoolTimeout(f"Không có kết nối rảnh sau {DB_POOL_TIMEOUT:g}s")
+        try:
+            conn = self._pool.getconn()
+            if self._schema_of.get(conn) != schema:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        sql.SQL("SET search_path TO {}").format(sql.Identifier(schema))
+                    )
+                conn.commit()
+                self._schema_of[conn] = schema
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            if conn.closed:
+                # pool đã bỏ kết nối này (hỏng / transaction lỗi)
+                self._schema_of.pop(conn, None)
+            self._slots.release()
+
+    @property
+    def opened(self) -> int:
+        """
+        Số kết nối đã mở từ lúc tạo pool: maxconn lúc khởi động + số lần mở lại kết nối hỏng.
+        """
+        return self._pool.opened
+
+    def closeall(self):
+        self._pool.closeall()
+        self._schema_of.clear()
+
+
+PG_POOL = None
+PG_REPLICA_POOL = None
+
+
+def shared_pg_pools():
+    """
+    Tạo (1 lần) pool primary và pool replica dùng chung.
+    """
+    global PG_POOL, PG_REPLICA_POOL
+    if PG_POOL is None:
+        PG_POOL = PgPool(DATABASE_URL, DB_POOL_SIZE)
+    if DATABASE_REPLICA_URL and PG_REPLICA_POOL is None:
+        PG_REPLICA_POOL = PgPool(DATABASE_REPLICA_URL, DB_POOL_SIZE)
+    return PG_POOL, PG_REPLICA_POOL
+
+
+def close_shared_pg_pools():
+    """
+    Đóng pool Postgres dùng chung (primary + replica) khi tắt bot.
+    """
+    for pool in (PG_POOL, PG_REPLICA_POOL):
+        if pool:
+            pool.closeall()
+
+
+# sự kiện vô hiệu cache gửi qua NOTIFY mang id tiến trình: CacheListener bỏ qua sự kiện của chính mình
+PROCESS_ID = secrets.token_hex(6)
+
+
+class PostgresStorage(Storage):
+    """
+    Backend PostgreSQL (Railway: DATABASE_URL).
+    Kết nối lấy từ pool dùng chung; mỗi bot (tenant) có 1 schema riêng.
+    """
+
+    name = "PostgreSQL"
+
+    def __init__(self, pool, replica_pool=None, schema="public", tenant="default"):
+        self.pool = pool
+        self.replica_pool = replica_pool
+        self.schema = schema
+        self.tenant = tenant
+        # owner_id -> thời điểm (monotonic) ghi gần nhất, để đọc lại từ primary
+        self._recent_writes = {}
+
+    def _connect(self):
+        return self.pool.getconn(self.schema)
+
+    def _release(self, conn):
+        self.pool.putconn(conn)
+
+    def init_schema(self):
+        if self.schema != "public":
+            with self._cursor() as cur:
+                cur.execute(
+                    sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(self.schema))
+                )
+        super().init_schema()
+
+    def _note_write(self, owner_id):
+        if self.replica_pool is None or owner_id is None:
+            return
+        now = time.monotonic()
+        self._recent_writes[owner_id] = now
+        if len(self._recent_writes) > 10000:
+            cutoff = now - REPLICA_RYW_SECONDS
+            for oid in [o for o, t in self._recent_writes.items() if t < cutoff]:
+                self._recent_writes.pop(oid, None)
+
+    def _wrote_recently(self, owner_id):
+        if owner_id is None:
+            return False
+        t = self._recent_writes.get(owner_id)
+        return t is not None and time.monotonic() - t < REPLICA_RYW_SECONDS
+
+    def _read(self, query_fn, owner_id=None, recheck_empty=False, primary=False):
+        if primary or self.replica_pool is None or self._wrote_recently(owner_id):
+            return super()._read(query_fn)
+
+        try:
+            conn = self.replica_pool.getconn(self.schema)
+            try:
+                result = query_fn(conn.cursor())
+                conn.rollback()
+            finally:
+                self.replica_pool.putconn(conn)
+        except (psycopg2.Error, DatabaseUnavailable) as e:
+            # gồm cả PoolTimeout của pool replica
+            logger.warning("Replica lỗi, đọc lại từ primary: %s", e)
+            return super()._read(query_fn)
+
+        if recheck_empty and not result:
+            return super()._read(query_fn)
+        return result
+
+    def publish_invalidation(self, event):
+        """
+        NOTIFY cho tiến trình khác (nhận khi transaction commit). Lỗi thì chỉ log:
+        dữ liệu đã ghi xong, cache bên kia vẫn tự hết hạn theo TTL.
+        """
+        if not CACHE_NOTIFY:
+            return
+        event = dict(event, o=PROCESS_ID, ts=time.time())
+        ids = event["ids"]
+        chunks = [ids[i:i + CACHE_NOTIFY_IDS] for i in range(0, len(ids), CACHE_NOTIFY_IDS)] or [[]]
+        try:
+            with self._cursor() as cur:
+                for chunk in chunks:
+                    cur.execute(
+                        "SELECT pg_notify(%s, %s)",
+                        (CACHE_CHANNEL, json.dumps(dict(event, ids=chunk))),
+                    )
+        except DB_DOWN_ERRORS as e:
+            logger.warning("Không NOTIFY được sự kiện cache %s: %s", event["k"], e)
+
+    def _set_name_folds(self, cur, rows):
+        psycopg2.extras.execute_values(
+            cur,
+            "UPDATE files SET name_fold = v.fold FROM (VALUES %s) AS v(fold, id) WHERE files.id = v.id",
+            rows, page_size=1000,
+        )
+
+    def add_share_stats(self, rows):
+        # cả lô trong 1 câu lệnh
+        with self._cursor() as cur:
+            psycopg2.extras.execute_values(cur, self.SHARE_STATS_UPSERT, rows, page_size=500)
+
+    def _add_column(self, cur, table, column, decl):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {decl};")
+
+    def analyze_hot_tables(self, min_changes):
+        """
+        ANALYZE các bảng nóng đã đổi >= min_changes dòng kể từ lần ANALYZE trước
+        (vd sau nhập hàng loạt, khi autovacuum chưa kịp). Trả về tên các bảng đã ANALYZE.
+        """
+        with self._cursor(statement_timeout=DB_MAINTENANCE_TIMEOUT_MS) as cur:
+            cur.execute(
+                """
+                SELECT relname FROM pg_stat_user_tables
+                WHERE schemaname = %s AND relname IN %s AND n_mod_since_analyze >= %s
+                """,
+                (self.schema, self.HOT_TABLES, min_changes),
+            )
+            tables = [r["relname"] for r in cur.fetchall()]
+            for table in tables:
+                cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        return tables
+
+
+class _SqliteCursor(sqlite3.Cursor):
+    """
+    Cursor SQLite nhận SQL viết theo placeholder %s (giống psycopg2).
+    """
+
+    def execute(self, sql, params=()):
+        return super().execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql, seq_of_params):
+        return super().executemany(sql.replace("%s", "?"), seq_of_params)
+
+
+def _sqlite_dict_row(cursor, row):
+    return {col[0]: value for col, value in zip(cursor.description, row)}
+
+
+class SqliteStorage(Storage):
+    """
+    Backend SQLite nhúng (file DB_PATH), bật WAL.
+    Hợp cho deploy 1 máy: không tốn round trip mạng tới DB.
+    Giữ 1 kết nối cho cả tiến trình, khoá lại khi dùng từ nhiều thread.
+    """
+
+    name = "SQLite"
+    PK = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    SKIP_LOCKED = ""  # 1 kết nối + khoá ghi của SQLite đã đủ để 2 worker không lấy trùng job
+
+    def __init__(self, path, tenant="default"):
+        self.path = path
+        self.tenant = tenant
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.row_factory = _sqlite_dict_row
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+
+    @contextmanager
+    def _cursor(self, statement_timeout=None):
+        # DB cục bộ: không có statement timeout, chờ khoá tối đa `timeout` của sqlite3.connect
+        with DB_BREAKER.guard(), self._lock:
+            cur = self._conn.cursor(_SqliteCursor)
+            try:
+                yield cur
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def create_ad(self, chat_id, message_id, content):
+        # SQLite không có sequence: id kế tiếp của AUTOINCREMENT nằm trong sqlite_sequence
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO ads (id, code, chat_id, message_id, content)
+                SELECT n.id, 'qc' || n.id, %s, %s, %s
+                FROM (
+                    SELECT COALESCE(
+                        (SELECT seq FROM sqlite_sequence WHERE name = 'ads'), 0
+                    ) + 1 AS id
+                ) AS n
+                RETURNING code;
+                """,
+                (chat_id, message_id, content),
+            )
+            return cur.fetchone()["code"]
+
+    def analyze_hot_tables(self, min_changes):
+        # SQLite tự chọn bảng cần ANALYZE lại (thống kê cũ / chưa có)
+        with self._cursor() as cur:
+            cur.execute("PRAGMA optimize;")
+        return []
+
+    def _add_column(self, cur, table, column, decl):
+        cur.execute(f"PRAGMA table_info({table});")
+        if any(r["name"] == column for r in cur.fetchall()):
+            return
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
+
+    def close(self):
+        self._conn.close()
+
+
+# Storage của bot chính; các bot phụ nằm trong STORES (tenant -> Storage)
+STORE = None
+STORES = {}
+# Storage của bot đang xử lý update hiện tại (đặt bởi bind_store)
+CURRENT_STORE = contextvars.ContextVar("current_store", default=None)
+
+
+def open_storage(tenant="default", primary=True):
+    """
+    Có DATABASE_URL → PostgreSQL (bot chính: schema public, bot phụ: schema bot_<id>),
+    không có → SQLite (bot chính: DB_PATH, bot phụ: file <DB_PATH>_<id>).
+    """
+    if DATABASE_URL:
+        pool, replica_pool = shared_pg_pools()
+        schema = "public" if primary else f"bot_{tenant}"
+        return PostgresStorage(pool, replica_pool, schema=schema, tenant=tenant)
+
+    path = DB_PATH
+    if not primary:
+        root, ext = os.path.splitext(DB_PATH)
+        path = f"{root}_{tenant}{ext or '.db'}"
+    return SqliteStorage(path, tenant=tenant)
+
+
+def db() -> Storage:
+    store = CURRENT_STORE.get() or STORE
+    if store is None:
+        raise RuntimeError("❌ Chưa khởi tạo database (gọi init_db() trước).")
+    return store
+
+
+def init_db(tenant="default", primary=True) -> Storage:
+    global STORE
+    if primary:
+        if STORE is None:
+            STORE = open_storage(tenant, primary=True)
+        store = STORE
+    else:
+        store = open_storage(tenant, primary=False)
+    store.init_schema()
+    STORES[store.tenant] = store
+    return store
@@ -0,0 +1,92 @@
+import itertools
+import os
+import sys
+import types
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import jobs  # noqa: E402
+import main  # noqa: E402
+import storage  # noqa: E402
+
+BACKENDS = ["sqlite", "postgres"]
+
+
+def reset_state():
+    """
+    Bỏ mọi cache / trạng thái trong RAM của main giữa các test.
+    """
+    for cache in (main.INLINE_CACHE, main.WHITELIST_CACHE, main.LATEST_AD_CACHE, main.SHARE_PLANS):
+        cache.clear()
+    main.CONTENT_VERSIONS.clear()
+    jobs.JOB_WAKEUP.clear()
+    storage.DB_BREAKER.failures = 0
+    storage.DB_BREAKER.opened_at = None
+
+
+class FakeBot:
+    """
+    Bot giả: ghi lại mọi lời gọi Bot API (tên hàm, tham số) thay vì gửi lên Telegram.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._ids = itertools.count(1)
+
+    def sent(self, method):
+        return [kw for name, kw in self.calls if name == method]
+
+    def __getattr__(self, method):
+        async def call(*args, **kwargs):
+            self.calls.append((method, kwargs))
+            return types.SimpleNamespace(message_id=next(self._ids))
+        return call
+
+
+def open_postgres(schema=None):
+    """
+    PostgresStorage trên 1 schema riêng (xoá ở drop_postgres) – các test không đụng dữ liệu của nhau.
+    """
+    pool = storage.PgPool(os.environ["DATABASE_URL"], 4)
+    store = storage.PostgresStorage(pool, schema=schema or f"test_{uuid.uuid4().hex[:12]}")
+    store.init_schema()
+    return store
+
+
+def drop_postgres(store):
+    with store._cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{store.schema}" CASCADE')
+    store.pool.closeall()
+
+
+@pytest.fixture(params=BACKENDS)
+def store(request, tmp_path):
+    """
+    Storage rỗng đã init_schema, đặt làm STORE của main: SQLite luôn chạy,
+    Postgres chỉ khi có DATABASE_URL.
+    """
+    if request.param == "postgres":
+        if not os.getenv("DATABASE_URL"):
+            pytest.skip("cần DATABASE_URL để chạy với PostgreSQL")
+        s = open_postgres()
+    else:
+        s = storage.SqliteStorage(str(tmp_path / "bot.db"))
+        s.init_schema()
+
+    old = storage.STORE
+    storage.STORE = s
+    storage.STORES[s.tenant] = s
+    reset_state()
+    try:
+        yield s
+    finally:
+        storage.STORE = old
+        reset_state()
+        if request.param == "postgres":
+            drop_postgres(s)
+        else:
+            s.close()
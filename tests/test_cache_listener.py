@@ -0,0 +1,95 @@
+"""
+Vô hiệu cache giữa các tiến trình (chỉ Postgres): tiến trình con ghi DB + NOTIFY,
+CacheListener ở tiến trình test nhận và bỏ cache của mình.
+"""
+
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+import main
+import storage
+from conftest import ROOT, drop_postgres, open_postgres, reset_state
+
+pytestmark = pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="cần DATABASE_URL (PostgreSQL)")
+
+# tiến trình bot khác dùng chung database: cấp quyền user 42, đăng QC mới, sửa thư mục 7
+WRITER = """
+import sys
+import main
+import storage
+
+dsn, schema, channel = sys.argv[1:]
+storage.CACHE_CHANNEL = channel
+storage.STORE = storage.PostgresStorage(storage.PgPool(dsn, 1), schema=schema)
+main.add_allowed_user(42, 1)
+main.create_ad(1, 1, "QC mới")
+main.touch_folders([7])
+"""
+
+
+@pytest.fixture
+def store():
+    s = open_postgres()
+    old = storage.STORE
+    storage.STORE = s
+    reset_state()
+    try:
+        yield s
+    finally:
+        storage.STORE = old
+        reset_state()
+        drop_postgres(s)
+
+
+async def wait_for(check, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+def test_write_in_other_process_evicts_cache(store):
+    dsn = os.environ["DATABASE_URL"]
+    channel = f"test_cache_{uuid.uuid4().hex[:8]}"
+
+    # cache của tiến trình này: chưa ai được cấp quyền, chưa có QC
+    assert main.is_user_allowed(42) is False
+    assert main.get_latest_ad() is None
+    version = main.content_version(1, 7)
+
+    async def scenario():
+        listener = main.CacheListener(dsn, channel=channel)
+        task = asyncio.create_task(listener.run())
+        try:
+            assert await wait_for(lambda: listener.conn is not None)
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", WRITER, dsn, store.schema, channel, cwd=ROOT,
+            )
+            assert await proc.wait() == 0
+            assert await wait_for(lambda: listener.received >= 3)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+    # TTL của cache còn dài: chỉ nhờ sự kiện từ tiến trình kia mới thấy dữ liệu mới
+    assert main.is_user_allowed(42) is True
+    assert main.get_latest_ad()["content"] == "QC mới"
+    assert main.content_version(1, 7) != version
+
+
+def test_own_events_are_ignored(store):
+    assert main.is_user_allowed(5) is False
+    listener = main.CacheListener(os.environ["DATABASE_URL"])
+    listener._handle('{"t": "default", "k": "allow", "ids": [5], "o": "%s"}' % storage.PROCESS_ID)
+    listener._handle("không phải json")
+    assert listener.received == 0
+    assert main.WHITELIST_CACHE.get(store.tenant) == set()
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import storage
+
+
+def fail(breaker, exc):
+    with pytest.raises(type(exc)):
+        with breaker.guard():
+            raise exc
+
+
+def test_trips_after_threshold_and_rejects():
+    b = storage.CircuitBreaker(3, 60)
+    for _ in range(3):
+        fail(b, psycopg2.OperationalError("mất kết nối"))
+    assert b.state == "open" and b.trips == 1
+    with pytest.raises(storage.DatabaseUnavailable):
+        with b.guard():
+            pytest.fail("không được chạy khi breaker mở")
+
+
+def test_success_resets_failures():
+    b = storage.CircuitBreaker(2, 60)
+    fail(b, psycopg2.OperationalError("x"))
+    with b.guard():
+        pass
+    fail(b, psycopg2.OperationalError("x"))
+    assert b.state == "closed"
+
+
+def test_pool_timeout_and_programming_errors_do_not_count():
+    b = storage.CircuitBreaker(1, 60)
+    fail(b, storage.PoolTimeout("hết kết nối rảnh"))
+    fail(b, sqlite3.OperationalError("no such table: khong_co"))
+    fail(b, sqlite3.OperationalError("near \"SELEC\": syntax error"))
+    fail(b, psycopg2.IntegrityError("trùng khoá"))
+    assert b.state == "closed" and b.failures == 0
+
+    fail(b, sqlite3.OperationalError("database is locked"))
+    assert b.state == "open"
+
+
+def test_half_open_admits_single_probe():
+    b = storage.CircuitBreaker(1, 0.05)
+    fail(b, psycopg2.OperationalError("x"))
+    time.sleep(0.06)
+    assert b.state == "half-open"
+
+    inside = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def probe():
+        with b.guard():
+            inside.set()
+            release.wait(5)
+        results.append("probe ok")
+
+    t = threading.Thread(target=probe)
+    t.start()
+    assert inside.wait(5)
+    # trong lúc truy vấn thử đang chạy, các truy vấn khác bị từ chối
+    for _ in range(3):
+        with pytest.raises(storage.DatabaseUnavailable):
+            with b.guard():
+                results.append("lọt qua")
+    release.set()
+    t.join()
+    assert results == ["probe ok"]
+    assert b.state == "closed"
+
+
+def test_failed_probe_reopens():
+    b = storage.CircuitBreaker(1, 0.05)
+    fail(b, psycopg2.OperationalError("x"))
+    time.sleep(0.06)
+    fail(b, psycopg2.OperationalError("vẫn lỗi"))
+    assert b.state == "open"
+    time.sleep(0.06)
+    # lượt thử lỗi không làm kẹt: chu kỳ sau vẫn được thử tiếp
+    with b.guard():
+        pass
+    assert b.state == "closed"
+
+
+def test_probe_ending_in_pool_timeout_frees_the_slot():
+    b = storage.CircuitBreaker(1, 0.05)
+    fail(b, psycopg2.OperationalError("x"))
+    time.sleep(0.06)
+    fail(b, storage.PoolTimeout("hết kết nối"))
+    assert b.state == "half-open"
+    with b.guard():
+        pass
+    assert b.state == "closed"
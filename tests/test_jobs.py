@@ -0,0 +1,118 @@
+"""
+Hàng đợi job: claim → chạy handler → thử lại / xong, và checkpoint khi chạy lại giữa chừng.
+"""
+
+import asyncio
+import time
+import types
+
+import pytest
+
+import jobs
+import main
+import storage
+from conftest import FakeBot
+
+
+class Crash(BaseException):
+    """
+    Tiến trình chết giữa chừng (không phải lỗi handler nên run_job không bắt).
+    """
+
+
+class CrashingBot(FakeBot):
+    def __init__(self, crash_after):
+        super().__init__()
+        self.crash_after = crash_after
+
+    async def send_message(self, **kwargs):
+        if len(self.sent("send_message")) == self.crash_after:
+            raise Crash()
+        self.calls.append(("send_message", kwargs))
+        return types.SimpleNamespace(message_id=1)
+
+
+def add_users(store, ids):
+    for uid in ids:
+        store.get_or_create_user(types.SimpleNamespace(id=uid, full_name="U", username=None))
+
+
+def future(seconds=3600):
+    return storage.utc_timestamp(time.time() + seconds)
+
+
+def test_broadcast_resumes_after_crash_without_duplicates(store, monkeypatch):
+    monkeypatch.setattr(main, "JOB_BATCH_SIZE", 4)
+    monkeypatch.setattr(main, "BROADCAST_CHECKPOINT_EVERY", 3)
+    monkeypatch.setattr(main, "BROADCAST_CHECKPOINT_SECONDS", 3600)
+    users = list(range(101, 111))
+    owner = 105
+    add_users(store, users)
+    store.enqueue_job("broadcast_ad", {"owner_chat_id": owner, "text": "QC", "code": "AD1"})
+
+    bot = CrashingBot(crash_after=6)  # chết giữa lô thứ 2
+    job = store.claim_job("w1")
+    with pytest.raises(Crash):
+        asyncio.run(jobs.run_job(bot, store, job))
+    first = [kw["chat_id"] for kw in bot.sent("send_message")]
+    assert first == [101, 102, 103, 104, 106, 107]
+    assert len(bot.sent("pin_chat_message")) == 6
+
+    # worker chết: job bị coi là treo, đưa lại vào hàng đợi rồi chạy tiếp từ checkpoint
+    assert store.requeue_stale_jobs(future()) == 1
+    job = store.claim_job("w2")
+    # checkpoint cuối sau 6 user (106): 107 gửi rồi nhưng chưa lưu → gửi lại, trùng < BROADCAST_CHECKPOINT_EVERY
+    assert job["checkpoint"] == "106" and job["progress"] == 6 and job["attempts"] == 2
+    bot = FakeBot()
+    asyncio.run(jobs.run_job(bot, store, job))
+    second = [kw["chat_id"] for kw in bot.sent("send_message")]
+    assert second == [107, 108, 109, 110, owner]  # user từ checkpoint + báo kết quả cho owner
+    assert "10 user" in bot.sent("send_message")[-1]["text"]
+    assert store.job_stats() == {"done": 1}
+
+
+def test_failed_job_is_retried_with_backoff_then_fails(store, monkeypatch):
+    runs = []
+
+    async def flaky(bot, store, job):
+        runs.append(job["attempts"])
+        raise RuntimeError("GET https://api.telegram.org/file/bot123456:ABCDEFGHIJKLMNOPQRSTUVWXYZ/x lỗi")
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, "flaky", flaky)
+    monkeypatch.setattr(jobs, "JOB_RETRY_BASE_SECONDS", 0)
+    job_id, _ = store.enqueue_job("flaky", {}, max_attempts=2)
+
+    asyncio.run(jobs.run_job(FakeBot(), store, store.claim_job("w")))
+    row = next(j for j in store.list_jobs() if j["id"] == job_id)
+    assert row["status"] == "queued"
+    # lỗi ghi vào DB đã che URL / token bot
+    assert "ABCDEFGHIJ" not in row["error"] and "<url>" in row["error"]
+
+    asyncio.run(jobs.run_job(FakeBot(), store, store.claim_job("w")))
+    assert runs == [1, 2]
+    assert store.job_stats() == {"failed": 1}
+    assert store.claim_job("w") is None
+
+
+def test_unknown_kind_fails_and_success_marks_done(store, monkeypatch):
+    async def ok(bot, store, job):
+        store.update_job_progress(job["id"], 1, 1)
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, "ok", ok)
+    store.enqueue_job("khong_co", {}, max_attempts=1)
+    store.enqueue_job("ok", {})
+    for _ in range(2):
+        asyncio.run(jobs.run_job(FakeBot(), store, store.claim_job("w")))
+    assert store.job_stats() == {"done": 1, "failed": 1}
+
+
+def test_cancelled_job_returns_to_queue(store, monkeypatch):
+    async def slow(bot, store, job):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, "slow", slow)
+    store.enqueue_job("slow", {})
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(jobs.run_job(FakeBot(), store, store.claim_job("w")))
+    job = store.claim_job("w")
+    assert job["kind"] == "slow" and job["attempts"] == 1
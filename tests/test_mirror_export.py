@@ -0,0 +1,218 @@
+"""
+Sao lưu file (mirror) và /export zip, chạy với Bot API giả: server HTTP local trả nội dung file
+theo URL .../file/bot<TOKEN>/<file_id> giống api.telegram.org.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import os
+import threading
+import types
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from telegram.error import BadRequest
+
+import jobs
+import main
+import mirror
+import storage
+from conftest import FakeBot
+
+TOKEN = "123456789:AAHfakeTokenForTestsOnly_abcdefghij"
+FILES = {f"fid{i}": os.urandom(1000 + i) for i in range(1, 6)}
+
+
+class Crash(BaseException):
+    pass
+
+
+@pytest.fixture(scope="module")
+def bot_api():
+    """
+    URL gốc của Bot API giả; file_id không có trong FILES → 404.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            prefix = f"/file/bot{TOKEN}/"
+            data = FILES.get(self.path[len(prefix):]) if self.path.startswith(prefix) else None
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+class FileBot(FakeBot):
+    def __init__(self, base_url, crash_on_part=None):
+        super().__init__()
+        self.base_url = base_url
+        self.crash_on_part = crash_on_part
+        self.documents = []
+        self.reports = []  # các lần sửa tin tiến độ /export
+
+    async def get_file(self, file_id, **kwargs):
+        if file_id == "gone":
+            raise BadRequest("Wrong file_id specified")
+        return types.SimpleNamespace(file_path=f"{self.base_url}/file/bot{TOKEN}/{file_id}")
+
+    async def edit_message_text(self, text, **kwargs):
+        self.reports.append(text)
+
+    async def send_document(self, **kwargs):
+        if len(self.documents) + 1 == self.crash_on_part:
+            raise Crash()
+        # như thư viện: document là file đã seek(0), đọc lúc gửi (sau đó bot đóng file)
+        self.documents.append({**kwargs, "document": kwargs["document"].read()})
+        return types.SimpleNamespace(message_id=len(self.documents))
+
+
+def add_file(store, folder_id, file_id, size=None, name=None, ftype="photo"):
+    size = len(FILES[file_id]) if size is None else size
+    store.save_file(1, folder_id, f"uq-{file_id}", file_id, name or f"{file_id}.jpg", ftype, size, "image/jpeg")
+
+
+def mirror_rows(store):
+    with store._cursor() as cur:
+        cur.execute(
+            """
+            SELECT fi.file_id, m.status, m.object_key, m.sha256, m.size, m.error
+            FROM file_mirrors m JOIN files fi ON fi.id = m.id
+            """
+        )
+        return {r["file_id"]: r for r in cur.fetchall()}
+
+
+# ---------- SAO LƯU ----------
+
+def test_mirror_streams_files_and_hides_token(store, bot_api, tmp_path, caplog):
+    folder = store.create_or_get_folder(1, "A")
+    for fid in ("fid1", "fid2"):
+        add_file(store, folder["id"], fid)
+    add_file(store, folder["id"], "missing", size=10)
+    add_file(store, folder["id"], "fid3", size=main.TELEGRAM_DOWNLOAD_LIMIT + 1)
+    sink = mirror.LocalMirror(str(tmp_path))
+
+    assert asyncio.run(mirror.mirror_pending(FileBot(bot_api), store, sink)) == 4
+    rows = mirror_rows(store)
+    for fid in ("fid1", "fid2"):
+        assert rows[fid]["status"] == "done"
+        assert rows[fid]["sha256"] == hashlib.sha256(FILES[fid]).hexdigest()
+        with open(tmp_path / rows[fid]["object_key"], "rb") as fh:
+            assert fh.read() == FILES[fid]
+    assert rows["fid3"]["status"] == "skipped"
+    assert rows["missing"]["status"] == "failed"
+    assert "HTTP 404" in rows["missing"]["error"]
+    # token bot (nằm trong URL tải file) không được ghi vào DB lẫn log
+    assert TOKEN not in rows["missing"]["error"] and TOKEN not in caplog.text
+    assert os.listdir(sink.tmp_dir) == []
+
+    # lần sau chỉ thử lại file lỗi
+    FILES["missing"] = b"da co"
+    try:
+        assert asyncio.run(mirror.mirror_pending(FileBot(bot_api), store, sink)) == 1
+    finally:
+        del FILES["missing"]
+    assert mirror_rows(store)["missing"]["status"] == "done"
+    assert asyncio.run(mirror.mirror_pending(FileBot(bot_api), store, sink)) == 0
+
+
+def test_download_error_message_is_redacted(bot_api):
+    async def download():
+        async with mirror.httpx.AsyncClient() as client:
+            tg_file = types.SimpleNamespace(file_path=f"{bot_api}/file/bot{TOKEN}/khong-co")
+            async for _ in mirror.stream_telegram_file(client, tg_file):
+                pass
+
+    with pytest.raises(mirror.DownloadError) as err:
+        asyncio.run(download())
+    assert str(err.value) == "HTTPStatusError: HTTP 404"
+    assert err.value.__cause__ is None and err.value.__suppress_context__
+
+    e = RuntimeError(f"GET https://api.telegram.org/file/bot{TOKEN}/x bị lỗi; token {TOKEN}")
+    assert TOKEN not in mirror.safe_error(e)
+
+
+# ---------- /EXPORT ----------
+
+def export_job(store, folder):
+    store.enqueue_job("export_folder", {
+        "owner_id": 1, "folder_id": folder["id"], "folder_name": folder["name"],
+        "chat_id": 1, "message_id": 1,
+    })
+    return store.claim_job("w")
+
+
+def zip_members(documents):
+    out = {}
+    for doc in documents:
+        with zipfile.ZipFile(io.BytesIO(doc["document"])) as zf:
+            for name in zf.namelist():
+                assert name not in out
+                out[name] = zf.read(name)
+    return out
+
+
+def test_export_splits_parts_and_skips_unavailable(store, bot_api, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_PART_SIZE", 3000)
+    a = store.create_or_get_folder(1, "A")
+    ab = store.create_or_get_folder(1, "A/B")
+    for fid in ("fid1", "fid2", "fid3"):
+        add_file(store, a["id"], fid)
+    add_file(store, ab["id"], "fid4")
+    add_file(store, a["id"], "gone", size=10, name="mat.jpg")
+    add_file(store, a["id"], "fid5", size=main.TELEGRAM_DOWNLOAD_LIMIT + 1, name="to.mp4")
+
+    bot = FileBot(bot_api)
+    asyncio.run(jobs.run_job(bot, store, export_job(store, a)))
+
+    assert len(bot.documents) == 2  # mỗi phần tối đa 2 file ~1KB
+    assert [d["filename"] for d in bot.documents] == ["A-1.zip", "A-2.zip"]
+    assert all(len(d["document"]) <= 3000 for d in bot.documents)
+    assert zip_members(bot.documents) == {
+        "fid1.jpg": FILES["fid1"], "fid2.jpg": FILES["fid2"],
+        "fid3.jpg": FILES["fid3"], "B/fid4.jpg": FILES["fid4"],
+    }
+    summary = bot.reports[-1]
+    assert "4 file trong 2 file zip" in summary
+    assert "Bỏ qua 2 file" in summary and "mat.jpg" in summary and "to.mp4" in summary
+    assert store.job_stats() == {"done": 1}
+
+
+def test_export_resumes_from_last_sent_part(store, bot_api, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_PART_SIZE", 2600)
+    a = store.create_or_get_folder(1, "A")
+    for fid in FILES:
+        add_file(store, a["id"], fid)
+
+    bot = FileBot(bot_api, crash_on_part=2)
+    job = export_job(store, a)
+    with pytest.raises(Crash):
+        asyncio.run(jobs.run_job(bot, store, job))
+    assert len(bot.documents) == 1
+
+    assert store.requeue_stale_jobs(storage.utc_timestamp(2 ** 31)) == 1
+    job = store.claim_job("w2")
+    assert json.loads(job["checkpoint"])["parts"] == 1
+    again = FileBot(bot_api)
+    asyncio.run(jobs.run_job(again, store, job))
+
+    assert [d["filename"] for d in again.documents] == ["A-2.zip", "A-3.zip"]
+    # không file nào bị nén lại ở lần chạy sau
+    assert zip_members(bot.documents + again.documents) == {f"{fid}.jpg": data for fid, data in FILES.items()}
@@ -0,0 +1,52 @@
+"""
+Kiểu dòng gọn cho cache (record_type) và bàn phím dựng sẵn dùng chung.
+"""
+
+import pickle
+import sys
+
+import pytest
+
+import main
+import storage
+
+
+def test_record_reads_like_row_and_tuple():
+    row = {"id": 3, "file_id": "F", "file_name": "a.jpg", "file_type": "photo", "file_size": 10, "thừa": "x"}
+    ref = storage.FileRef.from_row(row)
+    assert ref["file_name"] == "a.jpg" and ref.file_name == "a.jpg"
+    assert ref[0] == 3 and ref[1:3] == ("F", "a.jpg")
+    assert tuple(ref) == (3, "F", "a.jpg", "photo", 10)
+    with pytest.raises(AttributeError):
+        ref["thừa"]
+    with pytest.raises(AttributeError):
+        ref.file_name = "b"
+
+
+def test_record_has_no_per_row_dict():
+    ref = storage.AdRef("qc1", "nội dung")
+    assert not hasattr(ref, "__dict__")
+    with pytest.raises(AttributeError):
+        ref.extra = 1
+    assert sys.getsizeof(ref) < sys.getsizeof({"code": "qc1", "content": "nội dung"})
+    assert pickle.loads(pickle.dumps(ref)) == ref
+
+
+def test_storage_returns_records(store):
+    folder = store.create_or_get_folder(1, "A")
+    store.save_file(1, folder["id"], "uq1", "fid1", "Ảnh.jpg", "photo", 5, "image/jpeg")
+    store.create_ad(1, 1, "QC")
+
+    found = store.search_files(1, "ảnh", 10)
+    assert [type(f) for f in found] == [storage.FileRef] and found[0].file_id == "fid1"
+    shared = store.get_subtree_files(1, folder["id"])
+    assert isinstance(shared[0], storage.ShareFile) and shared[0]["storage_message_id"] is None
+    ad = main.load_latest_ad()
+    assert isinstance(ad, storage.AdRef) and ad.content == "QC"
+    assert main.get_latest_ad() is ad
+
+
+def test_main_keyboard_is_shared():
+    assert main.get_main_keyboard() is main.get_main_keyboard() is main.MAIN_KEYBOARD
+    with pytest.raises(AttributeError):
+        main.MAIN_KEYBOARD.resize_keyboard = False
@@ -0,0 +1,78 @@
+"""
+Đọc từ replica (chỉ Postgres): replica giả là 1 schema khác, không bao giờ được đồng bộ = replica trễ vô hạn.
+"""
+
+import os
+
+import psycopg2
+import pytest
+
+import storage
+from conftest import drop_postgres, open_postgres, reset_state
+
+pytestmark = pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="cần DATABASE_URL (PostgreSQL)")
+
+
+class LaggingReplica:
+    """
+    Pool "replica": mọi kết nối trỏ vào schema của 1 storage khác (dữ liệu cũ).
+    """
+
+    def __init__(self, stale):
+        self.stale = stale
+
+    def getconn(self, schema):
+        return self.stale.pool.getconn(self.stale.schema)
+
+    def putconn(self, conn):
+        self.stale.pool.putconn(conn)
+
+
+class BrokenReplica:
+    def __init__(self, error):
+        self.error = error
+
+    def getconn(self, schema):
+        raise self.error
+
+    def putconn(self, conn):
+        pass
+
+
+@pytest.fixture
+def stores():
+    primary = open_postgres()
+    stale = open_postgres()
+    reset_state()
+    try:
+        yield primary, stale
+    finally:
+        drop_postgres(primary)
+        drop_postgres(stale)
+
+
+def test_folder_password_read_from_primary(stores):
+    primary, stale = stores
+    folder = primary.create_or_get_folder(1, "A")
+    primary.replica_pool = LaggingReplica(stale)
+    primary.update_folder_password(1, folder["id"], "pw")
+
+    # người mở link không phải chủ thư mục: vẫn phải thấy mật khẩu vừa đặt
+    assert primary.get_folder_by_id(folder["id"])["password"] == "pw"
+    # chủ thư mục vừa ghi → đọc từ primary
+    assert [f["password"] for f in primary.list_folders(1)] == ["pw"]
+    # user khác chưa ghi gì → đọc replica (trễ, chưa có thư mục nào)
+    assert primary.list_folders(2) == []
+
+
+@pytest.mark.parametrize("error", [
+    psycopg2.OperationalError("replica không kết nối được"),
+    storage.PoolTimeout("replica hết kết nối"),
+])
+def test_broken_replica_falls_back_to_primary(stores, error):
+    primary, _ = stores
+    primary.create_or_get_folder(1, "A")
+    primary.replica_pool = BrokenReplica(error)
+    primary._recent_writes.clear()
+    assert [f["name"] for f in primary.list_folders(1)] == ["A"]
+    assert storage.DB_BREAKER.state == "closed"
@@ -0,0 +1,141 @@
+"""
+Cache kế hoạch gửi link chia sẻ (SHARE_PLANS): link nóng không truy vấn DB,
+mọi thay đổi nội dung / mật khẩu / xoá đều làm dựng lại.
+"""
+
+import asyncio
+import types
+
+import psycopg2
+import pytest
+
+import main
+from conftest import FakeBot
+import storage
+
+
+def add_file(owner, folder_id, n, ftype="photo"):
+    main.save_file(owner, folder_id, f"uq{n}", f"fid{n}", f"file{n}.jpg", ftype, 10, "image/jpeg")
+
+
+def album_ids(plan):
+    return sorted(m.media for kind, batch in plan.steps if kind == "album" for m in batch)
+
+
+@pytest.fixture
+def queries(store, monkeypatch):
+    """
+    Đếm số lần mở cursor tới DB.
+    """
+    calls = []
+    cursor = store._cursor
+
+    def counting(*args, **kwargs):
+        calls.append(1)
+        return cursor(*args, **kwargs)
+
+    monkeypatch.setattr(store, "_cursor", counting)
+    return calls
+
+
+@pytest.fixture
+def shared(store):
+    folder = main.create_or_get_folder(1, "A")
+    add_file(1, folder["id"], 1)
+    add_file(1, folder["id"], 2, ftype="video")
+    return folder, main.get_share_token(1, folder["id"])
+
+
+def test_hot_link_served_without_db(shared, queries):
+    _, token = shared
+    plan = main.get_share_plan(token)
+    assert album_ids(plan) == ["fid1", "fid2"]
+    built = len(queries)
+    assert built > 0
+
+    for _ in range(50):
+        assert main.get_share_plan(token) is plan
+    assert len(queries) == built
+
+
+def test_new_file_in_subfolder_rebuilds_parent_plan(shared):
+    folder, token = shared
+    plan = main.get_share_plan(token)
+    sub = main.create_or_get_folder(1, "A/B")
+    add_file(1, sub["id"], 3)
+
+    again = main.get_share_plan(token)
+    assert again is not plan
+    assert album_ids(again) == ["fid1", "fid2", "fid3"]
+    assert main.get_share_plan(token) is again
+
+
+def test_password_change_and_delete_rebuild(shared):
+    folder, token = shared
+    assert main.get_share_plan(token).password is None
+
+    main.update_folder_password(1, folder["id"], "pw")
+    assert main.get_share_plan(token).password == "pw"
+
+    main.soft_delete_folder(1, "A")
+    assert main.get_share_plan(token) is None
+    assert main.get_share_plan("khong-co-token") is None
+
+
+def test_other_folder_changes_keep_plan(shared):
+    _, token = shared
+    plan = main.get_share_plan(token)
+    other = main.create_or_get_folder(1, "C")
+    add_file(1, other["id"], 9)
+    assert main.get_share_plan(token) is plan
+
+
+def test_stale_plan_used_while_db_down(shared, monkeypatch):
+    _, token = shared
+    plan = main.get_share_plan(token)
+    key = (storage.db().tenant, token)
+    main.SHARE_PLANS.set(key, plan, ttl=-1)  # đã hết TTL
+
+    def down(token):
+        raise psycopg2.OperationalError("mất kết nối")
+
+    monkeypatch.setattr(main, "get_owner_and_folder_by_token", down)
+    assert main.get_share_plan(token) is plan
+
+    # nội dung đã đổi thì không gửi bản cũ (có thể vừa đặt mật khẩu)
+    main.SHARE_PLANS.set(key, plan, ttl=-1)
+    main.touch_folders([plan.folder_id])
+    with pytest.raises(psycopg2.OperationalError):
+        main.get_share_plan(token)
+
+
+def test_preview_keyboard_built_once(shared):
+    _, token = shared
+    plan = main.get_share_plan(token)
+    plan.pages = [[], []]
+    plan.previews = [(None, "photo")] * 7
+    markup = main.preview_keyboard(token, plan)
+    assert main.preview_keyboard(token, plan) is markup
+    buttons = [b.callback_data for row in markup.inline_keyboard for b in row]
+    assert buttons == [f"pv:{token}:0", f"pv:{token}:1", f"pv:{token}:all"]
+
+
+class CallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.message = types.SimpleNamespace(chat_id=7)
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+@pytest.mark.parametrize("suffix", ["", ":", ":x", ":-1", ":1.5"])
+def test_preview_callback_rejects_bad_data(shared, suffix):
+    _, token = shared
+    query = CallbackQuery(f"pv:{token}{suffix}")
+    update = types.SimpleNamespace(callback_query=query, effective_user=types.SimpleNamespace(id=7))
+    bot = FakeBot()
+    asyncio.run(main.preview_callback(update, types.SimpleNamespace(bot=bot)))
+    assert len(query.answers) == 1 and "không hợp lệ" in query.answers[0]
+    assert bot.calls == []
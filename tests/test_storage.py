@@ -0,0 +1,521 @@
+"""
+Bộ kiểm tra chung cho mọi backend Storage: cùng 1 test chạy trên SQLite và (khi có DATABASE_URL) PostgreSQL.
+"""
+
+import sqlite3
+import time
+import types
+
+import pytest
+
+import main
+import storage
+
+
+def tg_user(uid, name="User"):
+    return types.SimpleNamespace(id=uid, full_name=name, username=f"u{uid}")
+
+
+def subtree_names(store, owner, folder_id):
+    return {f["name"] for f in store.list_subtree(owner, folder_id)}
+
+
+def add_file(store, owner, folder_id, n, name=None, ftype="photo", size=10):
+    store.save_file(owner, folder_id, f"uq{n}", f"fid{n}", name or f"file{n}.jpg", ftype, size, "image/jpeg")
+    rows = [f for f in store.get_files_of_owner(owner, limit=1000) if f["file_unique_id"] == f"uq{n}"]
+    return rows[0] if rows else None
+
+
+def past(seconds=3600):
+    return storage.utc_timestamp(time.time() - seconds)
+
+
+def future(seconds=3600):
+    return storage.utc_timestamp(time.time() + seconds)
+
+
+# ---------- USERS ----------
+
+def test_users(store):
+    u = store.get_or_create_user(tg_user(5, "A"))
+    assert u["telegram_id"] == 5
+    again = store.get_or_create_user(tg_user(5, "B"))
+    assert again["id"] == u["id"] and again["full_name"] == "B"
+    for uid in (3, 9, 7):
+        store.get_or_create_user(tg_user(uid))
+
+    assert sorted(store.get_all_user_ids()) == [3, 5, 7, 9]
+    assert store.count_users() == 4
+    assert store.get_user_ids_after(0, 2) == [3, 5]
+    assert store.get_user_ids_after(5, 10) == [7, 9]
+    assert store.get_user_ids_after(9, 10) == []
+
+
+# ---------- FOLDERS ----------
+
+def test_create_folder_path_builds_tree(store):
+    c = store.create_or_get_folder(1, " A / B/ C ")
+    assert c["name"] == "A/B/C"
+    a = store.get_folder_by_name(1, "A")
+    b = store.get_folder_by_name(1, "A/B")
+    assert b["parent_id"] == a["id"] and c["parent_id"] == b["id"]
+    assert a["parent_id"] is None
+    assert subtree_names(store, 1, a["id"]) == {"A", "A/B", "A/B/C"}
+    assert sorted(store.get_folder_ancestor_ids(c["id"])) == sorted([a["id"], b["id"], c["id"]])
+    assert store.create_or_get_folder(1, "A/B/C")["id"] == c["id"]
+    # thư mục cùng tên của user khác là thư mục khác
+    assert store.create_or_get_folder(2, "A")["id"] != a["id"]
+
+
+def test_get_folder_by_id_and_password(store):
+    f = store.create_or_get_folder(1, "P")
+    assert store.get_folder_by_id(f["id"])["password"] is None
+    store.update_folder_password(1, f["id"], "secret")
+    assert store.get_folder_by_id(f["id"])["password"] == "secret"
+    store.update_folder_password(1, f["id"], None)
+    assert store.get_folder_by_id(f["id"])["password"] is None
+    assert store.get_folder_by_id(999999) is None
+    assert store.get_folder_ancestor_ids(999999) == [999999]
+
+
+def test_current_folder(store):
+    assert store.get_current_folder(1) is None
+    a = store.create_or_get_folder(1, "A")
+    b = store.create_or_get_folder(1, "B")
+    store.set_current_folder(1, a["id"])
+    assert store.get_current_folder(1)["id"] == a["id"]
+    store.set_current_folder(1, b["id"])
+    assert store.get_current_folder(1)["id"] == b["id"]
+    store.soft_delete_folder(1, "B")
+    assert store.get_current_folder(1) is None
+
+
+def test_list_folders_and_pages(store):
+    a = store.create_or_get_folder(1, "A")
+    ab = store.create_or_get_folder(1, "A/B")
+    store.create_or_get_folder(1, "C")
+    store.create_or_get_folder(2, "X")
+    add_file(store, 1, a["id"], 1, size=5)
+    add_file(store, 1, ab["id"], 2, size=7)
+    store.set_current_folder(1, ab["id"])
+
+    assert {f["name"] for f in store.list_folders(1)} == {"A", "A/B", "C"}
+
+    roots = store.list_folders_page(1, 10)
+    assert {f["name"] for f in roots} == {"A", "C"}
+    row = next(f for f in roots if f["name"] == "A")
+    assert row["file_count"] == 2 and row["total_size"] == 12
+    assert row["child_count"] == 1 and row["total_folders"] == 2
+    assert row["current_id"] == ab["id"]
+    assert len(store.list_folders_page(1, 1)) == 1
+    assert len(store.list_folders_page(1, 1, offset=1)) == 1
+    assert store.list_folders_page(3, 10) == []
+    children = store.list_folders_page(1, 10, parent_id=a["id"])
+    assert [f["name"] for f in children] == ["A/B"]
+
+    subtree = {f["name"]: f for f in store.list_subtree(1, a["id"])}
+    assert set(subtree) == {"A", "A/B"}
+    assert subtree["A"]["file_count"] == 1 and subtree["A/B"]["total_size"] == 7
+    assert {f["name"] for f in store.list_subtree(1)} == {"A", "A/B", "C"}
+
+
+def test_move_folder(store):
+    store.create_or_get_folder(1, "A/B/C")
+    store.create_or_get_folder(1, "X")
+    moved = store.move_folder(1, "A/B", "X/Y")
+    assert moved["name"] == "X/Y"
+    x = store.get_folder_by_name(1, "X")
+    assert moved["parent_id"] == x["id"]
+    c = store.get_folder_by_name(1, "X/Y/C")
+    assert c is not None and store.get_folder_by_name(1, "A/B/C") is None
+    assert subtree_names(store, 1, x["id"]) == {"X", "X/Y", "X/Y/C"}
+    assert x["id"] in store.get_folder_ancestor_ids(c["id"])
+    assert subtree_names(store, 1, store.get_folder_by_name(1, "A")["id"]) == {"A"}
+
+    assert store.move_folder(1, "khong-co", "Z") is None
+    with pytest.raises(ValueError):
+        store.move_folder(1, "X", "X/Y/Z")
+    with pytest.raises(ValueError):
+        store.move_folder(1, "A", "X")
+
+
+def legacy_folder(store, owner, name):
+    """
+    Thư mục tạo trước khi có thư mục lồng nhau: tên "A/B" nhưng là thư mục gốc, chưa có trong cây.
+    """
+    with store._cursor() as cur:
+        cur.execute(
+            "INSERT INTO folders (owner_telegram_id, name) VALUES (%s, %s) RETURNING id",
+            (owner, name),
+        )
+        return cur.fetchone()["id"]
+
+
+def test_legacy_flat_folder_linked_on_create(store):
+    ab = legacy_folder(store, 1, "A/B")
+    folder = store.create_or_get_folder(1, "A/B")
+    a = store.get_folder_by_name(1, "A")
+    assert folder["id"] == ab and folder["parent_id"] == a["id"]
+    assert subtree_names(store, 1, a["id"]) == {"A", "A/B"}
+    assert a["id"] in store.get_folder_ancestor_ids(ab)
+
+
+def test_legacy_flat_folders_backfilled(store):
+    abc = legacy_folder(store, 1, "A/B/C")
+    ab = legacy_folder(store, 1, "A/B")
+    odd = legacy_folder(store, 1, "A//D")
+    add_file(store, 1, abc, 1)
+    store.init_schema()
+
+    a = store.get_folder_by_name(1, "A")
+    assert store.get_folder_by_name(1, "A/B")["parent_id"] == a["id"]
+    assert store.get_folder_by_name(1, "A/B/C")["parent_id"] == ab
+    assert set(store.get_folder_ancestor_ids(abc)) == {a["id"], ab, abc}
+    assert store.get_folder_by_id(odd)["parent_id"] is None
+
+    # /mvfolder A mang theo cả các thư mục cũ
+    store.move_folder(1, "A", "X")
+    assert store.get_folder_by_name(1, "A/B") is None
+    assert store.get_folder_by_name(1, "X/B/C")["id"] == abc
+    assert [f["file_unique_id"] for f in store.get_files_of_owner(1, folder_id=abc)] == ["uq1"]
+    assert store.get_folder_by_id(odd)["name"] == "A//D"
+
+
+# ---------- FILES ----------
+
+def test_save_file_and_listing(store):
+    a = store.create_or_get_folder(1, "A")
+    ab = store.create_or_get_folder(1, "A/B")
+    add_file(store, 1, a["id"], 1)
+    add_file(store, 1, ab["id"], 2, ftype="video")
+    # lưu lại cùng file_unique_id: không tạo dòng mới
+    add_file(store, 1, a["id"], 1)
+
+    assert len(store.get_files_of_owner(1)) == 2
+    assert [f["file_unique_id"] for f in store.get_files_of_owner(1, folder_id=a["id"])] == ["uq1"]
+    assert len(store.get_files_of_owner(1, limit=1)) == 1
+    assert store.get_files_of_owner(2) == []
+
+    subtree = store.get_subtree_files(1, a["id"])
+    assert {f.file_id for f in subtree} == {"fid1", "fid2"}
+    assert isinstance(subtree[0], storage.ShareFile)
+    assert store.get_subtree_files(1, ab["id"])[0]["file_type"] == "video"
+    assert store.get_subtree_files(2, a["id"]) == []
+
+
+def test_storage_message(store):
+    a = store.create_or_get_folder(1, "A")
+    add_file(store, 1, a["id"], 1)
+    assert store.set_storage_message(1, "uq1", -100, 42) == a["id"]
+    assert store.get_subtree_files(1, a["id"])[0].storage_message_id == 42
+    assert store.set_storage_message(2, "uq1", -100, 43) is None
+
+
+def test_export_summary_and_batches(store):
+    a = store.create_or_get_folder(1, "A")
+    ab = store.create_or_get_folder(1, "A/B")
+    for n in range(5):
+        add_file(store, 1, a["id"] if n % 2 else ab["id"], n, size=100)
+    assert store.export_summary(1, a["id"]) == (5, 500)
+    assert store.export_summary(1, ab["id"]) == (3, 300)
+
+    first = store.get_export_files(1, a["id"], 0, 3)
+    assert len(first) == 3 and [f["id"] for f in first] == sorted(f["id"] for f in first)
+    rest = store.get_export_files(1, a["id"], first[-1]["id"], 3)
+    assert len(rest) == 2
+    assert {f["folder_name"] for f in first + rest} == {"A", "A/B"}
+
+
+def test_search_files(store):
+    a = store.create_or_get_folder(1, "A")
+    add_file(store, 1, a["id"], 1, name="Ảnh Đẹp.jpg")
+    add_file(store, 1, a["id"], 2, name="bao_cao 100%.pdf", ftype="document")
+    add_file(store, 1, a["id"], 3, name="baoXcao.pdf", ftype="document")
+    add_file(store, 2, a["id"], 4, name="Ảnh khác.jpg")
+
+    def names(q):
+        return sorted(f.file_name for f in store.search_files(1, q, 10))
+
+    for q in ("ảnh", "Ảnh", "ĐẸP", "đẹp", "ảnh đẹp"):
+        assert names(q) == ["Ảnh Đẹp.jpg"], q
+    # _ và % là ký tự thường, không phải wildcard
+    assert names("o_c") == ["bao_cao 100%.pdf"]
+    assert names("100%") == ["bao_cao 100%.pdf"]
+    assert len(names("")) == 3
+    assert isinstance(store.search_files(1, "", 1)[0], storage.FileRef)
+    assert len(store.search_files(1, "", 2, offset=2)) == 1
+
+
+# ---------- THÙNG RÁC ----------
+
+def test_soft_delete_and_restore_files(store):
+    a = store.create_or_get_folder(1, "A")
+    f1 = add_file(store, 1, a["id"], 1)
+    f2 = add_file(store, 1, a["id"], 2)
+    assert store.soft_delete_files(1, []) == 0
+    assert store.soft_delete_files(2, [f1["id"]]) == 0
+    assert store.soft_delete_files(1, [f1["id"], f2["id"]]) == 2
+    assert store.get_files_of_owner(1) == []
+    assert store.search_files(1, "", 10) == []
+
+    folders, files = store.list_trash(1, 10)
+    assert folders == [] and {f["id"] for f in files} == {f1["id"], f2["id"]}
+
+    assert store.restore_file(1, f1["id"]) is True
+    assert store.restore_file(1, f1["id"]) is False
+    assert [f["id"] for f in store.get_files_of_owner(1)] == [f1["id"]]
+
+    # gửi lại file đang trong thùng rác → lấy lại dòng cũ
+    add_file(store, 1, a["id"], 2)
+    assert len(store.get_files_of_owner(1)) == 2 and store.list_trash(1, 10) == ([], [])
+
+
+def test_resave_does_not_take_other_owners_trashed_file(store):
+    a = store.create_or_get_folder(1, "A")
+    b = store.create_or_get_folder(2, "B")
+    f1 = add_file(store, 1, a["id"], 1)
+    store.soft_delete_files(1, [f1["id"]])
+
+    store.save_file(2, b["id"], "uq1", "fid1", "file1.jpg", "photo", 10, "image/jpeg")
+    assert store.get_files_of_owner(2) == []
+    assert [f["id"] for f in store.list_trash(1, 10)[1]] == [f1["id"]]
+    assert store.restore_file(1, f1["id"]) is True
+    assert [f["folder_id"] for f in store.get_files_of_owner(1)] == [a["id"]]
+
+
+def test_soft_delete_and_restore_folder(store):
+    a = store.create_or_get_folder(1, "A")
+    ab = store.create_or_get_folder(1, "A/B")
+    add_file(store, 1, a["id"], 1)
+    add_file(store, 1, ab["id"], 2)
+    f0 = add_file(store, 1, a["id"], 0)
+    store.soft_delete_files(1, [f0["id"]])
+    with store._cursor() as cur:
+        # xoá riêng từ trước khi xoá thư mục (deleted_at chỉ chính xác tới giây)
+        cur.execute("UPDATE files SET deleted_at = %s WHERE id = %s", (past(), f0["id"]))
+    assert store.soft_delete_folder(1, "khong-co") is None
+    assert store.soft_delete_folder(1, "A") == 2
+    assert store.list_folders(1) == [] and store.get_files_of_owner(1) == []
+
+    folders, files = store.list_trash(1, 10)
+    # chỉ liệt kê thư mục gốc bị xoá, không liệt kê riêng thư mục con / file trong nó
+    assert [f["id"] for f in folders] == [a["id"]] and files == []
+
+    assert store.restore_folder(1, a["id"]) is True
+    assert store.restore_folder(1, a["id"]) is False
+    assert len(store.list_folders(1)) == 2 and len(store.get_files_of_owner(1)) == 2
+    # file đã xoá riêng từ trước vẫn nằm trong thùng rác
+    assert [f["id"] for f in store.list_trash(1, 10)[1]] == [f0["id"]]
+
+    # khôi phục 1 file trong thư mục đã xoá → lấy lại cả thư mục cha
+    f3 = add_file(store, 1, ab["id"], 3)
+    store.soft_delete_folder(1, "A")
+    assert store.restore_file(1, f3["id"]) is True
+    assert store.get_folder_by_id(ab["id"]) is not None and store.get_folder_by_id(a["id"]) is not None
+
+
+def test_purge_and_orphan_tokens(store):
+    a = store.create_or_get_folder(1, "A")
+    f1 = add_file(store, 1, a["id"], 1)
+    token = store.get_share_token(1, a["id"])
+    store.add_share_stats([(token, 1, 1, storage.utc_timestamp())])
+    store.record_mirror(f1["id"], "done", "k", "s", 1)
+    store.soft_delete_folder(1, "A")
+
+    # còn trong hạn giữ thùng rác: không xoá gì
+    assert store.purge_deleted(past(), 100) == 0
+    assert store.expire_orphan_tokens(100) == 0
+    assert store.purge_deleted(future(), 100) == 2  # 1 file + 1 thư mục
+    assert store.purge_deleted(future(), 100) == 0
+    assert store.list_trash(1, 10) == ([], [])
+    assert store.mirror_stats() == {}
+
+    assert store.expire_orphan_tokens(100) == 1
+    assert store.get_owner_and_folder_by_token(token) == (None, None)
+    assert store.top_share_links(1) == []
+
+
+# ---------- SAO LƯU FILE ----------
+
+def test_mirrors(store):
+    a = store.create_or_get_folder(1, "A")
+    f1 = add_file(store, 1, a["id"], 1)
+    f2 = add_file(store, 1, a["id"], 2)
+    assert [f["id"] for f in store.pending_mirrors(0, 10, 3)] == [f1["id"], f2["id"]]
+    assert [f["id"] for f in store.pending_mirrors(f1["id"], 10, 3)] == [f2["id"]]
+
+    store.record_mirror(f1["id"], "done", "key", "sha", 10)
+    store.record_mirror(f2["id"], "failed", error="lỗi")
+    assert [f["id"] for f in store.pending_mirrors(0, 10, 3)] == [f2["id"]]
+    store.record_mirror(f2["id"], "failed", error="lỗi")
+    store.record_mirror(f2["id"], "failed", error="lỗi")
+    assert store.pending_mirrors(0, 10, 3) == []
+    assert store.mirror_stats() == {"done": 1, "failed": 1}
+
+
+# ---------- HÀNG ĐỢI JOB ----------
+
+def test_job_lifecycle(store):
+    job_id, created = store.enqueue_job("k", {"x": "ả"}, idempotency_key="key1")
+    assert created
+    assert store.enqueue_job("k", {"x": 2}, idempotency_key="key1") == (job_id, False)
+    low, _ = store.enqueue_job("k", {}, priority=10)
+
+    job = store.claim_job("w1")
+    assert job["id"] == job_id and job["payload"] == {"x": "ả"}
+    assert job["status"] == "running" and job["attempts"] == 1 and job["locked_by"] == "w1"
+    assert store.claim_job("w2")["id"] == low
+    assert store.claim_job("w3") is None
+
+    store.update_job_progress(job_id, 3, total=10, checkpoint="c1")
+    store.update_job_progress(job_id, 4)
+    row = next(j for j in store.list_jobs() if j["id"] == job_id)
+    assert (row["progress"], row["total"]) == (4, 10)
+
+    # lỗi → chờ run_after rồi mới được lấy lại, checkpoint giữ nguyên
+    store.finish_job(job_id, "queued", "lỗi", future())
+    assert store.claim_job("w1") is None
+    store.finish_job(job_id, "queued", "lỗi", past())
+    again = store.claim_job("w1")
+    assert again["id"] == job_id and again["attempts"] == 2 and again["checkpoint"] == "c1"
+
+    store.release_job(job_id)
+    assert store.claim_job("w1")["attempts"] == 2
+
+    store.finish_job(job_id, "done")
+    store.finish_job(low, "failed", "hết lượt")
+    assert store.job_stats() == {"done": 1, "failed": 1}
+    assert store.prune_jobs(past(), 10) == 0
+    assert store.prune_jobs(future(), 10) == 2
+    assert store.list_jobs() == []
+
+
+def test_requeue_stale_jobs(store):
+    job_id, _ = store.enqueue_job("k", {}, max_attempts=2)
+    store.claim_job("w")
+    assert store.requeue_stale_jobs(past()) == 0
+    assert store.requeue_stale_jobs(future()) == 1
+    assert store.job_stats() == {"queued": 1}
+    store.claim_job("w")
+    assert store.requeue_stale_jobs(future()) == 1
+    assert store.job_stats() == {"failed": 1}
+
+
+# ---------- LINK CHIA SẺ ----------
+
+def test_share_tokens_and_stats(store):
+    a = store.create_or_get_folder(1, "A")
+    b = store.create_or_get_folder(1, "B")
+    ta = store.get_share_token(1, a["id"])
+    assert store.get_share_token(1, a["id"]) == ta
+    tb = store.get_share_token(1, b["id"])
+    assert ta != tb
+    assert store.get_owner_and_folder_by_token(ta) == (1, a["id"])
+    assert store.get_owner_and_folder_by_token("khong-co") == (None, None)
+
+    store.add_share_stats([(tb, 2, 1, storage.utc_timestamp()), (ta, 1, 0, storage.utc_timestamp())])
+    store.add_share_stats([(tb, 3, 1, storage.utc_timestamp())])
+    top = store.top_share_links(1)
+    assert [(r["token"], r["opens"], r["deliveries"]) for r in top] == [(tb, 5, 2), (ta, 1, 0)]
+    assert top[0]["folder_name"] == "B"
+
+    store.soft_delete_folder(1, "A")
+    assert store.get_owner_and_folder_by_token(ta) == (None, None)
+
+
+def test_share_stats_write_behind(store, monkeypatch):
+    a = store.create_or_get_folder(1, "A")
+    token = store.get_share_token(1, a["id"])
+    for _ in range(3):
+        main.record_share_event(token, opened=1)
+    main.record_share_event(token, delivered=1)
+    assert store.top_share_links(1)[0]["opens"] == 0
+
+    def down(rows):
+        raise RuntimeError("DB lỗi")
+
+    # ghi lỗi: bộ đếm được cộng trả lại, lần sau ghi tiếp
+    monkeypatch.setattr(store, "add_share_stats", down)
+    with pytest.raises(RuntimeError):
+        main.flush_share_stats(store)
+    monkeypatch.undo()
+    main.record_share_event(token, opened=1)
+    assert main.flush_share_stats(store) == 1
+    assert main.flush_share_stats(store) == 0
+    row = store.top_share_links(1)[0]
+    assert (row["opens"], row["deliveries"]) == (4, 1)
+
+
+# ---------- QUẢNG CÁO ----------
+
+def test_ads(store):
+    assert store.get_latest_ad() is None
+    c1 = store.create_ad(10, 100, "QC 1")
+    c2 = store.create_ad(10, 101, "QC 2")
+    assert c1 != c2 and c1.startswith("qc") and c2.startswith("qc")
+    latest = store.get_latest_ad()
+    assert isinstance(latest, storage.AdRef) and (latest.code, latest["content"]) == (c2, "QC 2")
+
+    assert store.get_ad_by_code(c1, 10)["message_id"] == 100
+    assert store.get_ad_by_code(c1, 11) is None
+    assert store.delete_ad(c1, 11) is False
+    assert store.delete_ad(c2, 10) is True
+    assert store.get_latest_ad().code == c1
+
+
+# ---------- WHITELIST ----------
+
+def test_whitelist(store):
+    assert not store.is_user_allowed(1)
+    store.add_allowed_user(1, 99)
+    store.add_allowed_user(1, 99)
+    assert store.is_user_allowed(1)
+    assert not store.is_user_allowed(2)
+
+    assert sorted(store.add_allowed_users([2, 3, 1], 99)) == [2, 3]
+    assert store.add_allowed_users([], 99) == []
+    assert sorted(store.get_allowed_user_ids()) == [1, 2, 3]
+
+    assert sorted(store.remove_allowed_users([3, 4])) == [3]
+    assert store.remove_allowed_users([]) == []
+    assert not store.is_user_allowed(3)
+
+    store.get_or_create_user(tg_user(2, "Hai"))
+    page = store.list_allowed_users_page(1)
+    assert len(page) == 1 and page[0]["total"] == 2
+    rows = {r["telegram_id"]: r for r in store.list_allowed_users_page(10)}
+    assert rows[2]["full_name"] == "Hai" and rows[1]["full_name"] is None
+    assert store.list_allowed_users_page(10, offset=2) == []
+
+
+def test_bulk_whitelist_many_rows(store):
+    if isinstance(store, storage.SqliteStorage):
+        # giới hạn tham số của SQLite trước 3.32
+        store._conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    ids = list(range(1000, 1000 + main.WHITELIST_BULK_MAX))
+    assert len(store.add_allowed_users(ids, 1)) == len(ids)
+    assert len(store.remove_allowed_users(ids)) == len(ids)
+
+
+# ---------- BẢO TRÌ / SCHEMA ----------
+
+def test_init_schema_is_idempotent(store):
+    a = store.create_or_get_folder(1, "A")
+    add_file(store, 1, a["id"], 1, name="Ảnh.jpg")
+    store.init_schema()
+    assert store.search_files(1, "ảnh", 10)[0].file_name == "Ảnh.jpg"
+
+
+def test_name_fold_backfill(store):
+    a = store.create_or_get_folder(1, "A")
+    add_file(store, 1, a["id"], 1, name="Đà Lạt.jpg")
+    with store._cursor() as cur:
+        cur.execute("UPDATE files SET name_fold = NULL")
+    store.init_schema()
+    assert [f.file_name for f in store.search_files(1, "đà lạt", 10)] == ["Đà Lạt.jpg"]
+
+
+def test_analyze_and_notify(store):
+    assert isinstance(store.analyze_hot_tables(0), list)
+    # không có ai LISTEN vẫn không lỗi
+    store.publish_invalidation({"t": store.tenant, "k": "folders", "ids": [1, 2]})
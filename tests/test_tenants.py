@@ -0,0 +1,104 @@
+"""
+Nhiều bot trong 1 tiến trình: mỗi bot 1 Storage riêng (schema Postgres / file SQLite),
+db() trả về Storage của bot đang xử lý update.
+"""
+
+import os
+import random
+import threading
+import uuid
+
+import pytest
+
+import main
+import storage
+
+
+def test_db_follows_current_store(tmp_path, monkeypatch):
+    a = storage.SqliteStorage(str(tmp_path / "a.db"), tenant="a")
+    b = storage.SqliteStorage(str(tmp_path / "b.db"), tenant="b")
+    monkeypatch.setattr(storage, "STORE", a)
+    try:
+        assert storage.db() is a and main.state_key(5) == ("a", 5)
+        token = storage.CURRENT_STORE.set(b)
+        try:
+            assert storage.db() is b and main.state_key(5) == ("b", 5)
+        finally:
+            storage.CURRENT_STORE.reset(token)
+        assert storage.db() is a
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="cần DATABASE_URL (PostgreSQL)")
+def test_schemas_on_shared_pool_are_isolated():
+    pool = storage.PgPool(os.environ["DATABASE_URL"], 2)
+    a, b = (
+        storage.PostgresStorage(pool, schema=f"test_{uuid.uuid4().hex[:12]}", tenant=t)
+        for t in ("a", "b")
+    )
+    try:
+        for s in (a, b):
+            s.init_schema()
+        # xen kẽ 2 bot trên cùng các kết nối của pool
+        for i in range(10):
+            a.add_allowed_user(i, 0)
+            b.create_or_get_folder(i, "B")
+            assert not b.is_user_allowed(i)
+            assert a.list_folders(i) == []
+        assert a.is_user_allowed(9) and [f["name"] for f in b.list_folders(9)] == ["B"]
+    finally:
+        for s in (a, b):
+            with s._cursor() as cur:
+                cur.execute(f'DROP SCHEMA IF EXISTS "{s.schema}" CASCADE')
+        pool.closeall()
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="cần DATABASE_URL (PostgreSQL)")
+def test_concurrent_checkouts_use_own_schema():
+    # mỗi luồng giữ tối đa 2 kết nối: pool đủ cho cả 3 luồng, không luồng nào phải chờ nhau
+    pool = storage.PgPool(os.environ["DATABASE_URL"], 6)
+    stores = [
+        storage.PostgresStorage(pool, schema=f"test_{uuid.uuid4().hex[:12]}", tenant=f"t{i}")
+        for i in range(3)
+    ]
+    wrong, errors = [], []
+
+    def check(s, cur):
+        cur.execute("SELECT current_schema() AS schema")
+        got = cur.fetchone()["schema"]
+        if got != s.schema:
+            wrong.append((s.schema, got))
+
+    def worker(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(50):
+                # giữ 2 kết nối cùng lúc (2 bot khác nhau) rồi trả cả 2 về pool
+                a, b = rng.sample(stores, 2)
+                with a._cursor() as cur_a, b._cursor() as cur_b:
+                    check(a, cur_a)
+                    check(b, cur_b)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        for s in stores:
+            s.init_schema()
+        # 1 kết nối bị đóng giữa chừng: pool bỏ nó, kết nối mở thay phải đặt lại search_path
+        conn = pool.getconn(stores[0].schema)
+        conn.close()
+        pool.putconn(conn)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == [] and wrong == []
+    finally:
+        for s in stores:
+            with s._cursor() as cur:
+                cur.execute(f'DROP SCHEMA IF EXISTS "{s.schema}" CASCADE')
+        pool.closeall()
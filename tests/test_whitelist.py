@@ -0,0 +1,143 @@
+"""
+Whitelist hàng loạt: đọc ID từ tham số / file CSV, /allow /revoke, /whitelist theo trang.
+"""
+
+import asyncio
+import types
+
+import pytest
+
+import main
+from conftest import FakeBot
+
+OWNER = 1
+
+
+class Message:
+    def __init__(self, document=None, caption=None, reply_to=None):
+        self.document = document
+        self.caption = caption
+        self.reply_to_message = reply_to
+        self.photo = self.video = self.audio = None
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class CsvBot(FakeBot):
+    def __init__(self, files):
+        super().__init__()
+        self.files = files
+
+    async def get_file(self, file_id, **kwargs):
+        async def download_as_bytearray():
+            return bytearray(self.files[file_id])
+        return types.SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+
+def document(file_id, size=100):
+    return types.SimpleNamespace(
+        file_id=file_id, file_unique_id=f"uq-{file_id}", file_name=f"{file_id}.csv",
+        file_size=size, mime_type="text/csv",
+    )
+
+
+def run(handler, user_id, message, args=(), files=None):
+    update = types.SimpleNamespace(
+        message=message,
+        effective_user=types.SimpleNamespace(id=user_id),
+        effective_chat=types.SimpleNamespace(id=user_id),
+    )
+    context = types.SimpleNamespace(args=list(args), bot=CsvBot(files or {}))
+    asyncio.run(handler(update, context))
+    return message.replies
+
+
+@pytest.fixture(autouse=True)
+def owner(monkeypatch):
+    monkeypatch.setattr(main, "OWNER_ID", OWNER)
+
+
+# ---------- ĐỌC ID ----------
+
+def test_parse_user_ids_dedupes_and_counts_bad():
+    assert main.parse_user_ids(["5", " 3 ", "5", "", "abc", "-2", "0", "7"]) == ([5, 3, 7], 3)
+
+
+@pytest.mark.parametrize("data", [
+    b"telegram_id,name\n11,A\n12,B\n11,C\n",
+    b"name;user_id\nA;11\nB;12\n",
+    b"\xef\xbb\xbfid\tname\n11\tA\n12\tB\n",
+    b"11\n12\n\n",
+])
+def test_read_csv_user_ids_formats(data):
+    assert main.read_csv_user_ids(data) == ([11, 12], 0)
+
+
+def test_read_csv_bad_cells():
+    assert main.read_csv_user_ids(b"id\n11\nx\n\n-1\n12,extra\n") == ([11, 12], 2)
+
+
+# ---------- LỆNH ----------
+
+def test_allow_and_revoke_from_args(store):
+    replies = run(main.allow_cmd, OWNER, Message(), ["10,", "11;", "12", "abc"])
+    assert "Đã thêm 3 user" in replies[0] and "Bỏ qua 1 mục" in replies[0]
+    assert main.is_user_allowed(11)
+
+    replies = run(main.revoke_cmd, OWNER, Message(), ["11", "99"])
+    assert "Đã bỏ 1 user" in replies[0]
+    # cache whitelist đổi ngay, không chờ TTL
+    assert not main.is_user_allowed(11) and main.is_user_allowed(12)
+
+
+def test_bulk_limit(store, monkeypatch):
+    monkeypatch.setattr(main, "WHITELIST_BULK_MAX", 2)
+    replies = run(main.allow_cmd, OWNER, Message(), ["1", "2", "3"])
+    assert "Tối đa 2 ID" in replies[0]
+    assert store.get_allowed_user_ids() == []
+
+
+def test_csv_caption_and_reply(store):
+    files = {"wl": b"telegram_id\n21\n22\n"}
+    replies = run(main.whitelist_file, OWNER, Message(document("wl"), caption="/allow"), files=files)
+    assert "Đã thêm 2 user" in replies[0]
+    assert sorted(store.get_allowed_user_ids()) == [21, 22]
+
+    reply_to = Message(document("wl"))
+    replies = run(main.revoke_cmd, OWNER, Message(reply_to=reply_to), files=files)
+    assert "Đã bỏ 2 user" in replies[0]
+    assert store.get_allowed_user_ids() == []
+
+    big = Message(document("wl", size=main.WHITELIST_CSV_MAX_BYTES + 1), caption="/allow")
+    assert "quá lớn" in run(main.whitelist_file, OWNER, big, files=files)[0]
+
+
+def test_non_owner_csv_with_caption_saved_as_file(store):
+    store.add_allowed_user(5, OWNER)
+    message = Message(document("ds"), caption="/allow mấy bạn này")
+    replies = run(main.whitelist_file, 5, message, files={"ds": b"30\n31\n"})
+    assert "Đã lưu file" in replies[0] and "ds.csv" in replies[0]
+    assert store.get_allowed_user_ids() == [5]
+    assert [f["file_id"] for f in store.get_files_of_owner(5)] == ["ds"]
+
+    assert "không có quyền" in run(main.allow_cmd, 5, Message(), ["30"])[0]
+
+
+def test_whitelist_pages(store, monkeypatch):
+    monkeypatch.setattr(main, "WHITELIST_PAGE_SIZE", 2)
+    text, markup = main.build_whitelist_page(0)
+    assert text is None and markup is None
+    assert run(main.whitelist_list_cmd, OWNER, Message())[0] == "Whitelist đang trống."
+
+    store.add_allowed_users([101, 102, 103], OWNER)
+    store.get_or_create_user(types.SimpleNamespace(id=101, full_name="Một", username="mot"))
+    text, markup = main.build_whitelist_page(1)
+    assert "(3 user) – trang 2/2" in text
+    assert [b.callback_data for b in markup.inline_keyboard[0]] == ["wl:0"]
+    text, markup = main.build_whitelist_page(0)
+    assert [b.callback_data for b in markup.inline_keyboard[0]] == ["wl:1"]
+    # trang vượt quá → quay về trang đầu
+    assert "trang 1/2" in main.build_whitelist_page(9)[0]
+    assert "Một (@mot)" in "".join(main.build_whitelist_page(p)[0] for p in (0, 1))